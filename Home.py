@@ -2,74 +2,27 @@
 # sys.path.append(os.getcwd())
 from datetime import datetime
 
-import geopandas as gpd
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import numpy as np
 import streamlit as st
 from streamlit_extras.badges import badge
-from streamlit_extras.dataframe_explorer import dataframe_explorer
 
-from app.constants import CITYLINK_COLORS
-from app.load_data import get_rides, get_rides_quarterly, get_route_linestrings
-from app.viz import (map_bus_routes, plot_bar_top_n_for_daterange,
-                     plot_ridership_average)
+from app.baseline import baseline_label
+from app.load_data import (get_ridership_cube, get_route_linestrings,
+                           route_level_of_detail)
+from app.schema import ROUTE_GROUPS
+from app.tiles import tile_layer_url
+from app.tracing import finish_run, span, start_run
+from app.viz import (cube_line_figure, map_bus_routes,
+                     plot_bar_top_n_for_daterange, use_webgl)
 
 st.set_page_config(
     layout="wide",
     page_icon="🚌",
     page_title="Compare MTA Bus Routes by Ridership",
 )
+start_run("Home")
 
 
-def plot_recovery_over_this_quarter(df, route_numbers):
-    df = df[(df.route.isin(route_numbers)) & (df.date >= "2020-01-01")]
-
-    fig = px.line(df, x="date", y="recovery_over_2019", color="route")
-    fig.update_xaxes(showspikes=True)
-    fig.update_xaxes(title_text="")
-    fig.update_yaxes(title_text="Ridership as a % of 2019 benchmark")
-    fig.update_xaxes(tickangle=45)
-    fig.update_layout(plot_bgcolor="#F5F5F5")  # Set light background color
-
-    fig.update_layout(xaxis=dict(rangeslider=dict(visible=True), type="date"))
-
-    for trace in fig.data:
-        if trace.name in CITYLINK_COLORS:
-            trace.marker.color = CITYLINK_COLORS[trace.name]
-            trace.line.color = CITYLINK_COLORS[trace.name]
-
-    fig.update_yaxes(showgrid=False)
-    fig.update_layout(height=600)
-
-    fig.update_layout(
-        title="Ridership as a percentage of ridership for the same period in 2019",
-        legend=dict(
-            orientation="h",
-            yanchor="bottom",
-            y=0.97,
-            xanchor="right",
-            x=1,
-            title_text="",
-        ),
-        margin=dict(l=50, r=50, t=100, b=50),
-    )
-
-    fig.update_xaxes(tickformat="%b %Y")
-    fig.update_yaxes(tickformat=",.0%")
-    fig.update_layout(hovermode="x unified")
-
-    return fig
-
-
-@st.cache_data
-def convert_df(df):
-    # IMPORTANT: Cache the conversion to prevent computation on every rerun
-    return df.to_csv().encode("utf-8")
-
-
-route_linestrings = get_route_linestrings()
-
 # Streamlit app
 st.title("MTA Bus Ridership")
 st.sidebar.title("TransitScope Baltimore")
@@ -81,62 +34,93 @@ title_mapping = {
 freq = "Monthly"
 freq = st.sidebar.selectbox("Choose frequency", ["Monthly", "Quarterly"])
 if freq == "Quarterly":
-    rides = get_rides_quarterly()
-    csv = convert_df(rides)
+    cube = get_ridership_cube("quarter")
 else:
-    rides = get_rides()
-    csv = convert_df(rides)
+    cube = get_ridership_cube("month")
 
 
 # Get the title from the mapping
 title = title_mapping.get(
     freq, "Ridership per month"
 )  # Default to 'Ridership per month'
-# Get the top 5 routes from 2023, group by route number and sum the ridership
-top_5_routes = (
-    rides[rides["date"] >= datetime(2023, 1, 1)]
-    .groupby("route")["ridership"]
-    .sum()
-    .sort_values(ascending=False)
-    .head(5)
-    .reset_index()["route"]
-    .tolist()
-)
+# Get the top 5 routes from 2023 by total ridership
+with span("top routes"):
+    top_5_routes = cube.top_routes(
+        "ridership", n=5, start_date=datetime(2023, 1, 1)
+    )
 route_numbers = st.sidebar.multiselect(
     "Select routes",
-    list(rides["route"].unique()),
+    cube.routes.tolist(),
     default=top_5_routes,
 )
 
+# Any year before the pandemic, or all of them averaged, can be the baseline
+baseline_options = {
+    str(year): (year,)
+    for year in sorted(
+        set(cube.periods.year[cube.periods.year < 2020]), reverse=True
+    )
+}
+if len(baseline_options) > 1:
+    pre_pandemic_years = tuple(sorted(y for (y,) in baseline_options.values()))
+    baseline_options[baseline_label(pre_pandemic_years)] = pre_pandemic_years
+if baseline_options:
+    baseline_years = baseline_options[
+        st.sidebar.selectbox("Recovery baseline", list(baseline_options))
+    ]
+else:
+    # Without a year before the pandemic, there is no recovery to measure
+    baseline_years = None
+    st.sidebar.info("The data has no year before 2020 to measure recovery.")
+
 highlight_routes = st.sidebar.checkbox(
     "Show unselected bus routes on map", value=False
 )
 
 if route_numbers:
+    start_date, end_date = datetime(2018, 1, 1), datetime(2023, 12, 31)
+    n_points = np.count_nonzero(
+        ~np.isnan(cube.select("ridership", route_numbers))
+    )
+    if use_webgl(n_points):
+        # Large charts are downsampled and have no range slider, so the date
+        # window is chosen here and narrowing it plots more detail
+        first_period = cube.periods[0].to_pydatetime()
+        last_period = cube.periods[-1].to_pydatetime()
+        start_date, end_date = st.sidebar.slider(
+            "Date window",
+            min_value=first_period,
+            max_value=last_period,
+            value=(max(start_date, first_period), last_period),
+            format="MMM YYYY",
+        )
     # Add a toggle to set y-axis to start at 0
 
-    # Plot the average ridership for the selected routes
-    fig = plot_ridership_average(
-        rides,
-        # Do the top 5 routes from 2022
-        route_numbers=route_numbers,
-        start_date=datetime(2018, 1, 1),
-        end_date=datetime(2023, 12, 31),
-        y_axis_zero=True,
-    )
-    # Use the title in the plot
-    fig.update_layout(
+    # Plot the average ridership for the selected routes, straight from the
+    # cube's rows. Unchanged selections reuse the figures built before
+    fig = cube_line_figure(
+        cube,
+        route_numbers,
+        "ridership",
+        start_date=start_date,
+        end_date=end_date,
+        # Use the title in the plot
         title=title,
-        yaxis_title=title,
+        y_axis_zero=True,
     )
     # Add a toggle to set y-axis to start at 0
-    fig2 = plot_recovery_over_this_quarter(
-        rides,
-        # Do the top 5 routes from 2022
-        route_numbers=route_numbers,
-    )
+    fig2 = None
+    if baseline_years is not None:
+        fig2 = cube_line_figure(
+            cube,
+            route_numbers,
+            "recovery_over_baseline",
+            start_date=max(start_date, datetime(2020, 1, 1)),
+            end_date=end_date,
+            baseline_years=baseline_years,
+        )
     col1, col2 = st.columns([3, 2])
-    with col1:
+    with col1, span("ridership chart"):
         st.plotly_chart(
             fig,
             use_container_width=True,
@@ -150,32 +134,83 @@ if route_numbers:
         st.markdown("### ")
         st.markdown("### ")
         st.markdown("### ")
-        map_bus_routes(
-            route_linestrings, route_numbers, highlight_routes=highlight_routes
+        # Draw the other routes from the tile server when the tiles are
+        # built, so only the selected routes' geometries are read. They are
+        # simplified to the level of detail the map will be viewed at
+        route_tiles = tile_layer_url("mta_bus_routes")
+        all_routes = highlight_routes and route_tiles is None
+        route_linestrings = get_route_linestrings(
+            None if all_routes else tuple(sorted(route_numbers)),
+            lod=route_level_of_detail(route_numbers, width=400, height=400),
         )
+        with span("route map"):
+            map_bus_routes(
+                route_linestrings,
+                route_numbers,
+                highlight_routes=highlight_routes,
+                other_routes_tiles=route_tiles,
+            )
 
     # Add a date selector, NOT another markdown header
-    st.plotly_chart(
-        fig2,
-        use_container_width=True,
+    if fig2 is not None:
+        with span("recovery chart"):
+            st.plotly_chart(
+                fig2,
+                use_container_width=True,
+            )
+    # Rankings are two lookups per route into the cube's prefix sums, so
+    # they can follow every change to the date range
+    st.markdown("### Explore the top routes over a date range")
+    first_period = cube.periods[0].to_pydatetime()
+    last_period = cube.periods[-1].to_pydatetime()
+    date_col1, date_col2, metric_col, group_col = st.columns(4)
+    start_date = date_col1.date_input(
+        "Start date",
+        min(max(datetime(2022, 1, 1), first_period), last_period),
+        min_value=first_period,
+        max_value=last_period,
     )
-    # NOTE: This is bad practice to just comment this out
-    # st.markdown("### Explore the top routes over a date range")
-    # start_date = st.date_input("Start date", datetime(2022, 1, 1))
-    # end_date = st.date_input("End date", datetime(2022, 12, 31))
-
-    # fig3 = plot_bar_top_n_for_daterange(
-    #     rides, top_n=5, col="ridership", daterange=(start_date, end_date)
-    # )
-    # st.plotly_chart(
-    #     fig3,
-    #     use_container_width=True,
-    # )
-    # # Show the ridership recovery chart
+    end_date = date_col2.date_input(
+        "End date",
+        max(min(datetime(2022, 12, 31), last_period), first_period),
+        min_value=first_period,
+        max_value=last_period,
+    )
+    # Recovery is ranked over the baseline chosen for the recovery chart
+    ranking_metrics = {
+        "Total ridership": "ridership",
+        "Average ridership per day": "ridership_per_day",
+    }
+    if baseline_years is not None:
+        ranking_metrics[
+            f"Average recovery over {baseline_label(baseline_years)}"
+        ] = "recovery_over_baseline"
+    ranking_metric = ranking_metrics[
+        metric_col.selectbox("Rank by", list(ranking_metrics))
+    ]
+    route_group = group_col.selectbox(
+        "Route group", ["All routes"] + list(ROUTE_GROUPS)
+    )
+    with span("top routes for date range"):
+        fig3 = plot_bar_top_n_for_daterange(
+            cube,
+            top_n=5,
+            col=ranking_metric,
+            daterange=(start_date, end_date),
+            route_group=None if route_group == "All routes" else route_group,
+            baseline_years=baseline_years,
+        )
+    if fig3.data and len(fig3.data[0].y):
+        st.plotly_chart(
+            fig3,
+            use_container_width=True,
+        )
+    else:
+        st.info("No routes have ridership in the selected date range.")
 
     with st.expander("Data details"):
         st.write(
-            "The ridership recovery metric uses average daily ridership for the selected period, and compares it to the average daily ridership for the same period in 2019."
+            "The ridership recovery metric uses average daily ridership for the selected period, and compares it to the average daily ridership for the same period in the selected baseline year, or the average over the baseline years."
         )
         st.write(
             "NOTE: If quarterly data is selected, The quarterly data is calculated by taking the sum of the total ridership in each quarter, and dividing it by the number of days in that quarter."
@@ -206,3 +241,4 @@ st.sidebar.write(
     "Data extracted using this [script](https://github.com/jamespizzurro/mta-bus-ridership-scraper) authored by James Pizzurro."
 )
 st.markdown("#")
+finish_run()
@@ -0,0 +1,118 @@
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+# Schema metadata keys for a geometry column stored as WKB
+GEOMETRY_KEY = b"geometry_column"
+CRS_KEY = b"crs"
+
+# Reads map the file into memory instead of copying it, so every process
+# reading the same file shares its pages in the OS page cache
+_filesystem = pafs.LocalFileSystem(use_mmap=True)
+
+
+def _types_mapper(arrow_type: pa.DataType):
+    # Strings stay in Arrow buffers instead of becoming Python objects
+    if arrow_type in (pa.string(), pa.large_string()):
+        return pd.StringDtype("pyarrow")
+    return None
+
+
+def arrow_path(parquet_path: Union[str, Path]) -> Path:
+    """The Arrow IPC file written next to a parquet file"""
+    return Path(parquet_path).with_suffix(".arrow")
+
+
+def write_arrow(frame: pd.DataFrame, path: Union[str, Path]):
+    """Write a frame as an uncompressed Arrow IPC (Feather v2) file
+
+    Uncompressed buffers can be used straight from a memory map, and
+    categoricals are stored as dictionaries, whose codes are too. A
+    GeoDataFrame's geometry is stored as WKB, with its CRS in the schema
+    metadata. The file is replaced in one step, so processes that have the
+    old file mapped keep reading it intact.
+    """
+    geometry = getattr(frame, "_geometry_column_name", None)
+    metadata = {}
+    if geometry is not None:
+        metadata = {
+            GEOMETRY_KEY: geometry.encode(),
+            CRS_KEY: json.dumps(
+                frame.crs.to_json() if frame.crs else None
+            ).encode(),
+        }
+        frame = pd.DataFrame(frame).assign(
+            **{geometry: frame.geometry.to_wkb().to_numpy()}
+        )
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    # Arrow stores NaN as null, and converting nulls back to NaN copies the
+    # column, so floats keep their NaN and read as views of the map
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count:
+            table = table.set_column(
+                i,
+                field,
+                pa.array(frame[field.name].to_numpy(), from_pandas=False),
+            )
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), **metadata}
+    )
+    tmp_path = f"{path}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_arrow(
+    path: Union[str, Path],
+    columns: Optional[List[str]] = None,
+    filter: Optional[ds.Expression] = None,
+) -> pa.Table:
+    """Memory-map an Arrow IPC file and return the matching rows
+
+    Without a filter the columns are views of the mapped file, so nothing is
+    copied or decoded.
+    """
+    dataset = ds.dataset(str(path), format="ipc", filesystem=_filesystem)
+    table = dataset.to_table(columns=columns, filter=filter)
+    # The dataset drops the file's schema metadata
+    return table.replace_schema_metadata(dataset.schema.metadata)
+
+
+def to_frame(table: pa.Table, arrow_strings: bool = True) -> pd.DataFrame:
+    """Convert a table from `read_arrow` to a (Geo)DataFrame
+
+    Numeric columns without nulls stay views of the mapped file. String
+    columns become Arrow-backed `string[pyarrow]` columns, or Python strings
+    without `arrow_strings`. A WKB geometry column written by `write_arrow`
+    is decoded into a GeoDataFrame.
+    """
+    kwargs = {"split_blocks": True}
+    if arrow_strings:
+        kwargs["types_mapper"] = _types_mapper
+    metadata = table.schema.metadata or {}
+    geometry = metadata.get(GEOMETRY_KEY, b"").decode()
+    if geometry not in table.column_names:
+        return table.to_pandas(**kwargs)
+    import geopandas as gpd
+
+    wkb = table[geometry].to_numpy(zero_copy_only=False)
+    frame = table.drop_columns([geometry]).to_pandas(**kwargs)
+    crs = json.loads(metadata[CRS_KEY])
+    frame.insert(
+        table.column_names.index(geometry),
+        geometry,
+        gpd.GeoSeries.from_wkb(wkb, crs=crs),
+    )
+    return gpd.GeoDataFrame(
+        frame,
+        geometry=geometry,
+        crs=crs,
+    )
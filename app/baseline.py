@@ -0,0 +1,207 @@
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.schema import apply_ridership_schema
+
+
+def period_of_year(dates, freq: str) -> np.ndarray:
+    """Return the quarter (1-4) or month (1-12) of each date"""
+    dates = pd.DatetimeIndex(dates)
+    return np.asarray(dates.quarter if freq == "quarter" else dates.month)
+
+
+def baseline_label(baseline_years: Sequence[int]) -> str:
+    """Describe a baseline window, e.g. '2019' or '2018-2019 average'"""
+    baseline_years = sorted(baseline_years)
+    if len(baseline_years) == 1:
+        return str(baseline_years[0])
+    return f"{baseline_years[0]}-{baseline_years[-1]} average"
+
+
+def route_codes(routes: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    """Return integer codes and the route for each code
+
+    Missing routes, and routes not among the categories, get code -1.
+    """
+    if isinstance(routes.dtype, pd.CategoricalDtype):
+        return routes.cat.codes.to_numpy(), routes.cat.categories
+    codes, uniques = pd.factorize(routes, sort=True)
+    return codes, pd.Index(uniques)
+
+
+class BaselineEngine:
+    """Lookup of baseline ridership per day by (route, period of year)
+
+    The engine is built once from the observed ridership. Each baseline window
+    (a single year, or several years averaged) becomes a (n_routes, 13) table
+    indexed by route code and month or quarter number, so recovery for any
+    set of rows is a single gather.
+    """
+
+    def __init__(
+        self,
+        route_codes: np.ndarray,
+        period_of_year: np.ndarray,
+        years: np.ndarray,
+        ridership_per_day: np.ndarray,
+        n_routes: int,
+    ):
+        self.route_codes = np.asarray(route_codes)
+        self.period_of_year = np.asarray(period_of_year)
+        self.years = np.asarray(years)
+        self.ridership_per_day = np.asarray(ridership_per_day, dtype=float)
+        self.n_routes = n_routes
+        self._tables: Dict[Tuple[int, ...], np.ndarray] = {}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, freq: str = "month"):
+        """Build an engine from long-format ridership data
+
+        Route codes are the category codes of a categorical route column, or
+        the factorized codes otherwise.
+        """
+        codes, routes = route_codes(df["route"])
+        return cls(
+            codes,
+            period_of_year(df["date"], freq),
+            df["date"].dt.year.to_numpy(),
+            df["ridership_per_day"].to_numpy(),
+            len(routes),
+        )
+
+    @classmethod
+    def from_cube(cls, cube):
+        """Build an engine from the observed cells of a `RidershipCube`"""
+        per_day = cube.values[cube.metric_index["ridership_per_day"]]
+        rows, cols = np.nonzero(~np.isnan(per_day))
+        return cls(
+            rows,
+            period_of_year(cube.periods, cube.freq)[cols],
+            np.asarray(cube.periods.year)[cols],
+            per_day[rows, cols],
+            len(cube.routes),
+        )
+
+    def table(self, baseline_years: Sequence[int] = (2019,)) -> np.ndarray:
+        """Mean ridership per day for each (route, period of year) in the window
+
+        Tables are cached per window. Route-periods with no ridership in the
+        window are NaN.
+        """
+        key = tuple(sorted(baseline_years))
+        if key not in self._tables:
+            # Code -1 is a route missing from the dimension, not the last row
+            in_window = np.isin(self.years, key) & (self.route_codes >= 0)
+            index = (
+                self.route_codes[in_window],
+                self.period_of_year[in_window],
+            )
+            totals = np.zeros((self.n_routes, 13))
+            counts = np.zeros((self.n_routes, 13))
+            np.add.at(totals, index, self.ridership_per_day[in_window])
+            np.add.at(counts, index, 1)
+            with np.errstate(invalid="ignore"):
+                table = np.where(counts > 0, totals / counts, np.nan)
+            table.flags.writeable = False
+            self._tables[key] = table
+        return self._tables[key]
+
+    def baseline(
+        self,
+        route_codes: np.ndarray,
+        period_of_year: np.ndarray,
+        baseline_years: Sequence[int] = (2019,),
+    ) -> np.ndarray:
+        """Gather the baseline ridership per day for routes and periods
+
+        The arguments broadcast like those of `recovery`. Route code -1 gets
+        NaN.
+        """
+        route_codes, period_of_year = np.broadcast_arrays(
+            route_codes, period_of_year
+        )
+        table = self.table(baseline_years)
+        missing = route_codes < 0
+        if not len(table):
+            return np.full(route_codes.shape, np.nan)
+        baseline = table[np.where(missing, 0, route_codes), period_of_year]
+        return np.where(missing, np.nan, baseline)
+
+    def recovery(
+        self,
+        ridership_per_day: np.ndarray,
+        route_codes: np.ndarray,
+        period_of_year: np.ndarray,
+        years: np.ndarray,
+        baseline_years: Sequence[int] = (2019,),
+    ) -> np.ndarray:
+        """Ridership per day as a fraction of the baseline for the same period
+
+        The arguments broadcast against each other, so a (routes, 1) array of
+        route codes and a (1, periods) array of periods gathers a whole block.
+        Periods up to the end of the baseline window are NaN.
+        """
+        baseline = self.baseline(route_codes, period_of_year, baseline_years)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            recovery = np.asarray(ridership_per_day, dtype=float) / baseline
+        return np.where(
+            np.asarray(years) <= max(baseline_years), np.nan, recovery
+        )
+
+
+def add_ridership_per_day_2019(
+    df: pd.DataFrame, freq: str = "quarter"
+) -> pd.DataFrame:
+    """Calculate the ridership recovery over 2019 for a given frequency
+
+    The input is not modified. The baseline is looked up per (route, period
+    of year) from a `BaselineEngine` table, so no merge is needed.
+
+    Args:
+        df (pd.DataFrame): DataFrame with route, ridership_per_day and date columns
+        freq (str, optional): Frequency to group by. Can be 'quarter' or 'month'. Defaults to 'quarter'.
+
+    Returns:
+        pd.DataFrame: Copy of df with additional columns for the ridership recovery over 2019
+    """
+    engine = BaselineEngine.from_frame(df, freq)
+    codes, _ = route_codes(df["route"])
+    periods = period_of_year(df["date"], freq)
+    years = df["date"].dt.year.to_numpy()
+    return df.assign(
+        **{
+            freq: periods,
+            "year": years,
+            "ridership_per_day_2019": engine.baseline(codes, periods, (2019,)),
+            "recovery_over_2019": engine.recovery(
+                df["ridership_per_day"].to_numpy(),
+                codes,
+                periods,
+                years,
+                (2019,),
+            ),
+        }
+    )
+
+
+def ridership_for_app(
+    df: pd.DataFrame,
+    freq: str = "month",
+    routes: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """Ridership data as the app loads it
+
+    Typed by `apply_ridership_schema`, sorted by route and date, and with the
+    recovery over 2019 columns. clean_data.py writes the memory-mapped Arrow
+    files in this form, so the app reads them without changing a column.
+
+    Args:
+        df (pd.DataFrame): Monthly or quarterly ridership data
+        freq (str, optional): 'month' or 'quarter'. Defaults to 'month'.
+        routes (pd.DataFrame, optional): Route dimension from `route_dimension`. Defaults to the routes in `df`.
+    """
+    df = apply_ridership_schema(df, routes)
+    df = df.sort_values(["route", "date"], ignore_index=True)
+    return add_ridership_per_day_2019(df, freq)
@@ -1,7 +1,67 @@
+import os
+import tempfile
 from pathlib import Path
 
 data_raw_dir = Path("data/raw")
-data_dir = Path("data")
+# Point the app at another data directory, such as generated synthetic data
+data_dir = Path(os.environ.get("TRANSITSCOPE_DATA_DIR", "data"))
+
+# Load the datasets once per process and share them read-only between
+# sessions, instead of a pickled copy per session
+SHARED_DATASETS = os.environ.get("TRANSITSCOPE_SHARED_DATASETS", "1") != "0"
+
+# Read the Arrow IPC copies of the data files through memory maps, so app
+# processes on one host share their pages in the OS page cache
+MEMORY_MAP = os.environ.get("TRANSITSCOPE_MEMORY_MAP") == "1"
+
+# Stage timing outputs, each off unless set: a sidebar panel of the current
+# run, a JSON lines log of every span and a Prometheus text file of totals
+DEBUG_PANEL = os.environ.get("TRANSITSCOPE_DEBUG") == "1"
+SPAN_LOG_PATH = os.environ.get("TRANSITSCOPE_SPAN_LOG")
+METRICS_PATH = os.environ.get("TRANSITSCOPE_METRICS")
+
+# Per-route bounding box columns stored with the route geometries
+ROUTE_BBOX_COLS = ["minx", "miny", "maxx", "maxy"]
+
+# Simplification tolerance in degrees for each route geometry level of detail,
+# from full resolution (0) to roughly 5 m, 20 m, 50 m and 200 m
+ROUTE_LOD_TOLERANCES = [0.0, 0.00005, 0.0002, 0.0005, 0.002]
+
+# Line charts with more points than this are drawn with WebGL, and each
+# series is downsampled to at most CHART_SERIES_POINTS points
+WEBGL_POINT_THRESHOLD = 2000
+CHART_SERIES_POINTS = 500
+
+# Budget for built chart figures kept in memory, per ridership cube
+FIGURE_CACHE_BYTES = 32 * 1024 * 1024
+FIGURE_CACHE_ENTRIES = 256
+
+# Budget for rendered route maps kept in memory across sessions
+MAP_RENDER_CACHE_BYTES = 64 * 1024 * 1024
+MAP_RENDER_CACHE_ENTRIES = 128
+
+# DuckDB query engine: connections shared by the sessions, threads per query
+# (None for one per core), the budget for cached query results and how
+# often the files behind a view are checked for changes
+SQL_POOL_SIZE = 4
+SQL_THREADS = None
+SQL_RESULT_CACHE_BYTES = 32 * 1024 * 1024
+SQL_RESULT_CACHE_ENTRIES = 256
+# How often the query engine checks a view's files for changes
+SQL_DATA_CHECK_SECONDS = 5.0
+
+# Raster tile pyramids built by build_tiles.py, one {z}/{x}/{y}.png directory
+# per tileset. Streamlit serves its static folder from the app's own origin
+# with server.enableStaticServing, so the browser fetches them from
+# <app URL>/app/static/tiles/. Set TRANSITSCOPE_TILE_BASE_URL where the
+# directories are published elsewhere, such as a CDN, or TRANSITSCOPE_TILE_DIR
+# is outside static/tiles
+TILE_DIR = Path(os.environ.get("TRANSITSCOPE_TILE_DIR", "static/tiles"))
+TILE_BASE_URL = os.environ.get("TRANSITSCOPE_TILE_BASE_URL")
+# A click on the stop tiles picks the nearest stop within this many pixels
+STOP_CLICK_PIXELS = 8
+STOP_TILE_ZOOMS = range(10, 17)
+ROUTE_TILE_ZOOMS = range(9, 16)
 
 CITYLINK_COLORS_DARK = {
     "CityLink Red": "#FF0000",
@@ -34,3 +94,54 @@ CITYLINK_COLORS = {
     "CityLink Gold": "#FFD700",
     "Other": "#000000",
 }
+
+# The bus stop map sends only each stop's key to the browser, and the stop's
+# details are looked up when it is clicked. Set to 1 to send every hover
+# column with the stops instead
+FULL_STOP_HOVER = os.environ.get("TRANSITSCOPE_FULL_STOP_HOVER") == "1"
+
+# Spatial index over the stops: a projected CRS in meters (NAD83 / Maryland)
+# and its grid cell size, and the distances offered for nearby stop searches
+STOP_INDEX_CRS = "EPSG:26985"
+STOP_INDEX_CELL_M = 400
+NEARBY_STOP_RADII_M = [200, 400, 800, 1600]
+
+# Grid cell sizes in meters offered for the ridership heatmap
+HEATMAP_CELL_SIZES_M = [100, 250, 500, 1000]
+
+# Rows converted and written at a time when exporting data for download
+EXPORT_CHUNK_ROWS = 50_000
+
+# Directory export files are written to before they are handed to the
+# download button, and the age and total size past which files left there,
+# e.g. by an interrupted export, are deleted
+EXPORT_DIR = Path(
+    os.environ.get(
+        "TRANSITSCOPE_EXPORT_DIR",
+        Path(tempfile.gettempdir()) / "transitscope-exports",
+    )
+)
+EXPORT_MAX_AGE_SECONDS = 3600
+EXPORT_MAX_BYTES = 2 * 1024**3
+
+# Short color codes and spellings in the stops' routes_served, mapped to the
+# CityLink route names used in the ridership data
+COLOR_TO_CITYLINK = {
+    "BL": "CityLink Blue",
+    "BR": "CityLink Brown",
+    "CityLink BLUE": "CityLink Blue",
+    "CityLink NAVY": "CityLink Navy",
+    "CityLink ORANGE": "CityLink Orange",
+    "CityLink RED": "CityLink Red",
+    "CityLink SILVER": "CityLink Silver",
+    "GD": "CityLink Gold",
+    "GR": "CityLink Green",
+    "LM": "CityLink Lime",
+    "NV": "CityLink Navy",
+    "OR": "CityLink Orange",
+    "PK": "CityLink Pink",
+    "PR": "CityLink Purple",
+    "RD": "CityLink Red",
+    "SV": "CityLink Silver",
+    "YW": "CityLink Yellow",
+}
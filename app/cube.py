@@ -0,0 +1,301 @@
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from app.baseline import BaselineEngine, period_of_year
+from app.schema import classify_route_group
+
+CUBE_METRICS = ["ridership", "ridership_per_day", "recovery_over_2019"]
+
+# How each metric is totaled over a date range. Per-day ridership and
+# recovery are rates, so they are averaged over the periods with data.
+# recovery_over_baseline is recovery over any baseline window, computed
+# when it is asked for
+CUBE_AGGREGATIONS = {
+    "ridership": "sum",
+    "ridership_per_day": "mean",
+    "recovery_over_2019": "mean",
+    "recovery_over_baseline": "mean",
+}
+
+
+class RidershipCube:
+    """Dense route x period array of ridership metrics
+
+    `values` has shape (n_metrics, n_routes, n_periods). Route-periods with no
+    ridership are NaN. Routes and periods are sorted, so a date window is a
+    contiguous slice along the last axis, and its per-route totals are the
+    difference of two columns of the prefix sums.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        routes: np.ndarray,
+        periods: np.ndarray,
+        metrics: List[str] = CUBE_METRICS,
+        freq: str = "month",
+    ):
+        self.values = values
+        self.routes = np.asarray(routes)
+        self.periods = pd.DatetimeIndex(periods)
+        self.metrics = list(metrics)
+        self.freq = freq
+        self.route_index = {route: i for i, route in enumerate(self.routes)}
+        self.metric_index = {
+            metric: i for i, metric in enumerate(self.metrics)
+        }
+        self.route_groups = classify_route_group(pd.Series(self.routes))
+        self._baseline_engine = None
+        self._prefix_sums = None
+
+    @property
+    def baseline_engine(self) -> BaselineEngine:
+        """Baseline lookup built from the cube on first use"""
+        if self._baseline_engine is None:
+            self._baseline_engine = BaselineEngine.from_cube(self)
+        return self._baseline_engine
+
+    @property
+    def prefix_sums(self):
+        """Running totals and counts of each metric along the periods
+
+        `totals[m, r, j]` is the sum of metric m for route r over the first j
+        periods, skipping NaN, and `counts[m, r, j]` the number of values
+        summed. Both are built on first use and read-only.
+        """
+        if self._prefix_sums is None:
+            valid = ~np.isnan(self.values)
+            shape = self.values.shape[:2] + (self.values.shape[2] + 1,)
+            totals = np.zeros(shape)
+            counts = np.zeros(shape, dtype=np.int32)
+            np.cumsum(
+                np.where(valid, self.values, 0), axis=2, out=totals[..., 1:]
+            )
+            np.cumsum(valid, axis=2, out=counts[..., 1:])
+            totals.flags.writeable = counts.flags.writeable = False
+            self._prefix_sums = totals, counts
+        return self._prefix_sums
+
+    def recovery(
+        self,
+        baseline_years=(2019,),
+        positions: Optional[np.ndarray] = None,
+        periods: slice = slice(None),
+    ) -> np.ndarray:
+        """Return a (routes, periods) array of recovery over a baseline window
+
+        Args:
+            baseline_years (tuple, optional): Years to average for the baseline. Defaults to (2019,).
+            positions (np.ndarray, optional): Rows of the routes to include. Defaults to all routes.
+            periods (slice, optional): Periods to include. Defaults to all periods.
+        """
+        if positions is None:
+            positions = np.arange(len(self.routes))
+        per_day = self.values[self.metric_index["ridership_per_day"]]
+        return self.baseline_engine.recovery(
+            per_day[positions, periods],
+            positions[:, None],
+            period_of_year(self.periods[periods], self.freq)[None, :],
+            np.asarray(self.periods[periods].year)[None, :],
+            baseline_years,
+        )
+
+    @classmethod
+    def from_frame(cls, rides: pd.DataFrame, freq: str = "month"):
+        """Build a cube from the long-format ridership data
+
+        Args:
+            rides (pd.DataFrame): DataFrame with route, date, ridership and ridership_per_day columns
+            freq (str, optional): Frequency of the data. Can be 'quarter' or 'month'. Defaults to 'month'.
+        """
+        route_codes, routes = pd.factorize(rides["route"], sort=True)
+        period_codes, periods = pd.factorize(rides["date"], sort=True)
+        periods = pd.DatetimeIndex(periods)
+
+        values = np.full(
+            (len(CUBE_METRICS), len(routes), len(periods)), np.nan
+        )
+        values[0, route_codes, period_codes] = rides["ridership"].to_numpy()
+        values[1, route_codes, period_codes] = rides[
+            "ridership_per_day"
+        ].to_numpy()
+        cube = cls(values, np.asarray(routes, dtype=str), periods, freq=freq)
+        values[2] = cube.recovery((2019,))
+        return cube
+
+    @classmethod
+    def load(cls, file_path: Union[str, Path]):
+        """Load a cube written by `RidershipCube.save`"""
+        with np.load(file_path, allow_pickle=False) as data:
+            return cls(
+                data["values"],
+                data["routes"],
+                data["periods"],
+                metrics=data["metrics"].tolist(),
+                freq=str(data["freq"]),
+            )
+
+    def save(self, file_path: Union[str, Path]):
+        """Write the cube as an uncompressed .npz file"""
+        np.savez(
+            file_path,
+            values=self.values,
+            routes=self.routes,
+            periods=self.periods.to_numpy(),
+            metrics=np.asarray(self.metrics),
+            freq=np.asarray(self.freq),
+        )
+
+    def period_slice(
+        self,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+    ) -> slice:
+        """Return the slice of periods between start_date and end_date, inclusive"""
+        start = (
+            0
+            if start_date is None
+            else self.periods.searchsorted(pd.Timestamp(start_date), "left")
+        )
+        stop = (
+            len(self.periods)
+            if end_date is None
+            else self.periods.searchsorted(pd.Timestamp(end_date), "right")
+        )
+        return slice(start, stop)
+
+    def route_positions(self, route_numbers: List[str]) -> np.ndarray:
+        """Return the row of each route, skipping routes not in the cube"""
+        return np.array(
+            [
+                self.route_index[r]
+                for r in route_numbers
+                if r in self.route_index
+            ],
+            dtype=np.intp,
+        )
+
+    def select(
+        self,
+        metric: str,
+        route_numbers: Optional[List[str]] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+    ) -> np.ndarray:
+        """Return a (routes, periods) array of one metric
+
+        With no route_numbers, this is a view into the cube.
+        """
+        values = self.values[self.metric_index[metric]]
+        if route_numbers is not None:
+            values = values[self.route_positions(route_numbers)]
+        return values[:, self.period_slice(start_date, end_date)]
+
+    def range_totals(
+        self,
+        metric: str = "ridership",
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        how: Optional[str] = None,
+        baseline_years=(2019,),
+    ) -> np.ndarray:
+        """Return each route's total of a metric over a date range
+
+        Two lookups into `prefix_sums` per route, whatever the range.
+        recovery_over_baseline is not stored, so it is computed for the
+        range's periods and totaled from those.
+
+        Args:
+            metric (str, optional): One of the cube's metrics, or 'recovery_over_baseline' for recovery over baseline_years. Defaults to 'ridership'.
+            start_date (datetime, optional): First period, inclusive. Defaults to the first period.
+            end_date (datetime, optional): Last period, inclusive. Defaults to the last period.
+            how (str, optional): 'sum' or 'mean'. Defaults to the metric's entry in CUBE_AGGREGATIONS.
+            baseline_years (tuple, optional): Years to average for the recovery_over_baseline baseline. Defaults to (2019,).
+
+        Returns:
+            np.ndarray: One value per route, NaN for routes with no data in the range
+        """
+        how = how or CUBE_AGGREGATIONS.get(metric, "sum")
+        periods = self.period_slice(start_date, end_date)
+        if metric == "recovery_over_baseline":
+            recovery = self.recovery(baseline_years, periods=periods)
+            valid = ~np.isnan(recovery)
+            total = np.where(valid, recovery, 0.0).sum(axis=1)
+            count = valid.sum(axis=1)
+        else:
+            totals, counts = self.prefix_sums
+            i = self.metric_index[metric]
+            total = totals[i, :, periods.stop] - totals[i, :, periods.start]
+            count = counts[i, :, periods.stop] - counts[i, :, periods.start]
+        if how == "mean":
+            total = total / np.maximum(count, 1)
+        return np.where(count > 0, total, np.nan)
+
+    def top_routes(
+        self,
+        metric: str = "ridership",
+        n: int = 5,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        route_group: Optional[str] = None,
+        how: Optional[str] = None,
+        baseline_years=(2019,),
+    ) -> List[str]:
+        """Return the n routes with the highest total for the date range
+
+        Routes are ranked by `range_totals`, with a partial sort, so only
+        the n largest are ordered. Ties keep the route order. Routes with no
+        data in the range are not ranked.
+
+        Args:
+            route_group (str, optional): Only rank routes in this group, e.g. 'CityLink'. Defaults to every route.
+        """
+        totals = self.range_totals(
+            metric, start_date, end_date, how, baseline_years
+        )
+        candidates = np.flatnonzero(
+            ~np.isnan(totals)
+            & (route_group is None or self.route_groups == route_group)
+        )
+        scores = totals[candidates]
+        if n < len(candidates):
+            top = np.argpartition(-scores, n - 1)[:n]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.lexsort((top, -scores[top]))]
+        return self.routes[candidates[top]].tolist()
+
+    def to_frame(
+        self,
+        route_numbers: List[str],
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        baseline_years=None,
+    ) -> pd.DataFrame:
+        """Return the selected routes and dates in long format for plotting
+
+        Route-periods with no ridership are dropped, as in the parquet data.
+        With baseline_years, a recovery_over_baseline column is added.
+        """
+        positions = self.route_positions(route_numbers)
+        periods = self.period_slice(start_date, end_date)
+        block = self.values[:, positions, periods]
+        n_periods = block.shape[2]
+
+        df = pd.DataFrame(
+            {
+                "route": np.repeat(self.routes[positions], n_periods),
+                "date": np.tile(self.periods[periods], len(positions)),
+            }
+        )
+        for i, metric in enumerate(self.metrics):
+            df[metric] = block[i].ravel()
+        if baseline_years is not None:
+            df["recovery_over_baseline"] = self.recovery(
+                baseline_years, positions, periods
+            ).ravel()
+        return df[df["ridership"].notna()].reset_index(drop=True)
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Pick n_out points of a series with Largest-Triangle-Three-Buckets
+
+    The first and last points are kept. The points between are split into
+    n_out - 2 buckets, and from each bucket the point forming the largest
+    triangle with the previously kept point and the average of the next
+    bucket is kept, so peaks and troughs survive the downsampling.
+
+    Args:
+        x (np.ndarray): Increasing x values, such as datetime64 or numbers
+        y (np.ndarray): y values, without NaN
+        n_out (int): Number of points to keep
+
+    Returns:
+        np.ndarray: Sorted positions of the kept points
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x).astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Bucket i covers [bounds[i], bounds[i + 1]); the last is the last point
+    bounds = np.empty(n_out, dtype=np.int64)
+    bounds[:-1] = (
+        np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(np.int64)
+        + 1
+    )
+    bounds[-1] = n
+    bounds[-2] = n - 1
+    # Average of the bucket after each one, from prefix sums
+    cum_x = np.concatenate([[0.0], np.cumsum(x)])
+    cum_y = np.concatenate([[0.0], np.cumsum(y)])
+    sizes = bounds[2:] - bounds[1:-1]
+    next_x = (cum_x[bounds[2:]] - cum_x[bounds[1:-1]]) / sizes
+    next_y = (cum_y[bounds[2:]] - cum_y[bounds[1:-1]]) / sizes
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = bounds[i], bounds[i + 1]
+        # Twice the triangle areas; the factor doesn't change the argmax
+        area = np.abs(
+            (x[a] - next_x[i]) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (next_y[i] - y[a])
+        )
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
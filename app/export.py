@@ -0,0 +1,198 @@
+import tempfile
+import time
+from itertools import chain
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import streamlit as st
+
+from app.constants import (EXPORT_CHUNK_ROWS, EXPORT_DIR,
+                           EXPORT_MAX_AGE_SECONDS, EXPORT_MAX_BYTES)
+
+# File extension and MIME type of each download format
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow IPC": ("arrow", "application/vnd.apache.arrow.file"),
+}
+
+ExportSource = Union[pd.DataFrame, pa.Table, pa.RecordBatchReader]
+
+
+def _decode_dictionaries(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Cast dictionary (categorical) columns to their values for CSV"""
+    columns = [
+        col.cast(col.type.value_type)
+        if pa.types.is_dictionary(col.type)
+        else col
+        for col in batch.columns
+    ]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def iter_batches(
+    source: ExportSource, chunk_rows: int = EXPORT_CHUNK_ROWS
+) -> Iterator[pa.RecordBatch]:
+    """Yield record batches of at most chunk_rows rows
+
+    DataFrames are converted one slice at a time, so only a chunk is ever
+    copied into Arrow memory. Readers are consumed as they stream. An empty
+    source yields one empty batch, so the export still has a header.
+    """
+    if isinstance(source, pd.DataFrame):
+        schema = pa.Schema.from_pandas(source, preserve_index=False)
+        batches = (
+            pa.RecordBatch.from_pandas(
+                source.iloc[start : start + chunk_rows],
+                schema=schema,
+                preserve_index=False,
+            )
+            for start in range(0, len(source), chunk_rows)
+        )
+    elif isinstance(source, pa.Table):
+        schema = source.schema
+        batches = source.to_batches(max_chunksize=chunk_rows)
+    else:
+        schema = source.schema
+        batches = (
+            batch.slice(start, chunk_rows)
+            for batch in source
+            for start in range(0, batch.num_rows, chunk_rows)
+        )
+    empty = True
+    for batch in batches:
+        empty = False
+        yield batch
+    if empty:
+        yield pa.RecordBatch.from_pylist([], schema=schema)
+
+
+def write_batches(
+    batches: Iterable[pa.RecordBatch], file_path: Union[str, Path], fmt: str
+) -> int:
+    """Write batches to file_path in an `EXPORT_FORMATS` format
+
+    The file is written one batch at a time, so memory use is bounded by
+    the batch size.
+
+    Returns:
+        int: Number of rows written
+    """
+    batches = iter(batches)
+    first = next(batches)
+    if fmt == "CSV":
+        batches = map(_decode_dictionaries, batches)
+        first = _decode_dictionaries(first)
+        writer = pacsv.CSVWriter(file_path, first.schema)
+    elif fmt == "Parquet":
+        writer = pq.ParquetWriter(file_path, first.schema)
+    elif fmt == "Arrow IPC":
+        writer = pa.ipc.new_file(file_path, first.schema)
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    rows = 0
+    with writer:
+        for batch in chain([first], batches):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def prune_exports(
+    export_dir: Path = EXPORT_DIR,
+    max_age: float = EXPORT_MAX_AGE_SECONDS,
+    max_bytes: int = EXPORT_MAX_BYTES,
+) -> int:
+    """Delete export files older than max_age seconds, then the oldest ones
+    until the rest fit in max_bytes
+
+    Returns:
+        int: Number of files deleted
+    """
+    files = []
+    for path in export_dir.glob("*"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Deleted by another session meanwhile
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort(key=lambda f: f[0], reverse=True)
+    now = time.time()
+    kept_bytes = deleted = 0
+    for mtime, size, path in files:
+        kept_bytes += size
+        if now - mtime > max_age or kept_bytes > max_bytes:
+            path.unlink(missing_ok=True)
+            kept_bytes -= size
+            deleted += 1
+    return deleted
+
+
+def export_to_file(
+    source: ExportSource,
+    fmt: str,
+    chunk_rows: int = EXPORT_CHUNK_ROWS,
+    export_dir: Path = EXPORT_DIR,
+) -> Path:
+    """Stream source to a new file in export_dir in the given format
+
+    Old files in export_dir are pruned first. The caller owns the file and
+    should delete it when done; `prune_exports` removes any it leaves.
+    """
+    export_dir.mkdir(parents=True, exist_ok=True)
+    prune_exports(export_dir)
+    suffix = "." + EXPORT_FORMATS[fmt][0]
+    with tempfile.NamedTemporaryFile(
+        suffix=suffix, dir=export_dir, delete=False
+    ) as f:
+        file_path = Path(f.name)
+    try:
+        write_batches(iter_batches(source, chunk_rows), file_path, fmt)
+    except BaseException:
+        file_path.unlink(missing_ok=True)
+        raise
+    return file_path
+
+
+def download_export(
+    get_source: Callable[[], ExportSource],
+    file_stem: str,
+    key: str = "export",
+):
+    """Offer the data in a choice of formats, exporting only on request
+
+    Nothing is exported until the user asks to prepare the download. The
+    file is handed to the download button on that run only, and deleted as
+    soon as Streamlit has its copy, so later reruns read nothing; the
+    button then asks for a new download to be prepared.
+
+    Args:
+        get_source (Callable): Returns the data to export
+        file_stem (str): Download file name without the extension
+        key (str, optional): Widget key prefix. Defaults to 'export'.
+    """
+    fmt = st.radio(
+        "Format", list(EXPORT_FORMATS), horizontal=True, key=f"{key}_format"
+    )
+    extension, mime = EXPORT_FORMATS[fmt]
+    if not st.button(f"Prepare {fmt} download", key=f"{key}_prepare"):
+        return
+    with st.spinner("Exporting..."):
+        file_path = export_to_file(get_source(), fmt)
+    try:
+        with open(file_path, "rb") as f:
+            st.download_button(
+                label=f"Download {fmt}",
+                data=f,
+                file_name=f"{file_stem}.{extension}",
+                mime=mime,
+                key=f"{key}_download",
+            )
+    finally:
+        file_path.unlink(missing_ok=True)
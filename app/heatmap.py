@@ -0,0 +1,49 @@
+import numpy as np
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111_320
+
+
+def bin_points(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    weights: np.ndarray,
+    cell_size_m: float,
+) -> np.ndarray:
+    """Sum weighted points into a square grid of roughly cell_size_m meters
+
+    The grid is anchored at the south-west corner of the points, with the
+    longitude step widened for the latitude of the points. Points with a
+    missing location or weight are skipped.
+
+    Returns:
+        np.ndarray: (n_cells, 3) array of cell center latitude, longitude and
+        summed weight, for cells with a positive total only
+    """
+    lat, lon, weights = (
+        np.asarray(a, dtype=float) for a in (lat, lon, weights)
+    )
+    valid = ~(np.isnan(lat) | np.isnan(lon) | np.isnan(weights))
+    lat, lon, weights = lat[valid], lon[valid], weights[valid]
+    if len(lat) == 0:
+        return np.empty((0, 3))
+
+    dlat = cell_size_m / METERS_PER_DEGREE
+    dlon = dlat / np.cos(np.radians(lat.mean()))
+    lat0, lon0 = lat.min(), lon.min()
+    row = ((lat - lat0) // dlat).astype(np.int64)
+    col = ((lon - lon0) // dlon).astype(np.int64)
+
+    cells, inverse = np.unique(
+        row * (col.max() + 1) + col, return_inverse=True
+    )
+    totals = np.bincount(inverse, weights=weights, minlength=len(cells))
+    cell_row, cell_col = np.divmod(cells, col.max() + 1)
+    binned = np.column_stack(
+        [
+            lat0 + (cell_row + 0.5) * dlat,
+            lon0 + (cell_col + 0.5) * dlon,
+            totals,
+        ]
+    )
+    return binned[totals > 0]
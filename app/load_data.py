@@ -1,53 +1,48 @@
 from datetime import datetime
 
-import geopandas as gpd
 import numpy as np
 import pandas as pd
-import streamlit as st
+import pyarrow.parquet as pq
 
+from app.arrow_store import arrow_path, read_arrow, to_frame
+from app.baseline import add_ridership_per_day_2019, ridership_for_app
+from app.constants import (MEMORY_MAP, ROUTE_BBOX_COLS, ROUTE_LOD_TOLERANCES,
+                           data_dir)
+from app.cube import RidershipCube
+from app.heatmap import bin_points
+from app.partitions import (PARTITION_COLS, list_partitions, read_partitions,
+                            snapshot_sort_key)
+from app.query import scan
+from app.schema import apply_ridership_schema
+from app.shared import shared_dataset
+from app.spatial_index import StopSpatialIndex
+from app.stop_index import StopRouteIndex
+from app.tracing import cache_data, cache_resource
 
-def add_ridership_per_day_2019(
-    df: pd.DataFrame, freq: str = "quarter"
-) -> pd.DataFrame:
-    """Calculate the ridership recovery over 2019 for a given frequency
+# geopandas is imported by the readers that return geometries, so pages that
+# only use the ridership tables start without it
 
-    Args:
-        df (pd.DataFrame): DataFrame with ridership and date columns
-        freq (str, optional): Frequency to group by. Can be 'quarter' or 'month'. Defaults to 'quarter'.
 
-    Returns:
-        pd.DataFrame: DataFrame with additional columns for the ridership recovery over 2019
+def memory_mapped(path):
+    """The Arrow IPC copy of a parquet file to memory-map instead, if any
+
+    None unless TRANSITSCOPE_MEMORY_MAP=1 and clean_data.py has written it.
     """
-    # Extract quarter and year information from date column
+    path = arrow_path(path)
+    return path if MEMORY_MAP and path.exists() else None
 
-    # freq can be 'quarter' or 'month'
 
-    df[freq] = (
-        df["date"].dt.quarter if freq == "quarter" else df["date"].dt.month
-    )
-    df["year"] = df["date"].dt.year
-
-    # Filter to same quarter in 2019
-    filter_df = (
-        df[(df["year"] == 2019) & (df[freq] == df[freq])]
-        .groupby(["route", freq])[["ridership_per_day"]]
-        .sum()
-        .reset_index()
+def _read_mapped(path, columns=None, filters=None, arrow_strings=True):
+    # Only the matching rows are copied out of the map and decoded
+    return to_frame(
+        read_arrow(
+            path,
+            columns=columns,
+            filter=pq.filters_to_expression(filters) if filters else None,
+        ),
+        arrow_strings,
     )
 
-    # Merge filtered DataFrame with original DataFrame
-    merged_df = df.merge(
-        filter_df, on=["route", freq], how="left", suffixes=("", "_2019")
-    )
-    merged_df.date = pd.to_datetime(merged_df.date)
-    merged_df["recovery_over_2019"] = np.where(
-        merged_df.date.dt.year < 2020,
-        np.nan,
-        merged_df["ridership_per_day"] / merged_df["ridership_per_day_2019"],
-    )
-
-    return merged_df
-
 
 cols = [
     "route",
@@ -57,31 +52,344 @@ cols = [
 ]
 
 
-@st.cache_data
-def get_rides(file_path="data/mta_bus_ridership.parquet"):
-    """Get the MTA bus ridership data"""
-    rides = pd.read_parquet(file_path)
-    rides = add_ridership_per_day_2019(rides, freq="month")
-    return rides
+def read_ridership(name="mta_bus_ridership"):
+    """Read a ridership dataset by name
+
+    Prefers the memory-mapped Arrow file in memory-map mode, then the
+    partitioned layout written by `clean_data.py --incremental`, then the
+    single parquet file. The Arrow file is written by `ridership_for_app`,
+    so it is returned as mapped, with the recovery columns.
+    """
+    mapped = memory_mapped(data_dir / f"{name}.parquet")
+    if mapped:
+        # Categoricals are stored as dictionaries, so no strings are decoded
+        return _read_mapped(mapped, arrow_strings=False)
+    if (data_dir / name).is_dir():
+        rides = read_partitions(data_dir / name, PARTITION_COLS[name])
+    else:
+        rides = pd.read_parquet(data_dir / f"{name}.parquet")
+    rides = apply_ridership_schema(rides, read_route_dimension())
+    return rides.sort_values(["route", "date"], ignore_index=True)
 
 
-@st.cache_data
-def get_rides_quarterly(file_path="data/mta_bus_ridership_quarterly.parquet"):
+def read_route_dimension():
+    """Read the route table written by clean_data.py, or None if missing"""
+    path = data_dir / "mta_bus_routes.parquet"
+    return pd.read_parquet(path) if path.exists() else None
+
+
+def _read_app_ridership(name, freq, file_path=None):
+    if file_path is not None:
+        return ridership_for_app(pd.read_parquet(file_path), freq)
+    if memory_mapped(data_dir / f"{name}.parquet"):
+        # Already in the app's form, so its columns are views of the map
+        return read_ridership(name)
+    return add_ridership_per_day_2019(read_ridership(name), freq)
+
+
+@shared_dataset
+def get_rides(file_path=None):
     """Get the MTA bus ridership data"""
-    rides = pd.read_parquet(file_path)
-    rides = add_ridership_per_day_2019(rides, freq="quarter")
-    return rides
+    return _read_app_ridership("mta_bus_ridership", "month", file_path)
 
 
-@st.cache_data
-def get_route_linestrings(file_path="data/mta_bus_route_linestring.geojson"):
+@shared_dataset
+def get_rides_quarterly(file_path=None):
     """Get the MTA bus ridership data"""
+    return _read_app_ridership(
+        "mta_bus_ridership_quarterly", "quarter", file_path
+    )
+
+
+@cache_resource(rows=lambda cube: cube.values[0].size)
+def get_ridership_cube(freq="month"):
+    """Get the route x period ridership cube for 'month' or 'quarter'
+
+    The cube is shared read-only between sessions. If the ETL has not written
+    it yet, it is built from the parquet data.
+    """
+    name = (
+        "mta_bus_ridership"
+        if freq == "month"
+        else "mta_bus_ridership_quarterly"
+    )
+    cube_path = data_dir / f"{name}_cube.npz"
+    if cube_path.exists():
+        cube = RidershipCube.load(cube_path)
+    else:
+        cube = RidershipCube.from_frame(read_ridership(name), freq=freq)
+    cube.values.flags.writeable = False
+    return cube
+
+
+ROUTE_GEOPARQUET = data_dir / "mta_bus_route_linestring.parquet"
+ROUTE_GEOJSON = data_dir / "mta_bus_route_linestring.geojson"
+
+
+@cache_data
+def get_route_bounds():
+    """Get the bounding box of every route without reading any geometry"""
+    if ROUTE_GEOPARQUET.exists():
+        has_lod = "lod" in pq.read_schema(ROUTE_GEOPARQUET).names
+        columns = ["route"] + ROUTE_BBOX_COLS
+        filters = [("lod", "==", 0)] if has_lod else None
+        mapped = memory_mapped(ROUTE_GEOPARQUET)
+        if mapped:
+            return _read_mapped(mapped, columns, filters)
+        return pd.read_parquet(
+            ROUTE_GEOPARQUET, columns=columns, filters=filters
+        )
+    import geopandas as gpd
+
+    gdf = gpd.read_file(ROUTE_GEOJSON)
+    bounds = gdf.bounds
+    bounds.insert(0, "route", gdf["route"].astype(str))
+    return bounds
+
+
+def routes_in_bbox(bbox):
+    """Return the routes whose bounding box intersects bbox
+
+    Args:
+        bbox (tuple): (minx, miny, maxx, maxy) in longitude and latitude
+    """
+    bounds = get_route_bounds()
+    minx, miny, maxx, maxy = bbox
+    hits = (
+        (bounds["minx"].to_numpy() <= maxx)
+        & (bounds["maxx"].to_numpy() >= minx)
+        & (bounds["miny"].to_numpy() <= maxy)
+        & (bounds["maxy"].to_numpy() >= miny)
+    )
+    return bounds["route"][hits].tolist()
+
+
+def route_level_of_detail(route_numbers, width, height):
+    """Coarsest geometry level that looks right for a map fit to these routes"""
+    bounds = get_route_bounds()
+    selected = bounds[bounds["route"].isin(route_numbers)]
+    if selected.empty:
+        return 0
+    return level_of_detail(
+        (
+            selected["minx"].min(),
+            selected["miny"].min(),
+            selected["maxx"].max(),
+            selected["maxy"].max(),
+        ),
+        width,
+        height,
+    )
+
+
+def _mercator_y(lat):
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def level_of_detail(bbox, width, height):
+    """Return the coarsest level in ROUTE_LOD_TOLERANCES for a map view
+
+    Estimates the zoom at which a width x height pixel map fits bbox, as
+    Leaflet's fitBounds does, and picks the largest simplification tolerance
+    under half a pixel at that zoom. That leaves one zoom level of headroom
+    before simplification is visible.
+    """
+    minx, miny, maxx, maxy = bbox
+    span_x = max(maxx - minx, 1e-9) / 360
+    span_y = max(_mercator_y(maxy) - _mercator_y(miny), 1e-9) / (2 * np.pi)
+    zoom = np.floor(
+        min(np.log2(width / (256 * span_x)), np.log2(height / (256 * span_y)))
+    )
+    zoom = int(np.clip(zoom, 0, 18))
+    half_pixel = 360 / (256 * 2**zoom) / 2
+    levels = [
+        level
+        for level, tolerance in enumerate(ROUTE_LOD_TOLERANCES)
+        if tolerance <= half_pixel
+    ]
+    return max(levels)
+
+
+@shared_dataset
+def get_route_linestrings(
+    route_numbers=None,
+    bbox=None,
+    lod=0,
+    file_path=ROUTE_GEOJSON,
+):
+    """Get the MTA bus route geometries
+
+    Reads the GeoParquet written by `clean_data.py --routes` when it exists,
+    pushing the route, bbox and level filters down so only the matching row
+    groups are read. Falls back to parsing the GeoJSON.
+
+    Args:
+        route_numbers (tuple, optional): Only read these routes. Defaults to all routes.
+        bbox (tuple, optional): Only read routes whose bounding box intersects (minx, miny, maxx, maxy).
+        lod (int, optional): Level of detail, an index into ROUTE_LOD_TOLERANCES. Defaults to 0, full resolution.
+    """
+    import geopandas as gpd
+
+    if ROUTE_GEOPARQUET.exists():
+        schema_names = pq.read_schema(ROUTE_GEOPARQUET).names
+        has_lod = "lod" in schema_names
+        filters = [("lod", "==", lod)] if has_lod else []
+        if route_numbers is not None:
+            filters.append(("route", "in", [str(r) for r in route_numbers]))
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            filters += [
+                ("minx", "<=", maxx),
+                ("maxx", ">=", minx),
+                ("miny", "<=", maxy),
+                ("maxy", ">=", miny),
+            ]
+        columns = [
+            name
+            for name in schema_names
+            if name not in ROUTE_BBOX_COLS + ["lod"]
+        ]
+        mapped = memory_mapped(ROUTE_GEOPARQUET)
+        if mapped:
+            gdf = _read_mapped(mapped, columns, filters)
+        else:
+            gdf = gpd.read_parquet(
+                ROUTE_GEOPARQUET, columns=columns, filters=filters or None
+            )
+        if has_lod or not lod:
+            return gdf
+        return gdf.assign(geometry=gdf.simplify(ROUTE_LOD_TOLERANCES[lod]))
+
     gdf = gpd.read_file(file_path)
     # The geometry column contains many multiline strings	, so we need to convert them to single linestrings
-
+    if route_numbers is not None:
+        gdf = gdf[gdf["route"].isin(route_numbers)]
+    if bbox is not None:
+        gdf = gdf.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
+    if lod:
+        gdf = gdf.assign(geometry=gdf.simplify(ROUTE_LOD_TOLERANCES[lod]))
     return gdf
 
 
-@st.cache_data
-def get_bus_stops(file_path="data/mta_bus_stops.parquet"):
+@shared_dataset
+def get_bus_stops(file_path=data_dir / "mta_bus_stops.parquet"):
+    mapped = memory_mapped(file_path)
+    if mapped:
+        return _read_mapped(mapped)
+    import geopandas as gpd
+
     return gpd.read_parquet(file_path)
+
+
+@cache_data
+def get_stop_heatmap(
+    metric: str = "rider_total",
+    cell_size_m: int = 250,
+    file_path=data_dir / "mta_bus_stops.parquet",
+    snapshot=None,
+) -> np.ndarray:
+    """Bin the bus stops into grid cells, summing one ridership metric
+
+    Binned once per metric, cell size and snapshot. With a snapshot key from
+    `get_stop_snapshots`, only that snapshot's partition is read. See
+    `app.heatmap.bin_points`.
+    """
+    columns = ["latitude", "longitude", metric]
+    mapped = memory_mapped(file_path)
+    if snapshot is not None:
+        stops = (
+            scan("mta_bus_stop_ridership")
+            .select(*columns)
+            .where(snapshots=[snapshot])
+            .to_pandas()
+        )
+    elif mapped:
+        stops = _read_mapped(mapped, columns)
+    else:
+        stops = pd.read_parquet(file_path, columns=columns)
+    return bin_points(
+        stops["latitude"].to_numpy(),
+        stops["longitude"].to_numpy(),
+        stops[metric].to_numpy(),
+        cell_size_m,
+    )
+
+
+@cache_data
+def get_daily_rides(
+    routes=None, start_date=None, end_date=None, columns=None
+) -> pd.DataFrame:
+    """Get daily route ridership, reading only the months and columns needed
+
+    Args:
+        routes (tuple, optional): Only these routes. Defaults to all routes.
+        start_date (date, optional): First day to read. Defaults to the first day stored.
+        end_date (date, optional): Last day to read. Defaults to the last day stored.
+        columns (tuple, optional): Columns to read. Defaults to every column.
+    """
+    rides = (
+        scan("mta_bus_ridership_daily")
+        .select(*(columns or ["route", "date", "ridership"]))
+        .where(
+            routes=list(routes) if routes else None,
+            start_date=start_date,
+            end_date=end_date,
+        )
+        .to_pandas()
+    )
+    return rides.sort_values(
+        [col for col in ["route", "date"] if col in rides], ignore_index=True
+    )
+
+
+def get_stop_snapshots():
+    """Keys of the stop ridership snapshots, oldest first
+
+    Read from the partition directories, without reading any data.
+    """
+    name = "mta_bus_stop_ridership"
+    if not (data_dir / name).is_dir():
+        return []
+    keys = list_partitions(data_dir / name, PARTITION_COLS[name])["snapshot"]
+    return sorted(keys, key=snapshot_sort_key)
+
+
+@cache_resource(rows=lambda index: index.n_stops)
+def get_stop_route_index(
+    file_path=data_dir / "mta_bus_stops.parquet",
+) -> StopRouteIndex:
+    """Build the stop-route index once, shared by every session
+
+    Stop positions are rows of `get_bus_stops(file_path)`.
+    """
+    return StopRouteIndex.from_stops(get_bus_stops(file_path))
+
+
+@cache_resource(rows=lambda index: index.n_stops)
+def get_stop_spatial_index(
+    file_path=data_dir / "mta_bus_stops.parquet",
+) -> StopSpatialIndex:
+    """Build the stops' spatial index once, shared by every session
+
+    Stop positions are rows of `get_bus_stops(file_path)`, as in
+    `get_stop_route_index`.
+    """
+    return StopSpatialIndex.from_stops(get_bus_stops(file_path))
+
+
+@cache_data
+def get_stop_ridership(stop_ids, snapshot) -> pd.DataFrame:
+    """Get the ridership of a few stops in one stop ridership snapshot
+
+    Only the snapshot's partition is read, and only the rows of the stops.
+
+    Args:
+        stop_ids (tuple): The stops
+        snapshot (str): Snapshot key from `get_stop_snapshots`
+    """
+    return (
+        scan("mta_bus_stop_ridership")
+        .select("stop_id", "rider_on", "rider_off", "rider_total")
+        .where(snapshots=[snapshot], stop_ids=list(stop_ids))
+        .to_pandas()
+    )
@@ -0,0 +1,130 @@
+import re
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Hive partition columns for each partitioned ridership dataset
+PARTITION_COLS = {
+    "mta_bus_ridership": ["year", "month"],
+    "mta_bus_ridership_quarterly": ["year", "quarter"],
+    "mta_bus_ridership_daily": ["year", "month"],
+    "mta_bus_stop_ridership": ["snapshot"],
+}
+
+# Partition columns that are not int32
+PARTITION_TYPES = {"snapshot": pa.string()}
+
+SEASONS = ["winter", "spring", "summer", "fall"]
+
+
+def _partitioning(partition_cols: List[str]) -> ds.Partitioning:
+    return ds.partitioning(
+        pa.schema(
+            [
+                (col, PARTITION_TYPES.get(col, pa.int32()))
+                for col in partition_cols
+            ]
+        ),
+        flavor="hive",
+    )
+
+
+def _partition_value(col: str, key) -> str:
+    return str(key) if col in PARTITION_TYPES else str(int(key))
+
+
+def snapshot_key(ridership_period: str) -> str:
+    """Partition key of a stop ridership snapshot, e.g. 'Summer 2023' -> '2023-summer'
+
+    Keys sort by year. `snapshot_sort_key` also orders the seasons.
+    """
+    words = re.findall(r"[a-z0-9]+", ridership_period.lower())
+    years = [w for w in words if w.isdigit()]
+    rest = [w for w in words if not w.isdigit()]
+    return "-".join(years + rest)
+
+
+def snapshot_label(key: str) -> str:
+    """The ridership_period of a snapshot key, e.g. '2023-summer' -> 'Summer 2023'"""
+    year, _, rest = key.partition("-")
+    return f"{rest.replace('-', ' ').title()} {year}".strip()
+
+
+def snapshot_sort_key(key: str):
+    """Sort key that orders snapshot keys by year, then season"""
+    year, _, season = key.partition("-")
+    return (year, SEASONS.index(season) if season in SEASONS else len(SEASONS))
+
+
+def write_partitions(
+    df: pd.DataFrame, root: Union[str, Path], partition_cols: List[str]
+) -> List[Path]:
+    """Write one parquet file per partition, replacing only those partitions
+
+    Partitions that are not present in `df` are left untouched, so appending a
+    month only writes that month's file.
+    """
+    root = Path(root)
+    written = []
+    for keys, part in df.groupby(partition_cols, sort=True):
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        part_dir = root.joinpath(
+            *[
+                f"{col}={_partition_value(col, key)}"
+                for col, key in zip(partition_cols, keys)
+            ]
+        )
+        part_dir.mkdir(parents=True, exist_ok=True)
+        part.drop(columns=partition_cols).to_parquet(
+            part_dir / "part-0.parquet", index=False
+        )
+        written.append(part_dir)
+    return written
+
+
+def list_partitions(
+    root: Union[str, Path], partition_cols: List[str]
+) -> pd.DataFrame:
+    """The partition keys present under root, from directory names alone"""
+    root = Path(root)
+    pattern = "/".join(f"{col}=*" for col in partition_cols)
+    rows = [
+        [part.split("=", 1)[1] for part in path.relative_to(root).parts]
+        for path in sorted(root.glob(pattern))
+        if path.is_dir()
+    ]
+    keys = pd.DataFrame(rows, columns=partition_cols)
+    return keys.astype(
+        {col: "int32" for col in partition_cols if col not in PARTITION_TYPES}
+    )
+
+
+def partitioned_dataset(
+    root: Union[str, Path], partition_cols: List[str]
+) -> ds.Dataset:
+    """Open a partitioned dataset for scanning
+
+    Partition columns are int32 unless listed in PARTITION_TYPES.
+    """
+    return ds.dataset(
+        root, format="parquet", partitioning=_partitioning(partition_cols)
+    )
+
+
+def read_partitions(
+    root: Union[str, Path],
+    partition_cols: List[str],
+    filter: Optional[ds.Expression] = None,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Read a partitioned dataset, with the partition columns"""
+    df = (
+        partitioned_dataset(root, partition_cols)
+        .to_table(columns=columns, filter=filter)
+        .to_pandas()
+    )
+    sort_cols = [col for col in ["route", "date"] if col in df.columns]
+    return df.sort_values(sort_cols).reset_index(drop=True)
@@ -0,0 +1,249 @@
+import operator
+from datetime import date
+from functools import reduce
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from app.constants import data_dir
+from app.partitions import PARTITION_COLS, partitioned_dataset
+
+Bounds = Dict[str, Tuple[Optional[float], Optional[float]]]
+
+
+def ridership_dataset(name: str = "mta_bus_ridership") -> ds.Dataset:
+    """Open a ridership dataset for filtered scans
+
+    Uses the partitioned layout when it exists, so date filters also prune
+    whole partitions, and the single parquet file otherwise.
+    """
+    if (data_dir / name).is_dir():
+        return partitioned_dataset(data_dir / name, PARTITION_COLS[name])
+    return ds.dataset(data_dir / f"{name}.parquet", format="parquet")
+
+
+def _any_equal(col: str, values: Sequence) -> ds.Expression:
+    # Equality tests, unlike is_in, are checked against row group statistics
+    # and partition keys, so row groups and partitions without these values
+    # are skipped
+    return reduce(operator.or_, [ds.field(col) == v for v in values])
+
+
+def _date_partitions(
+    bound: date, partition_cols: Sequence[str], after: bool
+) -> Optional[ds.Expression]:
+    # Prune year (and month) partitions outside a date bound
+    if "year" not in partition_cols:
+        return None
+    year = ds.field("year")
+    if "month" not in partition_cols:
+        return year >= bound.year if after else year <= bound.year
+    month = ds.field("month")
+    if after:
+        return (year > bound.year) | (
+            (year == bound.year) & (month >= bound.month)
+        )
+    return (year < bound.year) | (
+        (year == bound.year) & (month <= bound.month)
+    )
+
+
+def ridership_filter(
+    routes: Optional[Sequence[str]] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    bounds: Optional[Bounds] = None,
+    partition_cols: Sequence[str] = (),
+    snapshots: Optional[Sequence[str]] = None,
+    stop_ids: Optional[Sequence[str]] = None,
+) -> Optional[ds.Expression]:
+    """Build an Arrow filter expression for a ridership scan
+
+    Args:
+        routes (list, optional): Keep these routes. Defaults to all routes.
+        start_date (date, optional): Keep dates on or after start_date.
+        end_date (date, optional): Keep dates on or before end_date.
+        bounds (dict, optional): Inclusive (low, high) bounds per numeric column. Either end may be None.
+        partition_cols (list, optional): Partition columns of the dataset. 'year' and 'month' partitions are filtered by the date range too.
+        snapshots (list, optional): Keep these stop ridership snapshots, by `snapshot_key`.
+        stop_ids (list, optional): Keep these stops.
+
+    Returns:
+        ds.Expression: The filter, or None to keep every row
+    """
+    conditions = []
+    if routes:
+        conditions.append(_any_equal("route", routes))
+    if snapshots:
+        conditions.append(_any_equal("snapshot", snapshots))
+    if stop_ids:
+        conditions.append(ds.field("stop_id").isin(stop_ids))
+    for bound, after in [(start_date, True), (end_date, False)]:
+        if bound is None:
+            continue
+        field = ds.field("date")
+        conditions.append(
+            field >= pd.Timestamp(bound)
+            if after
+            else field <= pd.Timestamp(bound)
+        )
+        pruning = _date_partitions(bound, partition_cols, after)
+        if pruning is not None:
+            conditions.append(pruning)
+    for col, (low, high) in (bounds or {}).items():
+        if low is not None:
+            conditions.append(ds.field(col) >= low)
+        if high is not None:
+            conditions.append(ds.field(col) <= high)
+    return reduce(operator.and_, conditions) if conditions else None
+
+
+class Scan:
+    """A lazy scan of a ridership dataset: the columns and rows to read
+
+    `select` and `where` return new scans without reading anything. Only the
+    partitions, row groups and columns the scan needs are read when it is
+    materialized with `to_pandas`, streamed with `batches`, or reduced with
+    `aggregate`, whose memory use grows with the number of groups rather
+    than the history scanned.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        columns: Optional[List[str]] = None,
+        filter: Optional[ds.Expression] = None,
+    ):
+        self.name = name
+        self.columns = columns
+        self.filter = filter
+
+    @property
+    def partition_cols(self) -> List[str]:
+        if (data_dir / self.name).is_dir():
+            return PARTITION_COLS.get(self.name, [])
+        return []
+
+    def select(self, *columns: str) -> "Scan":
+        """Read only these columns"""
+        return Scan(self.name, list(columns), self.filter)
+
+    def where(
+        self, expression: Optional[ds.Expression] = None, **filters
+    ) -> "Scan":
+        """Keep the rows matching an expression and `ridership_filter` arguments"""
+        conditions = [
+            e
+            for e in [
+                self.filter,
+                expression,
+                ridership_filter(
+                    partition_cols=self.partition_cols, **filters
+                ),
+            ]
+            if e is not None
+        ]
+        return Scan(
+            self.name,
+            self.columns,
+            reduce(operator.and_, conditions) if conditions else None,
+        )
+
+    def batches(self) -> pa.RecordBatchReader:
+        """Stream the matching rows"""
+        return (
+            ridership_dataset(self.name)
+            .scanner(columns=self.columns, filter=self.filter)
+            .to_reader()
+        )
+
+    def to_table(self) -> pa.Table:
+        return ridership_dataset(self.name).to_table(
+            columns=self.columns, filter=self.filter
+        )
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.to_table().to_pandas()
+
+    def count_rows(self) -> int:
+        return ridership_dataset(self.name).count_rows(filter=self.filter)
+
+    def aggregate(
+        self, by: Sequence[str], sums: Sequence[str]
+    ) -> pd.DataFrame:
+        """Sum columns per group, one batch at a time
+
+        Each batch is reduced to per-group partial sums before the next is
+        read, so only the partial sums are held in memory.
+        """
+        by, sums = list(by), list(sums)
+        partials = []
+        for batch in Scan(self.name, by + sums, self.filter).batches():
+            if batch.num_rows:
+                partials.append(
+                    _sum_by(pa.Table.from_batches([batch]), by, sums)
+                )
+            if len(partials) > 64:
+                partials = [_sum_by(pa.concat_tables(partials), by, sums)]
+        if not partials:
+            return pd.DataFrame(columns=by + sums)
+        table = _sum_by(pa.concat_tables(partials), by, sums)
+        return (
+            table.select(by + sums)
+            .to_pandas()
+            .sort_values(by, ignore_index=True)
+        )
+
+
+def _sum_by(table: pa.Table, by: List[str], sums: List[str]) -> pa.Table:
+    table = table.group_by(by).aggregate([(col, "sum") for col in sums])
+    # Arrow names the sums "<col>_sum"
+    return table.rename_columns(
+        [
+            name[: -len("_sum")] if name[: -len("_sum")] in sums else name
+            for name in table.column_names
+        ]
+    )
+
+
+def scan(name: str = "mta_bus_ridership") -> Scan:
+    """Start a lazy scan of a ridership dataset by name"""
+    return Scan(name)
+
+
+def scan_ridership(
+    name: str = "mta_bus_ridership",
+    columns: Optional[List[str]] = None,
+    **filters,
+) -> pa.RecordBatchReader:
+    """Stream the rows of a ridership dataset that match the filters
+
+    The filter is pushed down to the parquet reader, so only the matching
+    partitions and row groups are read. See `ridership_filter` for the
+    filter arguments.
+    """
+    return Scan(name, columns).where(**filters).batches()
+
+
+def column_ranges(
+    name: str = "mta_bus_ridership", columns: Sequence[str] = ()
+) -> Dict[str, Tuple]:
+    """Return the (min, max) of columns from parquet statistics alone
+
+    No data pages are read, so this is cheap for any dataset size.
+    """
+    ranges = {}
+    for fragment in ridership_dataset(name).get_fragments():
+        for row_group in fragment.row_groups:
+            for col in columns:
+                stats = row_group.statistics.get(col)
+                if not stats:
+                    continue
+                low, high = ranges.get(col, (stats["min"], stats["max"]))
+                ranges[col] = (
+                    min(low, stats["min"]),
+                    max(high, stats["max"]),
+                )
+    return ranges
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def _utf8_size(html: str) -> int:
+    return len(html.encode("utf-8"))
+
+
+class RenderCache:
+    """Bounded LRU of rendered HTML keyed by the inputs that produced it
+
+    Entries are evicted least recently used first once either the number of
+    entries or their total size in bytes goes over budget. The cache is
+    shared between sessions, so every operation holds a lock. Other values,
+    such as query results, can be cached with a `sizeof` that measures them.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_entries: int,
+        sizeof: Callable[[Any], int] = _utf8_size,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """Return the cached HTML for key, or None, and mark it recently used"""
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key: Hashable, html: str):
+        """Store html under key, evicting old entries to stay in budget
+
+        HTML larger than the whole byte budget is not stored.
+        """
+        size = self.sizeof(html)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._sizes.pop(key)
+                del self._entries[key]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = html
+            self._sizes[key] = size
+            self.nbytes += size
+            while (
+                self.nbytes > self.max_bytes
+                or len(self._entries) > self.max_entries
+            ):
+                old_key, _ = self._entries.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def get_or_render(self, key: Hashable, render: Callable[[], str]) -> str:
+        """Return the cached HTML for key, calling render on a miss"""
+        html = self.get(key)
+        if html is None:
+            html = render()
+            self.put(key, html)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Hits, misses, evictions, entries and bytes held"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+        }
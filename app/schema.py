@@ -0,0 +1,117 @@
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+ROUTE_GROUPS = ["CityLink", "LocalLink", "Commuter"]
+
+# Compact widths for the ridership parquet outputs
+RIDERSHIP_DTYPES = {
+    "ridership": "float32",
+    "business_days": "int16",
+    "ridership_weekday": "float32",
+    "num_days_in_month": "int16",
+    "ridership_per_day": "float32",
+    "change_vs_1_years_ago": "float32",
+    "change_vs_2_years_ago": "float32",
+    "change_vs_3_years_ago": "float32",
+    "quarter": "int8",
+    "year": "int16",
+}
+
+# Rows per parquet row group in the single-file ridership outputs. Small
+# groups of route-sorted rows let filtered reads skip most of the file
+RIDERSHIP_ROW_GROUP_ROWS = 128
+
+
+def classify_route_group(routes: pd.Series) -> np.ndarray:
+    """Classify routes as Commuter (100+), LocalLink (<100) or CityLink
+
+    Routes that match none of the groups keep their own name.
+    """
+    routes = routes.astype(str)
+    numeric = routes.str.isnumeric().to_numpy()
+    number = pd.to_numeric(routes.where(numeric), errors="coerce").to_numpy()
+    return np.select(
+        [
+            numeric & (number >= 100),
+            numeric & (number < 100),
+            routes.str.contains("CityLink").to_numpy(),
+        ],
+        ["Commuter", "LocalLink", "CityLink"],
+        default=routes.to_numpy(),
+    )
+
+
+def route_dimension(routes: Iterable[str]) -> pd.DataFrame:
+    """Return the canonical route table: route_id, route and route_group
+
+    Numbered routes come first in numeric order, then named routes
+    alphabetically. route_id is the category code of the route in every
+    ridership output.
+    """
+    routes = pd.Series(pd.unique(pd.Series(list(routes), dtype=str)))
+    numeric = routes.str.isnumeric()
+    order = pd.DataFrame(
+        {
+            "route": routes,
+            "is_named": ~numeric,
+            "number": pd.to_numeric(routes.where(numeric), errors="coerce"),
+        }
+    ).sort_values(["is_named", "number", "route"])
+    dim = pd.DataFrame({"route": order["route"].to_numpy()})
+    dim["route_group"] = classify_route_group(dim["route"])
+    dim.insert(0, "route_id", np.arange(len(dim), dtype=np.int16))
+    return dim
+
+
+def apply_ridership_schema(
+    df: pd.DataFrame, routes: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
+    """Cast ridership data to categoricals and compact numeric widths
+
+    Args:
+        df (pd.DataFrame): Monthly or quarterly ridership data
+        routes (pd.DataFrame, optional): Route dimension from `route_dimension`. Defaults to the routes in `df`.
+
+    Returns:
+        pd.DataFrame: A copy of `df` with the typed schema
+    """
+    if routes is None:
+        routes = route_dimension(df["route"].astype(str).unique())
+    df = df.copy()
+    df["route"] = pd.Categorical(
+        df["route"].astype(str), categories=routes["route"]
+    )
+    if "route_group" in df.columns:
+        extra_groups = sorted(set(routes["route_group"]) - set(ROUTE_GROUPS))
+        df["route_group"] = pd.Categorical(
+            df["route_group"].astype(str),
+            categories=ROUTE_GROUPS + extra_groups,
+        )
+    if "quarter_year" in df.columns:
+        df["quarter_year"] = df["quarter_year"].astype("category")
+    if "date_end" in df.columns:
+        df["date_end"] = pd.to_datetime(df["date_end"])
+    return df.astype(
+        {col: dtype for col, dtype in RIDERSHIP_DTYPES.items() if col in df}
+    )
+
+
+def ridership_for_storage(df: pd.DataFrame) -> pd.DataFrame:
+    """Prepare ridership data for a filterable parquet file
+
+    Categorical columns are stored as plain strings, whose row group
+    statistics Arrow can use to skip row groups, and rows are sorted by
+    route name and date so each row group covers few routes.
+    `apply_ridership_schema` restores the categoricals on read.
+    """
+    df = df.astype(
+        {
+            col: str
+            for col in df.columns
+            if isinstance(df[col].dtype, pd.CategoricalDtype)
+        }
+    )
+    sort_cols = [col for col in ["route", "date"] if col in df.columns]
+    return df.sort_values(sort_cols, ignore_index=True)
@@ -0,0 +1,148 @@
+import functools
+from typing import Callable, Optional
+
+import pandas as pd
+
+from app.constants import SHARED_DATASETS
+from app.tracing import cache_data, cache_resource
+
+if SHARED_DATASETS:
+    # With copy-on-write, frames derived from a shared dataset by selecting,
+    # filtering, set_index, assign and so on reference its data until they
+    # are modified, and modifying them never writes through to it
+    pd.set_option("mode.copy_on_write", True)
+
+
+class ReadOnlyDatasetError(TypeError):
+    """Raised when code tries to modify a shared dataset in place"""
+
+
+def _read_only(*args, **kwargs):
+    raise ReadOnlyDatasetError(
+        "This dataset is shared between sessions and is read-only. Derive a "
+        "new frame with .assign(), .set_index() or .copy() and modify that."
+    )
+
+
+class _ReadOnlyIndexer:
+    """A .loc, .iloc, .at or .iat indexer that can only read"""
+
+    __slots__ = ("_indexer",)
+
+    def __init__(self, indexer):
+        self._indexer = indexer
+
+    def __getitem__(self, key):
+        return self._indexer[key]
+
+    def __call__(self, axis=None):
+        return _ReadOnlyIndexer(self._indexer(axis))
+
+    def __getattr__(self, name):
+        if "setitem" in name:
+            _read_only()
+        return getattr(self._indexer, name)
+
+    __setitem__ = _read_only
+
+
+class _ReadOnlyFrame:
+    """Mixin that rejects in-place changes to a frame
+
+    Results derived from the frame, including copies, are ordinary frames.
+    """
+
+    __setitem__ = __delitem__ = _read_only
+    insert = pop = update = isetitem = _read_only
+    # Every inplace=True method ends here
+    _update_inplace = _read_only
+
+    def __setattr__(self, name, value):
+        if name in ("index", "columns", "crs", "geometry") or (
+            not name.startswith("_") and name in self.columns
+        ):
+            _read_only()
+        super().__setattr__(name, value)
+
+    def set_crs(self, *args, inplace=False, **kwargs):
+        # GeoDataFrame.set_crs changes the shared geometry array's CRS
+        # before it assigns the geometry column
+        if inplace:
+            _read_only()
+        return super().set_crs(*args, **kwargs)
+
+    @property
+    def loc(self):
+        return _ReadOnlyIndexer(super().loc)
+
+    @property
+    def iloc(self):
+        return _ReadOnlyIndexer(super().iloc)
+
+    @property
+    def at(self):
+        return _ReadOnlyIndexer(super().at)
+
+    @property
+    def iat(self):
+        return _ReadOnlyIndexer(super().iat)
+
+
+class ReadOnlyDataFrame(_ReadOnlyFrame, pd.DataFrame):
+    @property
+    def _constructor(self):
+        return pd.DataFrame
+
+
+@functools.lru_cache(maxsize=None)
+def _read_only_class(cls):
+    # GeoDataFrames get a read-only subclass of their own, which keeps the
+    # geometry methods and builds GeoDataFrames from its results
+    if cls is pd.DataFrame:
+        return ReadOnlyDataFrame
+    return type(
+        f"ReadOnly{cls.__name__}",
+        (_ReadOnlyFrame, cls),
+        {"_constructor": property(lambda self: cls._constructor.fget(self))},
+    )
+
+
+def freeze(frame: pd.DataFrame) -> pd.DataFrame:
+    """Return a read-only view of a frame, with Arrow-backed string columns
+
+    Arrow strings are immutable and several times smaller than Python string
+    objects. The view shares every other column with `frame`.
+    """
+    strings = [
+        col
+        for col in frame.columns
+        if frame[col].dtype == object
+        and col != getattr(frame, "_geometry_column_name", None)
+        and pd.api.types.infer_dtype(frame[col], skipna=True) == "string"
+    ]
+    if strings:
+        frame = frame.astype({col: "string[pyarrow]" for col in strings})
+    else:
+        frame = frame.copy(deep=False)
+    # Same memory layout, so the class can be swapped without copying
+    frame.__class__ = _read_only_class(type(frame))
+    return frame
+
+
+def shared_dataset(func: Optional[Callable] = None, **cache_kwargs):
+    """Cache a loader once per process and return its result read-only
+
+    Every session gets the same frozen frame, so nothing is pickled or copied
+    on access. With TRANSITSCOPE_SHARED_DATASETS=0, this is `cache_data`,
+    which gives each caller its own copy.
+    """
+    if func is None:
+        return functools.partial(shared_dataset, **cache_kwargs)
+    if not SHARED_DATASETS:
+        return cache_data(func, **cache_kwargs)
+
+    @functools.wraps(func)
+    def load(*args, **kwargs):
+        return freeze(func(*args, **kwargs))
+
+    return cache_resource(load, **cache_kwargs)
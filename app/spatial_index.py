@@ -0,0 +1,213 @@
+import functools
+from typing import Tuple
+
+import numpy as np
+
+from app.constants import STOP_INDEX_CELL_M, STOP_INDEX_CRS
+
+
+def _as_array(values) -> np.ndarray:
+    return np.atleast_1d(np.asarray(values, dtype=np.float64))
+
+
+def _concat(arrays, dtype) -> np.ndarray:
+    return np.concatenate([np.empty(0, dtype=dtype)] + arrays)
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer(crs: str):
+    # pyproj comes with geopandas; it is imported when an index is built
+    from pyproj import Transformer
+
+    return Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+
+class StopSpatialIndex:
+    """Grid index of stop locations in a projected CRS, for distance queries
+
+    Stops are identified by their row in the bus stops table, as in
+    `StopRouteIndex`. Locations are projected to meters in `crs` and bucketed
+    into square cells of `cell_size` meters, numbered row by row, CSR-style:
+    the stops of cell c are `positions[cell_indptr[c]:cell_indptr[c + 1]]`,
+    so each row of cells a search area covers is one slice. Queries take
+    arrays of points, and keep the stops of the covered cells that are
+    really in the search area.
+    """
+
+    def __init__(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        cell_size: float = STOP_INDEX_CELL_M,
+        crs: str = STOP_INDEX_CRS,
+    ):
+        self.crs = crs
+        self.cell_size = float(cell_size)
+        self.lat = _as_array(lat)
+        self.lon = _as_array(lon)
+        self.x, self.y = self.project(self.lat, self.lon)
+        # Stops without a location are in no cell
+        located = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        x, y = self.x[located], self.y[located]
+        self.x0 = x.min() if len(x) else 0.0
+        self.y0 = y.min() if len(y) else 0.0
+        col = ((x - self.x0) // self.cell_size).astype(np.int64)
+        row = ((y - self.y0) // self.cell_size).astype(np.int64)
+        self.n_cols = int(col.max()) + 1 if len(col) else 1
+        self.n_rows = int(row.max()) + 1 if len(row) else 1
+        cells = row * self.n_cols + col
+        self.positions = located[np.argsort(cells, kind="stable")]
+        self.cell_indptr = np.zeros(self.n_rows * self.n_cols + 1, np.int64)
+        np.cumsum(
+            np.bincount(cells, minlength=self.n_rows * self.n_cols),
+            out=self.cell_indptr[1:],
+        )
+        for array in vars(self).values():
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+
+    @classmethod
+    def from_stops(cls, stops, **kwargs):
+        """Build the index from a table with latitude and longitude columns"""
+        return cls(
+            stops["latitude"].to_numpy(dtype=float),
+            stops["longitude"].to_numpy(dtype=float),
+            **kwargs,
+        )
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.lat)
+
+    def project(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """Project latitudes and longitudes to x and y in meters"""
+        x, y = _transformer(self.crs).transform(_as_array(lon), _as_array(lat))
+        return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+    def _covers_grid(self, xmin, ymin, xmax, ymax) -> bool:
+        return (
+            xmin <= self.x0
+            and ymin <= self.y0
+            and xmax >= self.x0 + self.n_cols * self.cell_size
+            and ymax >= self.y0 + self.n_rows * self.cell_size
+        )
+
+    def _candidates(self, xmin, ymin, xmax, ymax) -> np.ndarray:
+        # Rows of the stops in the cells that overlap a box in meters
+        if not np.isfinite([xmin, ymin, xmax, ymax]).all():
+            return np.empty(0, dtype=np.int64)
+        c0 = max(int((xmin - self.x0) // self.cell_size), 0)
+        c1 = min(int((xmax - self.x0) // self.cell_size), self.n_cols - 1)
+        r0 = max(int((ymin - self.y0) // self.cell_size), 0)
+        r1 = min(int((ymax - self.y0) // self.cell_size), self.n_rows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(r0, r1 + 1) * self.n_cols
+        starts = self.cell_indptr[rows + c0]
+        stops = self.cell_indptr[rows + c1 + 1]
+        return _concat(
+            [self.positions[a:b] for a, b in zip(starts, stops)], np.int64
+        )
+
+    def within(
+        self, lat, lon, radius_m
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the stops within a distance of each point
+
+        Args:
+            lat (float or np.ndarray): Latitudes of the points
+            lon (float or np.ndarray): Longitudes of the points
+            radius_m (float or np.ndarray): Distance in meters, for every point or one per point
+
+        Returns:
+            tuple: (point, position, distance) arrays with one entry per stop found: the point's index, the stop's row and its distance in meters, ordered by point, then nearest first
+        """
+        qx, qy = self.project(lat, lon)
+        radii = np.broadcast_to(_as_array(radius_m), qx.shape)
+        points, positions, distances = [], [], []
+        for i, (x, y, r) in enumerate(zip(qx, qy, radii)):
+            candidates = self._candidates(x - r, y - r, x + r, y + r)
+            d = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+            keep = np.flatnonzero(d <= r)
+            keep = keep[np.argsort(d[keep], kind="stable")]
+            points.append(np.full(len(keep), i, dtype=np.int64))
+            positions.append(candidates[keep])
+            distances.append(d[keep])
+        return (
+            _concat(points, np.int64),
+            _concat(positions, np.int64),
+            _concat(distances, np.float64),
+        )
+
+    def nearest(self, lat, lon, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k nearest stops to each point
+
+        The search starts with the cells around a point and doubles its
+        radius until k stops are found within it.
+
+        Returns:
+            tuple: (positions, distances) arrays of shape (points, k), nearest first. Where fewer than k stops have a location, the rest are -1 and inf.
+        """
+        qx, qy = self.project(lat, lon)
+        positions = np.full((len(qx), k), -1, dtype=np.int64)
+        distances = np.full((len(qx), k), np.inf)
+        for i, (x, y) in enumerate(zip(qx, qy)):
+            if not (np.isfinite(x) and np.isfinite(y)):
+                continue
+            r = self.cell_size
+            while True:
+                box = (x - r, y - r, x + r, y + r)
+                candidates = self._candidates(*box)
+                d = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+                if self._covers_grid(*box):
+                    break
+                # Stops within r are the nearest; the others in the box may
+                # not be, as cells outside it can hold nearer ones
+                if np.count_nonzero(d <= r) >= k:
+                    break
+                r *= 2
+            order = np.argsort(d, kind="stable")[:k]
+            positions[i, : len(order)] = candidates[order]
+            distances[i, : len(order)] = d[order]
+        return positions, distances
+
+    def in_bbox(
+        self, min_lat, min_lon, max_lat, max_lon
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the stops in each latitude and longitude box
+
+        Returns:
+            tuple: (box, position) arrays with one entry per stop found, ordered by box, then stop row
+        """
+        min_lat, min_lon, max_lat, max_lon = np.broadcast_arrays(
+            *(_as_array(v) for v in (min_lat, min_lon, max_lat, max_lon))
+        )
+        # Parallels are curved in a projected CRS, so the cells are searched
+        # a cell beyond the projected corners and the box is checked in
+        # degrees
+        xs, ys = self.project(
+            np.stack([min_lat, min_lat, max_lat, max_lat], axis=1),
+            np.stack([min_lon, max_lon, min_lon, max_lon], axis=1),
+        )
+        xs, ys = xs.reshape(-1, 4), ys.reshape(-1, 4)
+        pad = self.cell_size
+        boxes, positions = [], []
+        for i in range(len(min_lat)):
+            candidates = np.sort(
+                self._candidates(
+                    xs[i].min() - pad,
+                    ys[i].min() - pad,
+                    xs[i].max() + pad,
+                    ys[i].max() + pad,
+                )
+            )
+            lat, lon = self.lat[candidates], self.lon[candidates]
+            found = candidates[
+                (lat >= min_lat[i])
+                & (lat <= max_lat[i])
+                & (lon >= min_lon[i])
+                & (lon <= max_lon[i])
+            ]
+            boxes.append(np.full(len(found), i, dtype=np.int64))
+            positions.append(found)
+        return _concat(boxes, np.int64), _concat(positions, np.int64)
@@ -0,0 +1,297 @@
+import queue
+import re
+import time
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from app.constants import (COLOR_TO_CITYLINK, SQL_DATA_CHECK_SECONDS,
+                           SQL_POOL_SIZE, SQL_RESULT_CACHE_BYTES,
+                           SQL_RESULT_CACHE_ENTRIES, SQL_THREADS, data_dir)
+from app.render_cache import RenderCache
+from app.tracing import span
+
+if TYPE_CHECKING:
+    import duckdb
+
+# duckdb is imported when the first engine is created, so pages start
+# without it
+
+# Columns that may be summed by `top_routes`. Identifiers cannot be bound as
+# parameters, so they are checked against this list instead
+RIDERSHIP_METRICS = ["ridership", "ridership_weekday", "business_days"]
+
+# A row per route serving a stop, from the stops' routes_served lists, with
+# CityLink color codes mapped to route names. Matches `StopRouteIndex`
+STOP_ROUTES_SQL = """
+SELECT DISTINCT split.stop_id, coalesce(citylink.route, split.route) AS route
+FROM (
+    SELECT stop_id, trim(unnest(regexp_split_to_array(routes_served, '[,;]')))
+        AS route
+    FROM stops
+) AS split
+LEFT JOIN citylink_codes AS citylink ON citylink.code = split.route
+WHERE split.route <> ''
+"""
+
+TOP_ROUTES_SQL = """
+SELECT route, sum({metric}) AS {metric}
+FROM {view}
+WHERE date BETWEEN $start AND $end
+GROUP BY route
+ORDER BY {metric} DESC, route
+LIMIT $n
+"""
+
+BOARDINGS_BY_SHELTER_SQL = """
+SELECT shelter = 'Yes' AS shelter, sum(rider_on) AS rider_on
+FROM stops
+GROUP BY ALL
+ORDER BY shelter
+"""
+
+SHELTERS_BY_ROUTE_SQL = """
+SELECT
+    route,
+    count(*) FILTER (WHERE stops.shelter = 'Yes') AS number_of_sheltered_stops,
+    count(*) AS total_stops
+FROM stop_routes
+JOIN stops USING (stop_id)
+GROUP BY route
+ORDER BY number_of_sheltered_stops DESC, route
+"""
+
+
+def _source(name: str) -> Optional[Path]:
+    # The partitioned layout when it exists, as `read_ridership` prefers
+    if (data_dir / name).is_dir():
+        return data_dir / name
+    if (data_dir / f"{name}.parquet").exists():
+        return data_dir / f"{name}.parquet"
+    return None
+
+
+def _scan(path: Path) -> str:
+    if path.is_dir():
+        return (
+            f"read_parquet('{path.as_posix()}/**/*.parquet', "
+            "hive_partitioning = true)"
+        )
+    return f"read_parquet('{path.as_posix()}')"
+
+
+class QueryEngine:
+    """In-process SQL over the parquet files, shared by every session
+
+    One DuckDB database holds a view per dataset, read from the parquet
+    files on each query, so DuckDB's multi-threaded columnar scans do the
+    aggregation. Sessions borrow one of `pool_size` connections to it at a
+    time. Queries take their values as `$name` parameters, which DuckDB
+    binds to the prepared statement rather than splicing them into the SQL.
+    Results are kept in a bounded LRU keyed by the SQL, the parameters and
+    the modification times of the data files behind the views the SQL
+    names, so a rerun with the same inputs does not query again, and
+    rewritten data is queried afresh. The files are checked at most every
+    `data_check_seconds` per view.
+
+    `sources` maps view names to parquet files or partitioned directories.
+    It defaults to the datasets in VIEWS that exist in the data directory.
+    """
+
+    VIEWS = {
+        "ridership": "mta_bus_ridership",
+        "ridership_quarterly": "mta_bus_ridership_quarterly",
+        "ridership_daily": "mta_bus_ridership_daily",
+        "stops": "mta_bus_stops",
+        "stop_ridership": "mta_bus_stop_ridership",
+    }
+
+    def __init__(
+        self,
+        sources: Optional[Dict[str, Path]] = None,
+        pool_size: int = SQL_POOL_SIZE,
+        threads: Optional[int] = SQL_THREADS,
+        cache_bytes: int = SQL_RESULT_CACHE_BYTES,
+        cache_entries: int = SQL_RESULT_CACHE_ENTRIES,
+        data_check_seconds: float = SQL_DATA_CHECK_SECONDS,
+    ):
+        import duckdb
+
+        self.database = self._configure(duckdb.connect(":memory:"))
+        if threads:
+            self.database.execute(f"SET threads = {int(threads)}")
+        if sources is None:
+            sources = {
+                view: _source(name) for view, name in self.VIEWS.items()
+            }
+        self.sources = {
+            view: Path(path)
+            for view, path in sources.items()
+            if path is not None
+        }
+        for view, path in self.sources.items():
+            self.database.execute(
+                f"CREATE VIEW {view} AS SELECT * FROM {_scan(path)}"
+            )
+        self.database.execute(
+            "CREATE TABLE citylink_codes (code VARCHAR, route VARCHAR)"
+        )
+        self.database.executemany(
+            "INSERT INTO citylink_codes VALUES (?, ?)",
+            list(COLOR_TO_CITYLINK.items()),
+        )
+        if "stops" in self.sources:
+            self.database.execute(
+                f"CREATE VIEW stop_routes AS {STOP_ROUTES_SQL}"
+            )
+        self._pool: "queue.Queue[duckdb.DuckDBPyConnection]" = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._configure(self.database.cursor()))
+        self.data_check_seconds = data_check_seconds
+        # view -> (monotonic time checked, file modification times)
+        self._versions: Dict[str, Tuple[float, Tuple]] = {}
+        self.results = RenderCache(
+            cache_bytes,
+            cache_entries,
+            sizeof=lambda df: int(df.memory_usage(deep=True).sum()),
+        )
+
+    @staticmethod
+    def _configure(con: "duckdb.DuckDBPyConnection"):
+        # Settings are per connection. Geometry stays WKB; no query reads it
+        con.execute("SET enable_geoparquet_conversion = false")
+        return con
+
+    @contextmanager
+    def connection(self) -> Iterator["duckdb.DuckDBPyConnection"]:
+        """Borrow a connection, waiting for one if all are in use"""
+        con = self._pool.get()
+        try:
+            yield con
+        finally:
+            self._pool.put(con)
+
+    def _view_version(self, view: str) -> Tuple:
+        # Modification times of the view's files, listed again only once
+        # data_check_seconds have passed since the last listing
+        now = time.monotonic()
+        checked = self._versions.get(view)
+        if checked and now - checked[0] < self.data_check_seconds:
+            return checked[1]
+        path = self.sources[view]
+        files = sorted(path.rglob("*.parquet")) if path.is_dir() else [path]
+        version = tuple(f.stat().st_mtime_ns for f in files)
+        self._versions[view] = (now, version)
+        return version
+
+    def data_version(self, sql: Optional[str] = None) -> Tuple:
+        """Modification times of the files behind the views a query names
+
+        Names are matched as words, so a column named like a view adds
+        that view too. stop_routes is read from stops. Without sql, every
+        view is included.
+        """
+        names = set(re.findall(r"\w+", sql)) if sql is not None else None
+        if names is not None and "stop_routes" in names:
+            names.add("stops")
+        return tuple(
+            (view, self._view_version(view))
+            for view in sorted(self.sources)
+            if names is None or view in names
+        )
+
+    def query(
+        self,
+        sql: str,
+        params: Optional[Dict[str, Any]] = None,
+        name: str = "sql",
+        cache: bool = True,
+    ) -> pd.DataFrame:
+        """Run a parameterized query and return the result as a DataFrame
+
+        Args:
+            sql (str): The query, with `$name` placeholders for the parameters
+            params (dict, optional): Values for the placeholders
+            name (str, optional): Name of the span recorded for the query
+            cache (bool, optional): Use the result cache. Defaults to True.
+
+        Returns:
+            pd.DataFrame: A copy of the result, which the caller may modify
+        """
+        params = params or {}
+        key = (sql, tuple(sorted(params.items())), self.data_version(sql))
+        with span(name) as record:
+            result = self.results.get(key) if cache else None
+            record.cache = "miss" if result is None else "hit"
+            if result is None:
+                with self.connection() as con:
+                    result = con.execute(sql, params).df()
+                if cache:
+                    self.results.put(key, result)
+            record.rows = len(result)
+        return result.copy()
+
+
+@st.cache_resource
+def get_query_engine() -> QueryEngine:
+    """The query engine shared by every session"""
+    return QueryEngine()
+
+
+def top_routes(
+    start: date,
+    end: date,
+    n: int = 5,
+    metric: str = "ridership",
+    freq: str = "month",
+) -> pd.DataFrame:
+    """The n routes with the largest total of a metric between two dates
+
+    Args:
+        start (date): First date, inclusive
+        end (date): Last date, inclusive
+        n (int, optional): Number of routes. Defaults to 5.
+        metric (str, optional): One of RIDERSHIP_METRICS. Defaults to 'ridership'.
+        freq (str, optional): 'month' or 'quarter'. Defaults to 'month'.
+
+    Returns:
+        pd.DataFrame: route and metric columns, largest first
+    """
+    if metric not in RIDERSHIP_METRICS:
+        raise ValueError(f"metric must be one of {RIDERSHIP_METRICS}")
+    view = "ridership" if freq == "month" else "ridership_quarterly"
+    return get_query_engine().query(
+        TOP_ROUTES_SQL.format(metric=metric, view=view),
+        {
+            "start": pd.Timestamp(start).to_pydatetime(),
+            "end": pd.Timestamp(end).to_pydatetime(),
+            "n": int(n),
+        },
+        name="top routes",
+    )
+
+
+def boardings_by_shelter() -> pd.DataFrame:
+    """Total daily boardings at sheltered and unsheltered stops
+
+    Returns:
+        pd.DataFrame: shelter (bool) and rider_on columns, unsheltered first
+    """
+    return get_query_engine().query(
+        BOARDINGS_BY_SHELTER_SQL, name="boardings by shelter"
+    )
+
+
+def shelters_by_route() -> pd.DataFrame:
+    """The number of sheltered stops and of all stops on each route
+
+    Returns:
+        pd.DataFrame: route, number_of_sheltered_stops and total_stops columns, most sheltered stops first
+    """
+    return get_query_engine().query(
+        SHELTERS_BY_ROUTE_SQL, name="shelters by route"
+    )
@@ -0,0 +1,121 @@
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app.constants import COLOR_TO_CITYLINK
+from app.schema import route_dimension
+
+
+def split_routes_served(routes_served: pd.Series) -> pd.Series:
+    """Split 'routes_served' strings into one normalized route per row
+
+    Routes are separated by commas or semicolons. Short CityLink color codes
+    are mapped to the route names used in the ridership data. The index of
+    the result is the position of the stop each route came from.
+    """
+    routes = (
+        routes_served.reset_index(drop=True)
+        .str.split(r"[,;]")
+        .explode()
+        .str.strip()
+    )
+    routes = routes[routes.notna() & (routes != "")]
+    return routes.replace(COLOR_TO_CITYLINK)
+
+
+def _csr(rows: np.ndarray, cols: np.ndarray, n_rows: int):
+    """Return (indptr, indices) with cols grouped by row, in row order"""
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[order]
+
+
+class StopRouteIndex:
+    """Bipartite index between bus stops and the routes that serve them
+
+    Stops are identified by their row in the bus stops table and routes by
+    their row in `routes`. Both directions are stored CSR-style: the routes
+    of stop i are `route_ids[stop_indptr[i]:stop_indptr[i + 1]]` and the
+    stops of route j are `stop_ids[route_indptr[j]:route_indptr[j + 1]]`.
+    """
+
+    def __init__(
+        self,
+        stop_keys: np.ndarray,
+        routes: np.ndarray,
+        pair_stops: np.ndarray,
+        pair_routes: np.ndarray,
+    ):
+        self.stop_keys = np.asarray(stop_keys)
+        self.stop_index: Dict[Hashable, int] = {
+            key: i for i, key in enumerate(self.stop_keys.tolist())
+        }
+        self.routes = np.asarray(routes)
+        self.route_index: Dict[str, int] = {
+            route: i for i, route in enumerate(self.routes)
+        }
+        # One (stop, route) pair per stop served by a route
+        self.pair_stops = np.asarray(pair_stops, dtype=np.int64)
+        self.pair_routes = np.asarray(pair_routes, dtype=np.int64)
+        self.stop_indptr, self.route_ids = _csr(
+            self.pair_stops, self.pair_routes, len(self.stop_keys)
+        )
+        self.route_indptr, self.stop_ids = _csr(
+            self.pair_routes, self.pair_stops, len(self.routes)
+        )
+        for array in vars(self).values():
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+
+    @classmethod
+    def from_stops(cls, stops: pd.DataFrame, key: str = "stop_id"):
+        """Build the index from a table with a 'routes_served' column
+
+        Routes listed twice for the same stop are counted once.
+        """
+        routes = split_routes_served(stops["routes_served"])
+        dim = route_dimension(routes.unique())
+        pairs = np.unique(
+            np.column_stack(
+                [
+                    routes.index.to_numpy(),
+                    pd.Categorical(routes, categories=dim["route"]).codes,
+                ]
+            ),
+            axis=0,
+        )
+        return cls(stops[key].to_numpy(), dim["route"].to_numpy(), *pairs.T)
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.stop_keys)
+
+    def stop_position(self, key: Hashable) -> Optional[int]:
+        """Return the row of the stop with a key, such as a stop_id"""
+        return self.stop_index.get(key)
+
+    def routes_for_stop(self, position: int) -> List[str]:
+        """Return the routes serving the stop at a row of the stops table"""
+        start, stop = self.stop_indptr[position : position + 2]
+        return self.routes[self.route_ids[start:stop]].tolist()
+
+    def stops_for_route(self, route: str) -> np.ndarray:
+        """Return the rows of the stops served by a route"""
+        if route not in self.route_index:
+            return np.empty(0, dtype=np.int64)
+        i = self.route_index[route]
+        return self.stop_ids[self.route_indptr[i] : self.route_indptr[i + 1]]
+
+    def route_totals(self, values: Optional[np.ndarray] = None) -> np.ndarray:
+        """Sum a per-stop value over the stops of each route
+
+        With no values, this is the number of stops on each route.
+        """
+        weights = (
+            None if values is None else np.asarray(values)[self.pair_stops]
+        )
+        return np.bincount(
+            self.pair_routes, weights=weights, minlength=len(self.routes)
+        )
@@ -0,0 +1,417 @@
+from typing import List, Optional
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import MultiLineString
+
+from app.constants import CITYLINK_COLORS, COLOR_TO_CITYLINK
+from app.schema import classify_route_group
+
+METERS_PER_DEGREE = 111_320
+
+# Routes in the real data: 43 LocalLink, 12 Commuter and 12 CityLink
+BASE_LOCAL_ROUTES = 43
+BASE_COMMUTER_ROUTES = 12
+
+# County centers (lon, lat) that routes start from, weighted like the real
+# stops, or spread across the state
+COUNTIES = pd.DataFrame(
+    [
+        ("Baltimore City", -76.61, 39.30, 0.50, 0.20),
+        ("Baltimore County", -76.62, 39.40, 0.22, 0.12),
+        ("Anne Arundel County", -76.60, 39.00, 0.07, 0.08),
+        ("Howard County", -76.93, 39.25, 0.05, 0.06),
+        ("Harford County", -76.30, 39.54, 0.03, 0.05),
+        ("Montgomery County", -77.20, 39.14, 0.03, 0.10),
+        ("Prince George's County", -76.85, 38.83, 0.02, 0.10),
+        ("Washington DC", -77.03, 38.90, 0.03, 0.04),
+        ("Charles County", -76.99, 38.51, 0.01, 0.03),
+        ("Calvert County", -76.53, 38.54, 0.01, 0.02),
+        ("Frederick County", -77.41, 39.47, 0.01, 0.04),
+        ("Saint Mary's County", -76.60, 38.30, 0.01, 0.02),
+        ("Queen Anne's County", -76.10, 39.04, 0.005, 0.02),
+        ("Washington County", -77.72, 39.60, 0.005, 0.03),
+        ("Carroll County", -77.02, 39.56, 0.0, 0.03),
+        ("Cecil County", -75.95, 39.56, 0.0, 0.02),
+        ("Allegany County", -78.76, 39.64, 0.0, 0.02),
+        ("Wicomico County", -75.60, 38.37, 0.0, 0.02),
+    ],
+    columns=["county", "lon", "lat", "baltimore", "statewide"],
+)
+
+STREETS = [
+    "Charles St",
+    "Greenmount Ave",
+    "North Ave",
+    "Eastern Ave",
+    "Pratt St",
+    "Lombard St",
+    "Reisterstown Rd",
+    "Liberty Heights Ave",
+    "Harford Rd",
+    "Belair Rd",
+    "York Rd",
+    "Edmondson Ave",
+    "Frederick Rd",
+    "Wilkens Ave",
+    "Park Heights Ave",
+    "Falls Rd",
+    "Howard St",
+    "Fayette St",
+    "Monument St",
+    "Patterson Park Ave",
+    "Garrison Blvd",
+    "Northern Pkwy",
+    "Cold Spring Ln",
+    "Loch Raven Blvd",
+    "Ritchie Hwy",
+    "Security Blvd",
+]
+
+# The two-letter code the stops data uses for each CityLink route
+CITYLINK_CODES = {
+    name: code for code, name in COLOR_TO_CITYLINK.items() if len(code) == 2
+}
+
+
+def route_names(n_local: int, n_commuter: int, rng) -> List[str]:
+    """Route names in the style of the real data
+
+    LocalLink routes take numbers below 100 until they run out, the rest are
+    Commuter routes numbered from 100 with gaps, then the CityLink routes.
+    """
+    n_local = min(n_local, 99)
+    local = np.sort(rng.choice(np.arange(1, 100), n_local, replace=False))
+    commuter = 100 + np.cumsum(rng.integers(1, 20, n_commuter))
+    return (
+        [str(n) for n in local]
+        + [str(n) for n in commuter]
+        + [r for r in CITYLINK_COLORS if r.startswith("CityLink")]
+    )
+
+
+def route_lines(
+    routes: List[str], rng, statewide: bool = False, n_vertices: int = 150
+) -> gpd.GeoDataFrame:
+    """Random-walk route geometries starting from county centers
+
+    CityLink routes start downtown, Commuter routes take longer steps.
+    """
+    groups = classify_route_group(pd.Series(routes))
+    weights = COUNTIES["statewide" if statewide else "baltimore"].to_numpy()
+    county = rng.choice(len(COUNTIES), len(routes), p=weights / weights.sum())
+    county[groups == "CityLink"] = 0
+    start_lon = COUNTIES["lon"].to_numpy()[county] + rng.normal(
+        0, 0.05, len(routes)
+    )
+    start_lat = COUNTIES["lat"].to_numpy()[county] + rng.normal(
+        0, 0.04, len(routes)
+    )
+    step_m = np.select(
+        [groups == "Commuter", groups == "CityLink"], [300.0, 120.0], 80.0
+    )
+    # Headings wander a little from one step to the next
+    heading = rng.uniform(0, 2 * np.pi, (len(routes), 1)) + np.cumsum(
+        rng.normal(0, 0.2, (len(routes), n_vertices - 1)), axis=1
+    )
+    step_deg = step_m[:, None] / METERS_PER_DEGREE
+    lat = start_lat[:, None] + np.concatenate(
+        [np.zeros((len(routes), 1)), np.cumsum(step_deg * np.sin(heading), 1)],
+        axis=1,
+    )
+    lon = start_lon[:, None] + np.concatenate(
+        [
+            np.zeros((len(routes), 1)),
+            np.cumsum(
+                step_deg * np.cos(heading) / np.cos(np.radians(lat[:, 1:])),
+                axis=1,
+            ),
+        ],
+        axis=1,
+    )
+    return gpd.GeoDataFrame(
+        {"route": routes},
+        geometry=[
+            MultiLineString([np.column_stack([x, y])])
+            for x, y in zip(lon, lat)
+        ],
+        crs="EPSG:4326",
+    )
+
+
+def ridership_frame(
+    routes: List[str],
+    rng,
+    start_date: str = "2018-01-01",
+    end_date: str = "2023-09-30",
+    daily: bool = False,
+) -> pd.DataFrame:
+    """Ridership in the layout of the scraper CSV, one row per route period
+
+    Each route has a base level by route group, a seasonal cycle, a 2020 drop
+    with a partial recovery, and noise. Some routes start service late; their
+    earlier periods have zero ridership, which the ETL drops.
+    """
+    groups = classify_route_group(pd.Series(routes))
+    n_routes = len(routes)
+    dates = pd.date_range(start_date, end_date, freq="D" if daily else "MS")
+    if daily:
+        date_end = dates
+        num_days = np.ones(len(dates), dtype=np.int16)
+        business_days = (dates.dayofweek < 5).astype(np.int16)
+        lag = 364
+    else:
+        date_end = dates + pd.offsets.MonthEnd(0)
+        num_days = dates.days_in_month.to_numpy().astype(np.int16)
+        business_days = np.busday_count(
+            dates.values.astype("datetime64[D]"),
+            (date_end + pd.Timedelta(days=1)).values.astype("datetime64[D]"),
+        ).astype(np.int16)
+        lag = 12
+    # Weekend days carry about half the riders of a weekday
+    service_days = business_days + 0.52 * (num_days - business_days)
+
+    base = np.exp(
+        rng.normal(
+            np.select(
+                [groups == "CityLink", groups == "Commuter"],
+                [np.log(4000), np.log(120)],
+                np.log(1200),
+            ),
+            0.5,
+        )
+    )
+    season = 1 + 0.06 * np.cos(2 * np.pi * (dates.month.to_numpy() - 5) / 12)
+    years_since = np.clip(
+        (dates - pd.Timestamp("2020-04-01")).days.to_numpy() / 365.25, 0, 3
+    )
+    floor = rng.uniform(0.3, 0.6, n_routes)
+    target = np.where(
+        groups == "Commuter",
+        rng.uniform(0.3, 0.7, n_routes),
+        rng.uniform(0.6, 1.0, n_routes),
+    )
+    pandemic = floor[:, None] + (target - floor)[:, None] * years_since / 3
+    pandemic[:, dates < pd.Timestamp("2020-03-01")] = 1
+    noise = np.exp(
+        rng.normal(0, 0.1 if daily else 0.04, (n_routes, len(dates)))
+    )
+    ridership = np.round(
+        base[:, None] * season * pandemic * noise * service_days
+    ).astype(np.float32)
+    late_start = rng.random(n_routes) < 0.1
+    first_period = np.where(
+        late_start, rng.integers(0, len(dates), n_routes), 0
+    )
+    ridership[np.arange(len(dates)) < first_period[:, None]] = 0
+
+    per_day = ridership / num_days
+    changes = {}
+    for i in range(1, 4):
+        previous = np.full_like(per_day, np.nan)
+        previous[:, lag * i :] = per_day[:, : -lag * i or None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = per_day / np.where(previous > 0, previous, np.nan) - 1
+        changes[f"change_vs_{i}_years_ago"] = change.ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weekday = ridership / np.where(
+            business_days > 0, business_days, np.nan
+        )
+
+    return pd.DataFrame(
+        {
+            "route": pd.Categorical.from_codes(
+                np.repeat(np.arange(n_routes), len(dates)), categories=routes
+            ),
+            "date": np.tile(dates.values, n_routes),
+            "date_end": np.tile(date_end.values, n_routes),
+            "ridership": ridership.ravel(),
+            "business_days": np.tile(business_days, n_routes),
+            "ridership_weekday": weekday.ravel(),
+            "num_days_in_month": np.tile(num_days, n_routes),
+            "ridership_per_day": per_day.ravel(),
+            **changes,
+        }
+    )
+
+
+def _routes_served_label(routes: pd.Series) -> str:
+    # Commuter-only stops list their routes with semicolons in the real data
+    separator = (
+        "; "
+        if routes.str.isnumeric().all() and (routes.astype(int) >= 100).all()
+        else ", "
+    )
+    return separator.join(routes)
+
+
+def stops_frame(
+    lines: gpd.GeoDataFrame,
+    n_stops: int,
+    rng,
+    max_routes_served: int = 8,
+) -> gpd.GeoDataFrame:
+    """Bus stops along the route lines, in the schema of the stops data
+
+    Each stop is placed near a vertex of one route, and is served by every
+    route that passes through the same 200 m grid cell. CityLink routes are
+    listed by their two-letter codes, as in the real data.
+    """
+    coords = [np.asarray(g.geoms[0].coords) for g in lines.geometry]
+    n_vertices = np.array([len(c) for c in coords])
+    vertices = np.concatenate(coords)
+    vertex_route = np.repeat(np.arange(len(lines)), n_vertices)
+    cell_size = 200 / METERS_PER_DEGREE
+    cell = np.floor(vertices[:, 0] / cell_size).astype(np.int64) * (
+        1 << 32
+    ) + np.floor(vertices[:, 1] / cell_size).astype(np.int64)
+
+    source = rng.integers(0, len(vertices), n_stops)
+    jitter = rng.normal(0, 10 / METERS_PER_DEGREE, (n_stops, 2))
+    lon = vertices[source, 0] + jitter[:, 0]
+    lat = vertices[source, 1] + jitter[:, 1]
+
+    labels = lines["route"].map(lambda r: CITYLINK_CODES.get(r, r))
+    pairs = pd.DataFrame(
+        {"cell": cell, "route": vertex_route}
+    ).drop_duplicates()
+    served = (
+        pd.DataFrame({"stop": np.arange(n_stops), "cell": cell[source]})
+        .merge(pairs, on="cell")
+        .sort_values(["stop", "route"])
+        .groupby("stop")
+        .head(max_routes_served)
+    )
+    routes_served = labels.to_numpy()[served["route"].to_numpy()].astype(
+        object
+    )
+    routes_served = (
+        pd.Series(routes_served, index=served["stop"].to_numpy())
+        .groupby(level=0)
+        .agg(_routes_served_label)
+        .reindex(np.arange(n_stops))
+    )
+    n_served = routes_served.str.count("[,;]").to_numpy() + 1
+
+    rider_on = np.round(rng.lognormal(np.log(12 * n_served**0.8), 1.1))
+    rider_off = np.round(rng.lognormal(np.log(12 * n_served**0.8), 1.1))
+    # About one stop in ten has no ridership counts
+    missing = rng.random(n_stops) < 0.1
+    rider_on[missing] = np.nan
+    rider_off[missing] = np.nan
+    rider_total = rider_on + rider_off
+    shelter = rng.random(n_stops) < np.clip(
+        0.05 + np.nan_to_num(rider_total) / 600, 0, 0.9
+    )
+
+    county_lon = COUNTIES["lon"].to_numpy()
+    county_lat = COUNTIES["lat"].to_numpy()
+    county = np.argmin(
+        (lon[:, None] - county_lon) ** 2 + (lat[:, None] - county_lat) ** 2,
+        axis=1,
+    )
+    streets = rng.choice(len(STREETS), (n_stops, 2))
+    names = [f"{STREETS[a]} & {STREETS[b]}" for a, b in streets]
+    direction = rng.choice(["", " nb", " sb", " eb", " wb"], n_stops)
+    upper = rng.random(n_stops) < 0.4
+    stop_name = [
+        (name.upper() if up else name) + d
+        for name, up, d in zip(names, upper, direction)
+    ]
+    stop_id = np.cumsum(1 + rng.poisson(0.8, n_stops))
+
+    stops = gpd.GeoDataFrame(
+        {
+            "objectid": 59106 + np.arange(n_stops),
+            "stop_name": stop_name,
+            "rider_on": rider_on,
+            "rider_off": rider_off,
+            "rider_total": rider_total,
+            "stop_ridership_rank": pd.Series(rider_total).rank(
+                ascending=False, method="first"
+            ),
+            "routes_served": routes_served.to_numpy(),
+            "distribution_policy": "E1 - Public Domain - Internal Use Only",
+            "mode": "Bus",
+            "shelter": np.where(shelter, "Yes", "No"),
+            "county": COUNTIES["county"].to_numpy()[county],
+            "stop_id": stop_id.astype(str),
+        },
+        geometry=gpd.points_from_xy(lon, lat),
+        crs="EPSG:4326",
+    )
+    stops["latitude"] = lat
+    stops["longitude"] = lon
+    stops["ridership_period"] = "Summer 2023"
+    stops["download_date"] = "2024-01-10 03:20:37"
+    return stops
+
+
+def stop_snapshots(
+    stops: pd.DataFrame, n_snapshots: int, rng
+) -> List[pd.DataFrame]:
+    """Per-stop counts for the stops' ridership_period and the seasons before
+
+    Each earlier season scales every stop's counts by its own noise, so the
+    snapshots differ stop by stop. Returns the snapshots newest first.
+    """
+    season, year = stops["ridership_period"].iloc[0].split()
+    seasons = ["Winter", "Spring", "Summer", "Fall"]
+    index = int(year) * 4 + seasons.index(season)
+    snapshots = [stops]
+    for back in range(1, n_snapshots):
+        scale = rng.lognormal(0, 0.25, len(stops))
+        rider_on = np.round(stops["rider_on"].to_numpy() * scale)
+        rider_off = np.round(stops["rider_off"].to_numpy() * scale)
+        rider_total = rider_on + rider_off
+        period = index - back
+        snapshots.append(
+            stops.assign(
+                rider_on=rider_on,
+                rider_off=rider_off,
+                rider_total=rider_total,
+                stop_ridership_rank=pd.Series(rider_total)
+                .rank(ascending=False, method="first")
+                .to_numpy(),
+                ridership_period=f"{seasons[period % 4]} {period // 4}",
+            )
+        )
+    return snapshots
+
+
+def generate(
+    route_scale: int = 1,
+    n_stops: int = 4536,
+    daily: bool = False,
+    statewide: bool = False,
+    start_date: str = "2018-01-01",
+    end_date: str = "2023-09-30",
+    seed: int = 0,
+    routes: Optional[List[str]] = None,
+):
+    """Generate ridership, route lines and stops from one seed
+
+    Args:
+        route_scale (int, optional): Multiple of the real number of LocalLink and Commuter routes. Defaults to 1.
+        n_stops (int, optional): Number of bus stops. Defaults to the real count.
+        daily (bool, optional): One ridership row per route and day instead of per month. Defaults to False.
+        statewide (bool, optional): Spread routes across Maryland instead of around Baltimore. Defaults to False.
+        seed (int, optional): Random seed; the same arguments always give the same data. Defaults to 0.
+        routes (list, optional): Use these route names instead of generated ones.
+
+    Returns:
+        tuple: The raw ridership frame, route lines and stops
+    """
+    rng = np.random.default_rng(seed)
+    if routes is None:
+        routes = route_names(
+            BASE_LOCAL_ROUTES * route_scale,
+            BASE_COMMUTER_ROUTES * route_scale
+            + max(BASE_LOCAL_ROUTES * route_scale - 99, 0),
+            rng,
+        )
+    rides = ridership_frame(routes, rng, start_date, end_date, daily)
+    lines = route_lines(routes, rng, statewide)
+    stops = stops_frame(lines, n_stops, rng)
+    return rides, lines, stops
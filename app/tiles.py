@@ -0,0 +1,193 @@
+import base64
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import streamlit as st
+from PIL import Image, ImageDraw
+
+from app.constants import TILE_BASE_URL, TILE_DIR
+
+TILE_SIZE = 256
+
+Tile = Tuple[int, int, int, bytes]
+
+
+def world_pixels(
+    lon: np.ndarray, lat: np.ndarray, zoom: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Project longitude and latitude to Web Mercator pixels at a zoom level"""
+    scale = TILE_SIZE * 2**zoom
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = (np.asarray(lon) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return x, y
+
+
+def _to_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def render_point_tiles(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    zoom: int,
+    color: str = "#1f77b4",
+    radius: float = 2.5,
+) -> Iterator[Tile]:
+    """Render points as circles, yielding only the tiles that contain one
+
+    Points within `radius` pixels of a tile edge are drawn on both tiles so
+    circles are not cut off at tile boundaries.
+    """
+    x, y = world_pixels(lon, lat, zoom)
+    # Every tile touched by each point's circle
+    tx = np.floor(np.stack([x - radius, x + radius]) / TILE_SIZE)
+    ty = np.floor(np.stack([y - radius, y + radius]) / TILE_SIZE)
+    cols = np.concatenate([tx[0], tx[1], tx[0], tx[1]]).astype(np.int64)
+    rows = np.concatenate([ty[0], ty[0], ty[1], ty[1]]).astype(np.int64)
+    points = np.tile(np.arange(len(x)), 4)
+    pairs = np.unique(np.stack([cols, rows, points], axis=1), axis=0)
+
+    tiles, starts = np.unique(pairs[:, :2], axis=0, return_index=True)
+    for (col, row), members in zip(tiles, np.split(pairs[:, 2], starts[1:])):
+        image = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        px = x[members] - col * TILE_SIZE
+        py = y[members] - row * TILE_SIZE
+        for cx, cy in zip(px, py):
+            draw.ellipse(
+                [cx - radius, cy - radius, cx + radius, cy + radius],
+                fill=color,
+            )
+        yield zoom, int(col), int(row), _to_png(image)
+
+
+def _line_tiles(x: np.ndarray, y: np.ndarray, pad: float) -> set:
+    """Tiles crossed by the segments of a line, padded by `pad` pixels"""
+    x0 = np.floor((np.minimum(x[:-1], x[1:]) - pad) / TILE_SIZE).astype(int)
+    x1 = np.floor((np.maximum(x[:-1], x[1:]) + pad) / TILE_SIZE).astype(int)
+    y0 = np.floor((np.minimum(y[:-1], y[1:]) - pad) / TILE_SIZE).astype(int)
+    y1 = np.floor((np.maximum(y[:-1], y[1:]) + pad) / TILE_SIZE).astype(int)
+    single = (x0 == x1) & (y0 == y1)
+    tiles = set(zip(x0[single].tolist(), y0[single].tolist()))
+    for i in np.flatnonzero(~single):
+        tiles.update(
+            (col, row)
+            for col in range(x0[i], x1[i] + 1)
+            for row in range(y0[i], y1[i] + 1)
+        )
+    return tiles
+
+
+def render_line_tiles(
+    lines: Iterable[Tuple[np.ndarray, str]], zoom: int, width: int = 2
+) -> Iterator[Tile]:
+    """Render (coordinates, color) lines, yielding only non-empty tiles
+
+    Coordinates are (n, 2) arrays of longitude and latitude. Lines are drawn
+    in the order given, so later lines are on top.
+    """
+    by_tile: Dict[Tuple[int, int], List[Tuple[np.ndarray, str]]] = {}
+    for coords, color in lines:
+        if len(coords) < 2:
+            continue
+        x, y = world_pixels(coords[:, 0], coords[:, 1], zoom)
+        pixels = np.column_stack([x, y])
+        for tile in _line_tiles(x, y, width):
+            by_tile.setdefault(tile, []).append((pixels, color))
+
+    for (col, row), tile_lines in sorted(by_tile.items()):
+        image = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        offset = np.array([col * TILE_SIZE, row * TILE_SIZE])
+        for pixels, color in tile_lines:
+            draw.line(
+                (pixels - offset).ravel().tolist(),
+                fill=color,
+                width=width,
+                joint="curve",
+            )
+        yield zoom, col, row, _to_png(image)
+
+
+def write_tile_dir(
+    tile_dir: Union[str, Path],
+    tiles: Iterable[Tile],
+    metadata: Dict[str, str],
+) -> int:
+    """Write PNG tiles to a {z}/{x}/{y}.png directory, replacing it
+
+    Only the tiles given are written; the maps show nothing where a tile is
+    missing. The metadata is written to metadata.json. The tiles are
+    written next to the directory and moved into place when complete.
+
+    Returns:
+        int: Number of tiles written
+    """
+    tile_dir = Path(tile_dir)
+    tmp_dir = tile_dir.with_name(f"{tile_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    count = 0
+    for zoom, col, row, data in tiles:
+        path = tmp_dir / str(zoom) / str(col) / f"{row}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        count += 1
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    (tmp_dir / "metadata.json").write_text(json.dumps(metadata, indent=2))
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.replace(tmp_dir, tile_dir)
+    return count
+
+
+def read_tile_metadata(tileset: str) -> Dict[str, str]:
+    with open(TILE_DIR / tileset / "metadata.json") as f:
+        return json.load(f)
+
+
+# Shown by Leaflet where a tile is missing, instead of a broken image
+EMPTY_TILE_URL = (
+    "data:image/png;base64,"
+    + base64.b64encode(
+        _to_png(Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)))
+    ).decode()
+)
+
+
+def tile_base_url() -> str:
+    """Return the URL the browser fetches the tilesets from
+
+    TRANSITSCOPE_TILE_BASE_URL if set, otherwise the path Streamlit serves
+    static/tiles/ on, under the app's base URL path. The path has no
+    host, so it resolves against whatever origin the app is viewed on,
+    behind a proxy or over HTTPS, and in the map components' frames.
+    """
+    if TILE_BASE_URL:
+        return TILE_BASE_URL.rstrip("/")
+    base = st.get_option("server.baseUrlPath").strip("/")
+    return "/" + "/".join(filter(None, [base, "app/static/tiles"]))
+
+
+def tile_layer_url(tileset: str) -> Optional[str]:
+    """Return the {z}/{x}/{y} URL template of a tileset, or None if not built"""
+    if not (TILE_DIR / tileset / "metadata.json").exists():
+        return None
+    return f"{tile_base_url()}/{tileset}/{{z}}/{{x}}/{{y}}.png"
+
+
+def tile_zoom_range(tileset: str) -> Tuple[int, int]:
+    """Return the (minzoom, maxzoom) stored in a tileset's metadata"""
+    metadata = read_tile_metadata(tileset)
+    return int(metadata["minzoom"]), int(metadata["maxzoom"])
+
+
+def ground_resolution(lat: float, zoom: float) -> float:
+    """Meters per pixel of a Web Mercator map at a latitude and zoom level"""
+    return 40_075_016.686 * np.cos(np.radians(lat)) / (TILE_SIZE * 2**zoom)
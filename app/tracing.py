@@ -0,0 +1,274 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from app.constants import DEBUG_PANEL, METRICS_PATH, SPAN_LOG_PATH
+
+_RUN_KEY = "_tracing_run"
+
+
+class Span:
+    """One timed stage of a script run
+
+    `cache` is "hit" or "miss" for cached loaders and None otherwise.
+    """
+
+    __slots__ = ("name", "depth", "seconds", "rows", "cache")
+
+    def __init__(self, name: str, depth: int = 0, rows: Optional[int] = None):
+        self.name = name
+        self.depth = depth
+        self.seconds = 0.0
+        self.rows = rows
+        self.cache = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Run:
+    """The spans recorded during one script run of a page, in start order"""
+
+    def __init__(self, page: str):
+        self.page = page
+        self.started = datetime.now()
+        self.spans: List[Span] = []
+        self.depth = 0
+
+
+class Metrics:
+    """Running totals per page stage and per cached loader, for Prometheus"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (page, stage) -> [count, seconds, rows]
+        self.stages: Dict[Tuple[str, str], List[float]] = {}
+        # (loader, "hit" or "miss") -> count
+        self.cache: Dict[Tuple[str, str], int] = {}
+
+    def record(self, run: Run):
+        with self.lock:
+            for span in run.spans:
+                totals = self.stages.setdefault(
+                    (run.page, span.name), [0, 0.0, 0]
+                )
+                totals[0] += 1
+                totals[1] += span.seconds
+                totals[2] += span.rows or 0
+                if span.cache:
+                    key = (span.name, span.cache)
+                    self.cache[key] = self.cache.get(key, 0) + 1
+
+    def to_prometheus(self) -> str:
+        """Render the totals in the Prometheus text exposition format"""
+        with self.lock:
+            stages = sorted(self.stages.items())
+            cache = sorted(self.cache.items())
+        lines = []
+        for index, (name, help_text) in enumerate(
+            [
+                ("transitscope_stage_runs_total", "Times each stage ran"),
+                ("transitscope_stage_seconds_total", "Wall time per stage"),
+                ("transitscope_stage_rows_total", "Rows processed per stage"),
+            ]
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [
+                f"{name}{_labels(page=page, stage=stage)} {totals[index]:g}"
+                for (page, stage), totals in stages
+            ]
+        name = "transitscope_cache_requests_total"
+        lines += [
+            f"# HELP {name} Cached loader calls by result",
+            f"# TYPE {name} counter",
+        ]
+        lines += [
+            f"{name}{_labels(loader=loader, result=result)} {count}"
+            for (loader, result), count in cache
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(**labels) -> str:
+    escaped = (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+metrics = Metrics()
+_file_lock = threading.Lock()
+# Outside `streamlit run` there is no session state to hold the run
+_bare_run: Optional[Run] = None
+
+
+def start_run(page: str) -> Run:
+    """Start recording the spans of this script run of a page"""
+    global _bare_run
+    run = Run(page)
+    if get_script_run_ctx() is None:
+        _bare_run = run
+    else:
+        st.session_state[_RUN_KEY] = run
+    return run
+
+
+def current_run() -> Optional[Run]:
+    """The run started by this session's page, if any"""
+    if get_script_run_ctx() is None:
+        return _bare_run
+    return st.session_state.get(_RUN_KEY)
+
+
+@contextmanager
+def span(name: str, rows: Optional[int] = None):
+    """Time a stage of the current run
+
+    Yields the Span, so `rows` can be set once the stage knows it. Without a
+    started run the stage is timed but not recorded.
+    """
+    run = current_run()
+    record = Span(name, run.depth if run else 0, rows)
+    if run:
+        run.spans.append(record)
+        run.depth += 1
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        if run:
+            run.depth -= 1
+
+
+def count_rows(value) -> Optional[int]:
+    """Rows in a loader result: its length if it has one"""
+    if isinstance(value, (str, bytes)) or not hasattr(value, "__len__"):
+        return None
+    return len(value)
+
+
+def _traced(cache, func, rows, cache_kwargs):
+    if func is None:
+        return lambda func: _traced(cache, func, rows, cache_kwargs)
+    # One flag per call in progress, so nested loaders don't mix them up
+    calls = threading.local()
+
+    @functools.wraps(func)
+    def compute(*args, **kwargs):
+        # Only runs when the value is not cached
+        calls.stack[-1] = True
+        return func(*args, **kwargs)
+
+    cached = cache(compute, **cache_kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not hasattr(calls, "stack"):
+            calls.stack = []
+        with span(func.__name__) as record:
+            calls.stack.append(False)
+            try:
+                value = cached(*args, **kwargs)
+            finally:
+                missed = calls.stack.pop()
+            record.cache = "miss" if missed else "hit"
+            record.rows = rows(value)
+        return value
+
+    wrapper.clear = cached.clear
+    return wrapper
+
+
+def cache_data(
+    func: Optional[Callable] = None,
+    *,
+    rows: Callable[[Any], Optional[int]] = count_rows,
+    **cache_kwargs,
+):
+    """`st.cache_data` that records a span with rows and cache hit or miss
+
+    `rows` counts the rows in a result. Other arguments go to st.cache_data,
+    and `__wrapped__` is still the uncached function.
+    """
+    return _traced(st.cache_data, func, rows, cache_kwargs)
+
+
+def cache_resource(
+    func: Optional[Callable] = None,
+    *,
+    rows: Callable[[Any], Optional[int]] = count_rows,
+    **cache_kwargs,
+):
+    """`st.cache_resource` that records a span, like `cache_data`"""
+    return _traced(st.cache_resource, func, rows, cache_kwargs)
+
+
+def _write_outputs(run: Run):
+    session = getattr(get_script_run_ctx(), "session_id", None)
+    with _file_lock:
+        if SPAN_LOG_PATH:
+            with open(SPAN_LOG_PATH, "a") as f:
+                for record in run.spans:
+                    f.write(
+                        json.dumps(
+                            {
+                                "time": run.started.isoformat(),
+                                "session": session,
+                                "page": run.page,
+                                **record.to_dict(),
+                            }
+                        )
+                        + "\n"
+                    )
+        if METRICS_PATH:
+            # Replace the file in one step, so a scrape never reads half of it
+            tmp_path = f"{METRICS_PATH}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(metrics.to_prometheus())
+            os.replace(tmp_path, METRICS_PATH)
+
+
+def show_debug_panel(run: Run):
+    """Show the run's spans in a sidebar expander"""
+    table = pd.DataFrame(
+        {
+            "stage": ["· " * s.depth + s.name for s in run.spans],
+            "ms": [round(s.seconds * 1000, 1) for s in run.spans],
+            "rows": [s.rows for s in run.spans],
+            "cache": [s.cache for s in run.spans],
+        }
+    )
+    total = sum(s.seconds for s in run.spans if s.depth == 0)
+    with st.sidebar.expander(f"Stage timings: {total * 1000:.0f} ms"):
+        st.dataframe(table, hide_index=True, use_container_width=True)
+
+
+def finish_run():
+    """End the current run: update the totals, write the log and metrics
+    files that are configured, and show the debug panel if enabled"""
+    global _bare_run
+    run = current_run()
+    if run is None:
+        return
+    if get_script_run_ctx() is None:
+        _bare_run = None
+    else:
+        del st.session_state[_RUN_KEY]
+    metrics.record(run)
+    _write_outputs(run)
+    if DEBUG_PANEL:
+        show_debug_panel(run)
@@ -1,19 +1,161 @@
+import functools
+import threading
+import weakref
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Union
+from typing import (TYPE_CHECKING, Callable, Dict, Hashable, List, Optional,
+                    Tuple, Union)
 
-import geopandas as gpd
-import leafmap.foliumap as leafmap
 import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import streamlit as st
+import streamlit.components.v1 as components
 
-from app.constants import CITYLINK_COLORS
+from app.baseline import baseline_label
+from app.constants import (CHART_SERIES_POINTS, CITYLINK_COLORS,
+                           FIGURE_CACHE_BYTES, FIGURE_CACHE_ENTRIES,
+                           MAP_RENDER_CACHE_BYTES, MAP_RENDER_CACHE_ENTRIES,
+                           WEBGL_POINT_THRESHOLD)
+from app.downsample import lttb
+from app.render_cache import RenderCache
+from app.tiles import EMPTY_TILE_URL, tile_zoom_range
+from app.tracing import span
+
+# geopandas, leafmap and plotly take seconds to import, so the functions that
+# use them import them. Pages that draw no chart or map never load them, and
+# a map served from the render cache never loads leafmap
+if TYPE_CHECKING:
+    import folium
+    import geopandas as gpd
+    import leafmap.foliumap as leafmap
+    import plotly.graph_objects as go
+
+    from app.cube import RidershipCube
+
+
+def use_webgl(n_points: int, render_mode: str = "auto") -> bool:
+    """Whether a line chart of n_points points is drawn with WebGL
+
+    render_mode is 'svg', 'webgl' or 'auto', which picks WebGL above
+    WEBGL_POINT_THRESHOLD points.
+    """
+    if render_mode == "auto":
+        return n_points > WEBGL_POINT_THRESHOLD
+    return render_mode == "webgl"
+
+
+# Layout of every route line chart: a wide legend over the plot, angled
+# date ticks and no y gridlines. LINE_CHART_STYLES adds each kind's colors,
+# axis titles and number formats
+LINE_CHART_LAYOUT = dict(
+    height=600,
+    legend=dict(
+        orientation="h",
+        yanchor="bottom",
+        y=0.97,
+        xanchor="right",
+        x=1,
+        # Don't show the legend title
+        title_text="",
+    ),
+    margin=dict(l=50, r=50, t=100, b=50),
+    xaxis=dict(showspikes=True, title_text="", tickangle=45, type="date"),
+    yaxis=dict(showgrid=False),
+)
+
+LINE_CHART_STYLES = {
+    "ridership": dict(
+        layout=dict(plot_bgcolor="white"),
+        hovertemplate="%{y:,.0f}",
+    ),
+    "recovery": dict(
+        layout=dict(
+            plot_bgcolor="#F5F5F5",
+            xaxis=dict(tickformat="%b %Y"),
+            yaxis=dict(tickformat=",.0%"),
+        ),
+        hovertemplate="%{y:.0%}",
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def line_chart_layout(kind: str, webgl: bool) -> "go.Layout":
+    """The styled layout of a kind of route line chart, built once
+
+    The range slider draws every trace again and can't draw WebGL traces,
+    and a unified hover label lists every trace, so large WebGL charts have
+    neither. Figures copy the layout, so it is never modified.
+    """
+    import plotly.graph_objects as go
+
+    layout = go.Layout(LINE_CHART_LAYOUT)
+    layout.update(LINE_CHART_STYLES[kind]["layout"])
+    layout.update(
+        xaxis_rangeslider_visible=not webgl,
+        hovermode="closest" if webgl else "x unified",
+    )
+    return layout
+
+
+def route_line_figure(
+    series: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    kind: str = "ridership",
+    title: str = "",
+    yaxis_title: str = "",
+    y_axis_zero: bool = False,
+    render_mode: str = "auto",
+    max_points: int = CHART_SERIES_POINTS,
+):
+    """Build a line chart with a trace per route from its (x, y) arrays
+
+    Traces are made directly from the arrays on the `line_chart_layout` of
+    the kind, in the order of `series`. Missing values are dropped. On a
+    WebGL chart (see `use_webgl`) each series is downsampled to max_points
+    with LTTB, which keeps its peaks and troughs.
+    """
+    import plotly.graph_objects as go
+
+    series = {
+        route: (x[~np.isnan(y)], y[~np.isnan(y)])
+        for route, (x, y) in series.items()
+    }
+    webgl = use_webgl(sum(len(y) for _, y in series.values()), render_mode)
+    scatter = go.Scattergl if webgl else go.Scatter
+    traces = []
+    for route, (x, y) in series.items():
+        if webgl:
+            kept = lttb(x, y, max_points)
+            x, y = x[kept], y[kept]
+        if np.issubdtype(x.dtype, np.datetime64):
+            # The ridership dates are days, and plotly reads ISO dates
+            x = np.datetime_as_string(x, unit="D")
+        traces.append(
+            scatter(
+                x=x,
+                y=y,
+                name=route,
+                mode="lines",
+                line_color=CITYLINK_COLORS.get(route),
+                hovertemplate=LINE_CHART_STYLES[kind]["hovertemplate"],
+            )
+        )
+    fig = go.Figure(traces, line_chart_layout(kind, webgl))
+    fig.layout.title.text = title
+    fig.layout.yaxis.title.text = yaxis_title
+    values = [y for _, y in series.values() if len(y)]
+    if y_axis_zero and values:
+        # Start the y-axis at 0, with 10% above the highest value
+        fig.layout.yaxis.range = [0, max(y.max() for y in values) * 1.1]
+    return fig
 
 
 def plot_ridership_average(
-    rides, route_numbers, start_date, end_date, y_axis_zero=True
+    rides,
+    route_numbers,
+    start_date,
+    end_date,
+    y_axis_zero=True,
+    render_mode="auto",
 ):
     """
     Plot the average ridership for the selected routes over time
@@ -28,88 +170,164 @@ def plot_ridership_average(
         The start date to plot
     end_date : datetime
         The end date to plot
+    render_mode : str
+        'svg', 'webgl' or 'auto'. See `use_webgl`
 
     Returns
     -------
     fig : plotly.graph_objects.Figure
         The plotly figure
     """
-    date_col = "date"
-    title = f"Ridership by Route over Time"
-
     # Convert start_date and end_date to datetime64[ns]
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
 
-    # Get the data for the route
-    route = rides[rides["route"].isin(route_numbers)]
-
-    # Filter the data by the start and end dates
-    route = route[
-        (route[date_col] >= start_date) & (route[date_col] <= end_date)
+    # Get the data for the routes between the start and end dates
+    route = rides[
+        rides["route"].isin(route_numbers)
+        & rides["date"].between(start_date, end_date)
     ]
+    route = route.sort_values("date")
+    dates = route["date"].to_numpy()
+    ridership = route["ridership"].to_numpy(dtype=float)
+    groups = route.groupby(
+        route["route"].astype(str), sort=False, observed=True
+    ).indices
+    return route_line_figure(
+        {
+            name: (dates[positions], ridership[positions])
+            for name, positions in groups.items()
+        },
+        title="Ridership by Route over Time",
+        yaxis_title="Ridership",
+        y_axis_zero=y_axis_zero,
+        render_mode=render_mode,
+    )
 
-    # Plot the ridership over time
-    fig = px.line(route, x=date_col, y="ridership", color="route")
 
-    fig.update_layout(title=title)
+# Figures built from each cube, shared by every session. Entries go with the
+# cube when it is reloaded
+_cube_figures: "weakref.WeakKeyDictionary[RidershipCube, RenderCache]" = (
+    weakref.WeakKeyDictionary()
+)
+_cube_figures_lock = threading.Lock()
+
+
+def _figure_size(fig) -> int:
+    # Roughly 16 bytes per point, which is what dates and values take
+    return 4096 + 16 * sum(len(trace.x) for trace in fig.data)
 
-    # Add spikelines to the x and y axes
-    fig.update_xaxes(showspikes=True)
-    # fig.update_yaxes(showspikes=True)
-    # Make background white
-    fig.update_layout(plot_bgcolor="white")
-    # Show the y-value for all traces when hovering over the chart
-    fig.update_traces(hoverinfo="all")
-
-    # Add labels to the x and y axes
-    fig.update_xaxes(title_text="")
-    fig.update_yaxes(title_text=f"Ridership")
-
-    # Angle the x-axis labels
-    fig.update_xaxes(tickangle=45)
-
-    if y_axis_zero:
-        # Start the y-axis at 0
-        y_max = route["ridership"].max()
-        # Let's add 10% to the max y-value
-        y_max = y_max + y_max * 0.1
-        fig.update_yaxes(range=[0, y_max])
-    # Add an option to only show a certain date range
-    fig.update_layout(xaxis=dict(rangeslider=dict(visible=True), type="date"))
-    # iterate through the traces and apply the CITYLINK_COLORS to the plot
-    for i, trace in enumerate(fig.data):
-        if trace.name in CITYLINK_COLORS:
-            trace.marker.color = CITYLINK_COLORS[trace.name]
-            trace.line.color = CITYLINK_COLORS[trace.name]
-    # Remove major gridlines
-    fig.update_yaxes(showgrid=False)
-    # Increase the height of the plot to accommodate the legend
-    fig.update_layout(height=600)
-    fig.update_layout(
-        title=title,
-        legend=dict(
-            orientation="h",
-            yanchor="bottom",
-            y=0.97,
-            xanchor="right",
-            x=1,
-            # Don't show the legend title
-            title_text="",
-        ),
-        margin=dict(l=50, r=50, t=100, b=50),
-    )
-    fig.update_layout(hovermode="x unified")
 
+def cube_line_figure(
+    cube: "RidershipCube",
+    route_numbers: List[str],
+    metric: str = "ridership",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    baseline_years: Tuple[int, ...] = (2019,),
+    title: Optional[str] = None,
+    y_axis_zero: bool = False,
+    render_mode: str = "auto",
+    cache: bool = True,
+):
+    """A line chart per route of one of the cube's metrics, memoized
+
+    The series are rows of the cube, so nothing is filtered or grouped.
+    Figures are kept by route set, frequency, metric and the other
+    arguments, within FIGURE_CACHE_BYTES, so an unchanged selection reuses
+    the figure. A cached figure is shared: copy it with `go.Figure(fig)`
+    before modifying it.
+
+    Args:
+        metric (str, optional): One of the cube's metrics, or 'recovery_over_baseline' for recovery over baseline_years. Defaults to 'ridership'.
+        title (str, optional): Chart and y-axis title. Defaults to one for the metric.
+        cache (bool, optional): Use the figure cache. Defaults to True.
+    """
+    kind = "recovery" if metric == "recovery_over_baseline" else "ridership"
+    key = (
+        tuple(route_numbers),
+        cube.freq,
+        metric,
+        baseline_years if kind == "recovery" else None,
+        start_date,
+        end_date,
+        title,
+        y_axis_zero,
+        render_mode,
+    )
+    with _cube_figures_lock:
+        figures = _cube_figures.get(cube)
+        if figures is None:
+            figures = _cube_figures[cube] = RenderCache(
+                FIGURE_CACHE_BYTES, FIGURE_CACHE_ENTRIES, sizeof=_figure_size
+            )
+    with span(f"{kind} figure") as record:
+        fig = figures.get(key) if cache else None
+        record.cache = "miss" if fig is None else "hit"
+        if fig is None:
+            fig = _build_cube_line_figure(
+                cube,
+                route_numbers,
+                metric,
+                start_date,
+                end_date,
+                baseline_years,
+                title,
+                y_axis_zero,
+                render_mode,
+            )
+            if cache:
+                figures.put(key, fig)
+        record.rows = sum(len(trace.x) for trace in fig.data)
     return fig
 
 
+def _build_cube_line_figure(
+    cube,
+    route_numbers,
+    metric,
+    start_date,
+    end_date,
+    baseline_years,
+    title,
+    y_axis_zero,
+    render_mode,
+):
+    routes = [r for r in route_numbers if r in cube.route_index]
+    periods = cube.period_slice(start_date, end_date)
+    if metric == "recovery_over_baseline":
+        values = cube.recovery(
+            baseline_years, cube.route_positions(routes), periods
+        )
+        baseline = baseline_label(baseline_years)
+        kind = "recovery"
+        yaxis_title = f"Ridership as a % of {baseline} benchmark"
+        title = (
+            title
+            or f"Ridership as a percentage of ridership for the same period in {baseline}"
+        )
+    else:
+        values = cube.select(metric, routes, start_date, end_date)
+        kind = "ridership"
+        title = yaxis_title = title or "Ridership by Route over Time"
+    dates = cube.periods[periods].to_numpy()
+    return route_line_figure(
+        {route: (dates, row) for route, row in zip(routes, values)},
+        kind=kind,
+        title=title,
+        yaxis_title=yaxis_title,
+        y_axis_zero=y_axis_zero,
+        render_mode=render_mode,
+    )
+
+
 def map_bus_routes(
-    gdf: gpd.GeoDataFrame,
+    gdf: "gpd.GeoDataFrame",
     route_numbers: List[str],
     highlight_routes: bool = False,
     width: int = 400,
     height: int = 400,
+    other_routes_tiles: Optional[str] = None,
 ):
     """
     > This function takes a GeoDataFrame of bus routes, a list of route numbers, and a boolean
@@ -126,8 +344,40 @@ def map_bus_routes(
     :type width: int (optional)
     :param height: int=400, width: int=400, defaults to 400
     :type height: int (optional)
+    :param other_routes_tiles: Tile URL template to draw the other routes from instead of `gdf`
+    :type other_routes_tiles: str (optional)
     """
 
+    key = (
+        "routes",
+        tuple(sorted(route_numbers)),
+        highlight_routes,
+        None,
+        (width, height),
+        other_routes_tiles,
+    )
+    if highlight_routes:
+        # The highlighted map has always used the component's default size
+        width, height = None, 600
+    return show_map(
+        key,
+        lambda: build_bus_routes_map(
+            gdf, route_numbers, highlight_routes, other_routes_tiles
+        ),
+        width=width,
+        height=height,
+    )
+
+
+def build_bus_routes_map(
+    gdf: "gpd.GeoDataFrame",
+    route_numbers: List[str],
+    highlight_routes: bool = False,
+    other_routes_tiles: Optional[str] = None,
+) -> "leafmap.Map":
+    """Build the leafmap.Map drawn by `map_bus_routes`"""
+    import leafmap.foliumap as leafmap
+
     # Get the data for the route
     route = gdf[gdf["route"].isin(route_numbers)]
 
@@ -139,26 +389,23 @@ def map_bus_routes(
     m.toolbar = False
     # Show the route highlighted in red, then plot all the other routes in gray
     if highlight_routes:
-        non_highlighted_routes = gdf[~gdf["route"].isin(route_numbers)]
-        # Add the bus routes to the map
-        m.add_gdf(
-            non_highlighted_routes,
-            layer_name="Other Bus Routes",
-            style={"color": "black", "weight": 1, "opacity": 1},
-        )
+        if other_routes_tiles:
+            # The browser only fetches the tiles on screen
+            add_tile_overlay(m, other_routes_tiles, "Other Bus Routes")
+        else:
+            non_highlighted_routes = gdf[~gdf["route"].isin(route_numbers)]
+            # Add the bus routes to the map
+            m.add_gdf(
+                non_highlighted_routes,
+                layer_name="Other Bus Routes",
+                style={"color": "black", "weight": 1, "opacity": 1},
+            )
         m.add_gdf(
             route,
             layer_name="Selected Bus Routes",
             style={"color": "red", "weight": 3, "opacity": 1},
         )
-
-        # Zoom to the bus routes
-        m.zoom_to_gdf(route)
-        # Display the map
-        return m.to_streamlit()
     else:
-        # Q: Whare do I find the list of basemaps?
-        # A:
         # Add the bus routes to the map
         m.add_gdf(
             route,
@@ -172,13 +419,64 @@ def map_bus_routes(
                 "opacity": 1,
             },
         )
-        # Zoom to the bus routes
-        m.zoom_to_gdf(route)
-        # Display the map
-        return m.to_streamlit(height=height, width=width)
+    # Zoom to the bus routes
+    m.zoom_to_gdf(route)
+    return m
+
+
+def add_tile_overlay(
+    m: "folium.Map", url: str, name: str, opacity: float = 1.0
+):
+    """Add a tileset built by build_tiles.py as an overlay layer
+
+    Past the deepest zoom in the tileset, Leaflet scales up those tiles.
+    """
+    import folium
+
+    # URLs from `tile_layer_url` end in /<tileset>/{z}/{x}/{y}.png
+    tileset = url.split("/")[-4]
+    min_zoom, max_zoom = tile_zoom_range(tileset)
+    folium.TileLayer(
+        url,
+        name=name,
+        attr="MDOT MTA",
+        overlay=True,
+        opacity=opacity,
+        max_zoom=100,
+        min_native_zoom=min_zoom,
+        max_native_zoom=max_zoom,
+        # Only tiles with something on them are built
+        error_tile_url=EMPTY_TILE_URL,
+    ).add_to(m)
+
+
+@st.cache_resource
+def get_map_render_cache() -> RenderCache:
+    """Rendered map HTML shared by every session"""
+    return RenderCache(MAP_RENDER_CACHE_BYTES, MAP_RENDER_CACHE_ENTRIES)
+
+
+def show_map(
+    key: Hashable,
+    build_map: Callable[[], "leafmap.Map"],
+    width: Optional[int] = None,
+    height: int = 600,
+):
+    """Display a map, building and serializing it only on a cache miss
+
+    The key must identify everything the map depends on, e.g. the sorted
+    routes, highlighting, stop marker and size. The cached HTML is what
+    `leafmap.Map.to_streamlit` would send, layer control included.
+    """
+    html = get_map_render_cache().get_or_render(
+        key, lambda: build_map().to_html()
+    )
+    return components.html(html, width=width, height=height)
 
 
 def plot_recovery_over_this_quarter(df, route_numbers):
+    import plotly.express as px
+
     df = df[df.route.isin(route_numbers)]
     # Drop dates before January 2021
     df = df[df.date >= "2021-01-01"]
@@ -198,24 +496,47 @@ def plot_recovery_over_this_quarter(df, route_numbers):
 
 
 def plot_bar_top_n_for_daterange(
-    df, top_n=5, col="ridership", daterange=("2020-05-01", "2023-01-01")
+    cube,
+    top_n=5,
+    col="ridership",
+    daterange=("2020-05-01", "2023-01-01"),
+    route_group=None,
+    baseline_years=(2019,),
 ):
-    """Plot a bar chart of the top N routes for a given date range"""
-    daterange = pd.date_range(start=daterange[0], end=daterange[1])
-    df = df[df.date.isin(daterange)]
-    df = (
-        df.groupby(["route"])
-        .sum()
-        .reset_index()
-        .sort_values(by=col, ascending=False)
+    """Plot a bar chart of the top N routes for a given date range
+
+    The totals come from the ridership cube's prefix sums, so any date range
+    costs the same. See `RidershipCube.top_routes`. Rates such as
+    ridership_per_day are averaged over the range rather than summed.
+    col 'recovery_over_baseline' ranks by recovery over baseline_years.
+    """
+    import plotly.express as px
+
+    start, end = (pd.Timestamp(date) for date in daterange)
+    routes = cube.top_routes(
+        col,
+        top_n,
+        start,
+        end,
+        route_group=route_group,
+        baseline_years=baseline_years,
+    )
+    totals = cube.range_totals(col, start, end, baseline_years=baseline_years)
+    df = pd.DataFrame(
+        {"route": routes, col: totals[cube.route_positions(routes)]}
     )
-    df = df.head(top_n)
+    labels = {}
+    if col == "recovery_over_baseline":
+        labels[col] = f"Recovery over {baseline_label(baseline_years)}"
     fig = px.bar(
-        df.sort_values(by=col, ascending=False),
+        df,
         x=col,
         y="route",
         orientation="h",
+        labels=labels,
     )
+    # Largest at the top, and route numbers are names, not a numeric axis
+    fig.update_yaxes(type="category", categoryorder="total ascending")
     fig.update_layout(title="Top routes for the selected date range")
     fig.update_layout(plot_bgcolor="white")
     fig.update_layout(
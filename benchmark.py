@@ -0,0 +1,432 @@
+import argparse
+import ast
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from app.baseline import add_ridership_per_day_2019
+from app.cube import RidershipCube
+from app.heatmap import bin_points
+from app.load_data import get_bus_stops, get_rides
+from app.spatial_index import StopSpatialIndex
+from app.sql import SHELTERS_BY_ROUTE_SQL, TOP_ROUTES_SQL, QueryEngine
+from app.stop_index import StopRouteIndex
+from app.synthetic import generate
+from app.viz import (build_bus_routes_map, cube_line_figure,
+                     plot_ridership_average)
+from clean_data import clean_ridership_data, transform_ridership
+
+# Columns added by prepare_monthly that are not in the scraper CSV
+DERIVED_COLS = ["quarter", "route_group"]
+
+# Cold import time allowed per page; --startup fails past it
+STARTUP_BUDGET_S = 2.0
+
+PAGES = [
+    "Home.py",
+    "pages/1_Bus_stops.py",
+    "pages/2_Download_data.py",
+    "pages/About.py",
+]
+
+
+def _uncached(func):
+    # Time the work, not a Streamlit cache lookup
+    return getattr(func, "__wrapped__", func)
+
+
+def scale_routes(rides, scale):
+    # Copy every route `scale` times under new names in the same route group
+    copies = []
+    for i in range(scale):
+        copy = rides.copy()
+        route = copy["route"].astype(str)
+        if i > 0:
+            numeric = route.str.isnumeric()
+            route = route.where(
+                ~numeric, (pd.to_numeric(route, errors="coerce") + 1000 * i)
+            )
+            route = route.astype(str).str.replace(r"\.0$", "", regex=True)
+            route = route.where(numeric, route + f" {i}")
+        copy["route"] = route
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def scale_stops(stops, scale, seed=0):
+    # Copy every stop `scale` times, jittered within about 2 km
+    rng = np.random.default_rng(seed)
+    copies = [stops]
+    for i in range(1, scale):
+        copy = stops.copy()
+        lon = copy.geometry.x + rng.normal(0, 0.02, len(copy))
+        lat = copy.geometry.y + rng.normal(0, 0.02, len(copy))
+        copy = copy.set_geometry(gpd.points_from_xy(lon, lat, crs=stops.crs))
+        copy["longitude"], copy["latitude"] = lon, lat
+        copy["stop_id"] = copy["stop_id"].astype(str) + f"-{i}"
+        copies.append(copy)
+    return gpd.GeoDataFrame(pd.concat(copies, ignore_index=True))
+
+
+def prepare_inputs(scale, work_dir, synthetic=False):
+    # Write the scaled raw CSV, ridership parquet and stops parquet, either
+    # copied from the real data or generated
+    csv_path = work_dir / f"ridership_{scale}.csv"
+    rides_path = work_dir / f"ridership_{scale}.parquet"
+    stops_path = work_dir / f"stops_{scale}.parquet"
+    if synthetic:
+        raw, _, stops = generate(route_scale=scale, n_stops=4536 * scale)
+        raw.to_csv(csv_path, index=False)
+        rides, _ = transform_ridership(raw)
+    else:
+        rides = scale_routes(
+            pd.read_parquet("data/mta_bus_ridership.parquet"), scale
+        )
+        rides.drop(columns=DERIVED_COLS).to_csv(csv_path, index=False)
+        stops = scale_stops(
+            gpd.read_parquet("data/mta_bus_stops.parquet"), scale
+        )
+    rides.to_parquet(rides_path, index=False)
+    stops.to_parquet(stops_path)
+    return csv_path, rides_path, stops_path
+
+
+def route_geometries():
+    # The route geometries are not in the repository, so the map benchmark
+    # only runs where they have been downloaded
+    from app.load_data import ROUTE_GEOJSON, ROUTE_GEOPARQUET
+
+    if not (ROUTE_GEOPARQUET.exists() or ROUTE_GEOJSON.exists()):
+        return None
+    from app.load_data import get_route_linestrings
+
+    return _uncached(get_route_linestrings)()
+
+
+def make_benchmarks(scale, work_dir, synthetic=False):
+    # Return {name: zero-argument callable} for one data scale
+    csv_path, rides_path, stops_path = prepare_inputs(
+        scale, work_dir, synthetic
+    )
+    rides = _uncached(get_rides)(rides_path)
+    stops = gpd.read_parquet(stops_path)
+    stops["shelter"] = stops["shelter"].eq("Yes")
+    top_routes = (
+        rides.groupby("route", observed=True)["ridership"]
+        .sum()
+        .nlargest(5)
+        .index.tolist()
+    )
+
+    def shelter_aggregation():
+        index = StopRouteIndex.from_stops(stops)
+        return (
+            index.route_totals(stops["shelter"].to_numpy()),
+            index.route_totals(),
+        )
+
+    cube = RidershipCube.from_frame(add_ridership_per_day_2019(rides))
+    cube.prefix_sums
+    rng = np.random.default_rng(0)
+    date_ranges = np.sort(
+        rng.integers(0, len(cube.periods), size=(100, 2)), axis=1
+    )
+
+    def cube_top_routes():
+        # A top-5 ranking per route group for each of 100 date ranges
+        for start, end in date_ranges:
+            for route_group in [None, "CityLink", "LocalLink", "Commuter"]:
+                cube.top_routes(
+                    "ridership",
+                    5,
+                    cube.periods[start],
+                    cube.periods[end],
+                    route_group=route_group,
+                )
+
+    def nearby_stops():
+        # Build the spatial index, then find the stops within 400 m of 100
+        # stops and the 5 nearest to each
+        index = StopSpatialIndex.from_stops(stops)
+        sample = stops.iloc[:: max(len(stops) // 100, 1)]
+        index.within(sample["latitude"], sample["longitude"], 400)
+        index.nearest(sample["latitude"], sample["longitude"], k=5)
+
+    engine = QueryEngine({"ridership": rides_path, "stops": stops_path})
+
+    def sql(query, **params):
+        # Uncached, so every run executes the query
+        return lambda: engine.query(query, params, cache=False)
+
+    def heatmap():
+        for metric in ["rider_total", "rider_on", "rider_off"]:
+            bin_points(
+                stops["latitude"], stops["longitude"], stops[metric], 250
+            )
+
+    benchmarks = {
+        "clean_ridership_data": lambda: clean_ridership_data(csv_path),
+        "add_ridership_per_day_2019": lambda: add_ridership_per_day_2019(
+            rides, freq="month"
+        ),
+        "get_rides": lambda: _uncached(get_rides)(rides_path),
+        "get_bus_stops": lambda: _uncached(get_bus_stops)(stops_path),
+        "plot_ridership_average": lambda: plot_ridership_average(
+            rides, top_routes, datetime(2018, 1, 1), datetime(2023, 12, 31)
+        ),
+        # Every route, which is drawn with WebGL and downsampled
+        "plot_ridership_average_all_routes": lambda: plot_ridership_average(
+            rides,
+            rides["route"].unique().tolist(),
+            datetime(2018, 1, 1),
+            datetime(2023, 12, 31),
+        ).to_json(),
+        "cube_line_figure": lambda: cube_line_figure(
+            cube,
+            top_routes,
+            start_date=datetime(2018, 1, 1),
+            end_date=datetime(2023, 12, 31),
+            y_axis_zero=True,
+            cache=False,
+        ),
+        "shelter_aggregation": shelter_aggregation,
+        "sql_shelters_by_route": sql(SHELTERS_BY_ROUTE_SQL),
+        "sql_top_routes": sql(
+            TOP_ROUTES_SQL.format(metric="ridership", view="ridership"),
+            start=datetime(2022, 1, 1),
+            end=datetime(2022, 12, 31),
+            n=5,
+        ),
+        "cube_top_routes": cube_top_routes,
+        "heatmap": heatmap,
+        "nearby_stops": nearby_stops,
+    }
+    routes = route_geometries()
+    if routes is not None:
+        selected = routes["route"].astype(str).head(5).tolist()
+        benchmarks["map_bus_routes"] = lambda: build_bus_routes_map(
+            routes, selected, highlight_routes=True
+        ).to_html()
+    return benchmarks
+
+
+def measure(func, repeat):
+    # Wall time over `repeat` runs after a warm-up run, then peak traced
+    # memory over one more run. Arrow buffers are allocated outside Python
+    # and are not traced
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_mb": peak / 1024**2,
+    }
+
+
+def run(scales, repeat, only=None, synthetic=False):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            benchmarks = make_benchmarks(scale, Path(tmp), synthetic)
+            for name, func in benchmarks.items():
+                if only and name not in only:
+                    continue
+                result = measure(func, repeat)
+                results.setdefault(name, {})[str(scale)] = result
+                print(
+                    f"{name:<28} x{scale:<4} "
+                    f"{result['median_s'] * 1000:10.1f} ms "
+                    f"{result['peak_mb']:8.1f} MB"
+                )
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "synthetic": synthetic,
+        },
+        "results": results,
+    }
+
+
+def page_imports(path):
+    # The top-level import statements of a page script, as source
+    tree = ast.parse(Path(path).read_text())
+    imports = [
+        node
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+    return ast.unparse(ast.Module(body=imports, type_ignores=[]))
+
+
+def _import_in_new_process(code, importtime=False):
+    # Run the imports in a fresh interpreter, so nothing is already loaded,
+    # and return the wall time and the -X importtime report
+    timed = (
+        "import time as _time\n_start = _time.perf_counter()\n"
+        f"{code}\nprint(_time.perf_counter() - _start)"
+    )
+    args = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    result = subprocess.run(
+        args + ["-c", timed],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).parent,
+    )
+    return float(result.stdout.split()[-1]), result.stderr
+
+
+def slowest_imports(report, n=5):
+    # The top-level packages with the largest cumulative import time
+    cumulative = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, us, name = line[len("import time:") :].split("|")
+        # Nested imports are indented under the package that imported them
+        if not name[1:].startswith(" ") and us.strip().isdigit():
+            cumulative[name.strip()] = int(us) / 1e6
+    return sorted(cumulative.items(), key=lambda kv: -kv[1])[:n]
+
+
+def check_startup(budget_s, repeat):
+    # Report each page's cold import time and return the pages over budget
+    over_budget = []
+    for page in PAGES:
+        code = page_imports(page)
+        best = min(_import_in_new_process(code)[0] for _ in range(repeat))
+        _, report = _import_in_new_process(code, importtime=True)
+        slowest = ", ".join(
+            f"{name} {seconds * 1000:.0f} ms"
+            for name, seconds in slowest_imports(report)
+        )
+        print(f"{page:<28} {best * 1000:8.0f} ms  ({slowest})")
+        if best > budget_s:
+            over_budget.append((page, best))
+    return over_budget
+
+
+def compare(current, baseline, max_slowdown, min_delta_s):
+    # Return the benchmarks whose best time regressed past the threshold. The
+    # minimum is compared because it is the least affected by other load
+    regressions = []
+    for name, by_scale in current["results"].items():
+        for scale, result in by_scale.items():
+            base = baseline["results"].get(name, {}).get(scale)
+            if base is None:
+                continue
+            ratio = result["min_s"] / base["min_s"]
+            delta = result["min_s"] - base["min_s"]
+            # Ignore changes below min_delta_s, which are mostly timer noise
+            if ratio > max_slowdown and delta > min_delta_s:
+                regressions.append((name, scale, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the app's data and rendering hot paths"
+    )
+    parser.add_argument(
+        "--scales",
+        default="1,10",
+        help="Comma-separated data scales, as multiples of the routes and stops",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timed runs per benchmark"
+    )
+    parser.add_argument("--only", nargs="*", help="Only run these benchmarks")
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="Generate the data with app.synthetic instead of copying the real data",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.json",
+        help="Where to write the results as JSON",
+    )
+    parser.add_argument(
+        "--compare",
+        help="Baseline results JSON; exit with an error on regressions",
+    )
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.3,
+        help="Allowed ratio of current to baseline best time",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=5.0,
+        help="Slowdowns smaller than this are not regressions",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Only check each page's cold import time against --startup-budget",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=STARTUP_BUDGET_S,
+        help="Allowed cold import time per page, in seconds",
+    )
+    args = parser.parse_args()
+
+    if args.startup:
+        over_budget = check_startup(args.startup_budget, args.repeat)
+        for page, seconds in over_budget:
+            print(
+                f"OVER BUDGET {page}: {seconds:.2f} s > "
+                f"{args.startup_budget:.2f} s"
+            )
+        if over_budget:
+            sys.exit(1)
+        print("Every page starts within the budget")
+        return
+
+    scales = [int(s) for s in args.scales.split(",")]
+    results = run(scales, args.repeat, args.only, args.synthetic)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(
+            results, baseline, args.max_slowdown, args.min_delta_ms / 1000
+        )
+        for name, scale, ratio in regressions:
+            print(f"REGRESSION {name} x{scale}: {ratio:.2f}x the baseline")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+from itertools import chain
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+
+from app.constants import (ROUTE_LOD_TOLERANCES, ROUTE_TILE_ZOOMS,
+                           STOP_TILE_ZOOMS, TILE_DIR, data_dir)
+from app.load_data import get_route_linestrings
+from app.tiles import (TILE_SIZE, render_line_tiles, render_point_tiles,
+                       write_tile_dir)
+
+
+def _metadata(name, description, zooms, bounds):
+    return {
+        "name": name,
+        "description": description,
+        "type": "overlay",
+        "minzoom": str(min(zooms)),
+        "maxzoom": str(max(zooms)),
+        "bounds": ",".join(f"{b:.6f}" for b in bounds),
+        "attribution": "MDOT MTA",
+    }
+
+
+def build_stop_tiles(stops_path, tile_dir, zooms=STOP_TILE_ZOOMS):
+    stops = gpd.read_parquet(stops_path)
+    lon, lat = stops.geometry.x.to_numpy(), stops.geometry.y.to_numpy()
+    tiles = chain.from_iterable(
+        # Grow the stop markers as the map zooms in
+        render_point_tiles(lon, lat, zoom, radius=max(1.5, zoom - 11))
+        for zoom in zooms
+    )
+    count = write_tile_dir(
+        Path(tile_dir) / "mta_bus_stops",
+        tiles,
+        _metadata("mta_bus_stops", "MTA bus stops", zooms, stops.total_bounds),
+    )
+    print(f"Wrote {count} stop tiles")
+
+
+def _route_lines(routes):
+    for geometry in routes.geometry:
+        parts = getattr(geometry, "geoms", [geometry])
+        for part in parts:
+            yield np.asarray(part.coords), "black"
+
+
+def build_route_tiles(tile_dir, zooms=ROUTE_TILE_ZOOMS):
+    def tiles():
+        for zoom in zooms:
+            # Use the coarsest geometry that is within half a pixel
+            half_pixel = 180 / (TILE_SIZE * 2**zoom)
+            lod = max(
+                i
+                for i, t in enumerate(ROUTE_LOD_TOLERANCES)
+                if t <= half_pixel
+            )
+            routes = get_route_linestrings(lod=lod)
+            yield from render_line_tiles(_route_lines(routes), zoom, width=1)
+
+    bounds = get_route_linestrings().total_bounds
+    count = write_tile_dir(
+        Path(tile_dir) / "mta_bus_routes",
+        tiles(),
+        _metadata("mta_bus_routes", "MTA bus routes", zooms, bounds),
+    )
+    print(f"Wrote {count} route tiles")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build raster tile pyramids of the bus stops and routes"
+    )
+    parser.add_argument(
+        "--stops-path",
+        default=data_dir / "mta_bus_stops.parquet",
+        help="Bus stops parquet file",
+    )
+    parser.add_argument(
+        "--tile-dir",
+        default=str(TILE_DIR),
+        help="Directory to write the tilesets' {z}/{x}/{y}.png directories to",
+    )
+    parser.add_argument(
+        "--skip-routes",
+        action="store_true",
+        help="Only build the stop tiles",
+    )
+    args = parser.parse_args()
+    build_stop_tiles(args.stops_path, args.tile_dir)
+    if not args.skip_routes:
+        build_route_tiles(args.tile_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,94 @@
+import argparse
 import calendar
 import datetime as dt
 import json
+import operator
 import os
+import shutil
+from functools import reduce
 from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 import requests
 
+from app.arrow_store import arrow_path, write_arrow
+from app.baseline import ridership_for_app
+from app.constants import ROUTE_BBOX_COLS, ROUTE_LOD_TOLERANCES
+from app.cube import RidershipCube
+from app.partitions import (PARTITION_COLS, read_partitions, snapshot_key,
+                            write_partitions)
+from app.schema import (RIDERSHIP_DTYPES, RIDERSHIP_ROW_GROUP_ROWS,
+                        apply_ridership_schema, ridership_for_storage,
+                        route_dimension)
+
+RIDERSHIP_URL = "https://github.com/fedderw/mta-bus-ridership-scraper/blob/a46aaf701bee079e46ad3c715432bfc9be48be14/data/processed/mta_bus_ridership.csv?raw=true"
+STATE_FILE = "etl_state.json"
+
+# Per-stop columns kept in each stop ridership snapshot
+STOP_SNAPSHOT_COLS = [
+    "stop_id",
+    "stop_name",
+    "rider_on",
+    "rider_off",
+    "rider_total",
+    "stop_ridership_rank",
+    "latitude",
+    "longitude",
+    "ridership_period",
+]
+
+
+def read_ridership_csv(url_or_path=RIDERSHIP_URL, since=None, chunksize=None):
+    # Parse the scraper CSV, keeping only months after `since` if given
+    if since is None:
+        return pd.read_csv(
+            url_or_path, parse_dates=["date"], dtype={"route": str}
+        )
+    chunks = pd.read_csv(
+        url_or_path,
+        parse_dates=["date"],
+        dtype={"route": str},
+        chunksize=chunksize or 100_000,
+    )
+    return pd.concat(
+        [chunk[chunk["date"] > since] for chunk in chunks], ignore_index=True
+    )
 
-def clean_ridership_data(
-    url_or_path="https://github.com/fedderw/mta-bus-ridership-scraper/blob/a46aaf701bee079e46ad3c715432bfc9be48be14/data/processed/mta_bus_ridership.csv?raw=true",
-):
-    # Load the data
-    rides = pd.read_csv(url_or_path, parse_dates=["date"])
 
+def prepare_monthly(rides, routes=None):
     # Drop route months where  ridership is 0
-    rides = rides[rides["ridership"] > 0]
+    rides = rides[rides["ridership"] > 0].copy()
     rides["quarter"] = rides["date"].dt.quarter
 
-    # Organize the bus data by type
-    rides["route_group"] = rides["route"].apply(
-        lambda x: "Commuter"
-        if x.isnumeric() and int(x) >= 100
-        else "LocalLink"
-        if x.isnumeric() and int(x) < 100
-        else "CityLink"
-        if "CityLink" in x
-        else x
+    # Organize the bus data by type, classifying each distinct route once
+    if routes is None:
+        routes = route_dimension(rides["route"].unique())
+    route = pd.Categorical(
+        rides["route"].astype(str), categories=routes["route"]
     )
+    rides["route_group"] = routes["route_group"].to_numpy()[route.codes]
+    return apply_ridership_schema(rides, routes)
 
+
+def aggregate_quarterly(rides):
+    # Sum the counts per route and quarter; the ratios are recomputed below
+    sum_cols = [
+        col
+        for col in rides.select_dtypes("number").columns
+        if col not in ("quarter", "year", "month")
+    ]
     rides_quarterly = (
-        rides.groupby(["route", pd.Grouper(key="date", freq="Q")])
-        .sum()
+        rides.groupby(
+            ["route", pd.Grouper(key="date", freq="Q")], observed=True
+        )
+        .agg(
+            **{col: (col, "sum") for col in sum_cols},
+            date_end=("date_end", "max"),
+            route_group=("route_group", "first"),
+        )
         .reset_index()
     )
     rides_quarterly["quarter"] = rides_quarterly["date"].dt.quarter
@@ -46,15 +101,43 @@ def clean_ridership_data(
     rides_quarterly["ridership_per_day"] = (
         rides_quarterly["ridership"] / rides_quarterly["num_days_in_month"]
     )
-    # Create a column for the change over one year ago, two years ago, and three years ago
+    return rides_quarterly
+
+
+def add_change_vs_years_ago(rides_quarterly):
+    # Create a column for the change over one year ago, two years ago, and three years ago.
+    # Match on the calendar quarter, so routes with suspended service compare against the right quarter
+    quarter = rides_quarterly["date"].dt.to_period("Q")
+    ridership_per_day = rides_quarterly["ridership_per_day"].to_numpy()
+    by_route_quarter = pd.Series(
+        ridership_per_day,
+        index=pd.MultiIndex.from_arrays([rides_quarterly["route"], quarter]),
+    )
+    rides_quarterly = rides_quarterly.copy()
     for i in range(1, 4):
-        rides_quarterly[f"change_vs_{i}_years_ago"] = (
-            rides_quarterly["ridership_per_day"]
-            / rides_quarterly.groupby("route")["ridership_per_day"].shift(
-                i * 4
+        previous = by_route_quarter.reindex(
+            pd.MultiIndex.from_arrays(
+                [rides_quarterly["route"], quarter - 4 * i]
             )
-            - 1
+        ).to_numpy()
+        rides_quarterly[f"change_vs_{i}_years_ago"] = (
+            ridership_per_day / previous - 1
         )
+    return rides_quarterly
+
+
+def clean_ridership_data(url_or_path=RIDERSHIP_URL):
+    # Load the data
+    return transform_ridership(read_ridership_csv(url_or_path))
+
+
+def transform_ridership(raw):
+    # Build the monthly and quarterly outputs from scraper-format rows
+    rides = prepare_monthly(raw)
+    routes = route_dimension(rides["route"].cat.categories)
+    rides_quarterly = apply_ridership_schema(
+        add_change_vs_years_ago(aggregate_quarterly(rides)), routes
+    )
 
     return rides, rides_quarterly
 
@@ -62,13 +145,360 @@ def clean_ridership_data(
 def write_ridership_data_to_parquet(
     rides, rides_quarterly, data_dir=Path("data")
 ):
-    # Write the data to parquet
-    rides.to_parquet(data_dir / "mta_bus_ridership.parquet")
-    rides_quarterly.to_parquet(
-        data_dir / "mta_bus_ridership_quarterly.parquet"
+    # Write the data to parquet in small route-sorted row groups, so filtered
+    # reads only scan the row groups that can match
+    for df, name in [
+        (rides, "mta_bus_ridership"),
+        (rides_quarterly, "mta_bus_ridership_quarterly"),
+    ]:
+        ridership_for_storage(df).to_parquet(
+            data_dir / f"{name}.parquet",
+            index=False,
+            row_group_size=RIDERSHIP_ROW_GROUP_ROWS,
+        )
+
+
+def write_ridership_arrow(rides, rides_quarterly, data_dir=Path("data")):
+    # Write uncompressed Arrow IPC copies for the memory-mapped loading mode,
+    # already typed, sorted and with the recovery columns, so the app uses
+    # them as mapped
+    routes = route_dimension(rides["route"].cat.categories)
+    for df, name, freq in [
+        (rides, "mta_bus_ridership", "month"),
+        (rides_quarterly, "mta_bus_ridership_quarterly", "quarter"),
+    ]:
+        write_arrow(
+            ridership_for_app(df, freq, routes), data_dir / f"{name}.arrow"
+        )
+
+
+def write_stops_arrow(data_dir=Path("data")):
+    # The stops parquet comes from outside the ETL, so it is copied as is
+    src = data_dir / "mta_bus_stops.parquet"
+    if src.exists():
+        write_arrow(gpd.read_parquet(src), arrow_path(src))
+
+
+def write_route_dimension(rides, data_dir=Path("data")):
+    # Write the canonical route table shared by every ridership output
+    route_dimension(rides["route"].cat.categories).to_parquet(
+        data_dir / "mta_bus_routes.parquet", index=False
+    )
+
+
+def write_ridership_cubes(rides, rides_quarterly, data_dir=Path("data")):
+    # Write the dense route x period arrays that the app slices
+    RidershipCube.from_frame(rides, freq="month").save(
+        data_dir / "mta_bus_ridership_cube.npz"
+    )
+    RidershipCube.from_frame(rides_quarterly, freq="quarter").save(
+        data_dir / "mta_bus_ridership_quarterly_cube.npz"
+    )
+
+
+def write_route_geoparquet(
+    src=Path("data/mta_bus_route_linestring.geojson"),
+    dst=Path("data/mta_bus_route_linestring.parquet"),
+):
+    """Convert the route GeoJSON to GeoParquet keyed by level of detail and route
+
+    Each route is written once per level in ROUTE_LOD_TOLERANCES, simplified
+    to that tolerance, with the bounding box of the full geometry alongside.
+    Rows are sorted by level and route and written one per row group. The
+    parquet statistics on lod, route and the bounding box columns then let
+    readers skip every row group except the requested routes and level, or the
+    routes near an area, without parsing geometry.
+    """
+    gdf = gpd.read_file(src)
+    gdf["route"] = gdf["route"].astype(str)
+    gdf[ROUTE_BBOX_COLS] = gdf.bounds.to_numpy()
+    levels = []
+    for lod, tolerance in enumerate(ROUTE_LOD_TOLERANCES):
+        level = gdf.copy()
+        if tolerance:
+            level["geometry"] = level.simplify(tolerance)
+        level["lod"] = np.int8(lod)
+        levels.append(level)
+    pyramid = pd.concat(levels).sort_values(
+        ["lod", "route"], ignore_index=True
+    )
+    pyramid.to_parquet(dst, index=False, row_group_size=1)
+    write_arrow(pyramid, arrow_path(dst))
+    return pyramid
+
+
+def _with_partition_keys(rides, freq):
+    rides = rides.copy()
+    rides["year"] = rides["date"].dt.year
+    rides[freq] = (
+        rides["date"].dt.month if freq == "month" else rides["date"].dt.quarter
+    )
+    return rides
+
+
+def write_daily_ridership(daily, data_dir=Path("data")):
+    """Merge daily route ridership into the dataset partitioned by year and month
+
+    Only the months present in `daily` are read and rewritten, so memory use
+    depends on the months ingested rather than the whole history. Days
+    already stored for those months are kept unless `daily` replaces them.
+
+    Args:
+        daily (pd.DataFrame): One row per route and day, with route, date and ridership columns
+    """
+    name = "mta_bus_ridership_daily"
+    partition_cols = PARTITION_COLS[name]
+    daily = _with_partition_keys(
+        daily.assign(
+            route=daily["route"].astype(str),
+            date=pd.to_datetime(daily["date"]),
+        ),
+        "month",
+    )
+    if (data_dir / name).is_dir():
+        months = daily[partition_cols].drop_duplicates()
+        existing = read_partitions(
+            data_dir / name,
+            partition_cols,
+            reduce(
+                operator.or_,
+                [
+                    (ds.field("year") == year) & (ds.field("month") == month)
+                    for year, month in months.itertuples(index=False)
+                ],
+            ),
+        )
+        daily = pd.concat([existing, daily], ignore_index=True)
+        daily = daily.drop_duplicates(["route", "date"], keep="last")
+    daily = daily.sort_values(["route", "date"]).astype(
+        {
+            col: RIDERSHIP_DTYPES[col]
+            for col in daily
+            if col in RIDERSHIP_DTYPES
+        }
+    )
+    return write_partitions(daily, data_dir / name, partition_cols)
+
+
+def write_stop_snapshots(stops, data_dir=Path("data")):
+    """Write the per-stop counts of each ridership_period as a snapshot partition
+
+    Rewrites only the snapshots present in `stops`.
+    """
+    name = "mta_bus_stop_ridership"
+    snapshots = stops[STOP_SNAPSHOT_COLS].assign(
+        stop_id=stops["stop_id"].astype(str),
+        snapshot=stops["ridership_period"].map(snapshot_key),
+    )
+    return write_partitions(snapshots, data_dir / name, PARTITION_COLS[name])
+
+
+def read_high_water_mark(data_dir=Path("data")):
+    # The last month already ingested, from the state file or the data itself
+    state_path = data_dir / STATE_FILE
+    if state_path.exists():
+        with open(state_path) as f:
+            return pd.Timestamp(json.load(f)["high_water_mark"])
+    if (data_dir / "mta_bus_ridership").is_dir():
+        rides = read_partitions(
+            data_dir / "mta_bus_ridership",
+            PARTITION_COLS["mta_bus_ridership"],
+            columns=["date"],
+        )
+        return rides["date"].max()
+    if (data_dir / "mta_bus_ridership.parquet").exists():
+        return pd.read_parquet(
+            data_dir / "mta_bus_ridership.parquet", columns=["date"]
+        )["date"].max()
+    return None
+
+
+def write_high_water_mark(high_water_mark, data_dir=Path("data")):
+    with open(data_dir / STATE_FILE, "w") as f:
+        json.dump(
+            {
+                "high_water_mark": high_water_mark.strftime("%Y-%m-%d"),
+                "updated_at": dt.datetime.now().isoformat(timespec="seconds"),
+            },
+            f,
+            indent=2,
+        )
+
+
+def remove_partitioned_ridership(data_dir=Path("data")):
+    """Delete the monthly and quarterly partitions and the high-water mark
+
+    The app reads the partitions when they exist, so a full rebuild of the
+    single files removes them. The next incremental run splits the new
+    files into partitions again.
+    """
+    for name in ["mta_bus_ridership", "mta_bus_ridership_quarterly"]:
+        if (data_dir / name).is_dir():
+            shutil.rmtree(data_dir / name)
+    (data_dir / STATE_FILE).unlink(missing_ok=True)
+
+
+def _bootstrap_partitions(data_dir):
+    # Split the single-file outputs into partitions on the first incremental run
+    for name, freq in [
+        ("mta_bus_ridership", "month"),
+        ("mta_bus_ridership_quarterly", "quarter"),
+    ]:
+        if not (data_dir / name).is_dir():
+            rides = pd.read_parquet(data_dir / f"{name}.parquet")
+            write_partitions(
+                _with_partition_keys(rides, freq),
+                data_dir / name,
+                PARTITION_COLS[name],
+            )
+
+
+def _read_partitioned(data_dir, name, routes, filter=None):
+    rides = read_partitions(data_dir / name, PARTITION_COLS[name], filter)
+    if name == "mta_bus_ridership":
+        rides = rides.drop(columns=PARTITION_COLS[name])
+    return apply_ridership_schema(rides, routes)
+
+
+def _known_routes(data_dir):
+    if (data_dir / "mta_bus_routes.parquet").exists():
+        return pd.read_parquet(data_dir / "mta_bus_routes.parquet")["route"]
+    return read_partitions(
+        data_dir / "mta_bus_ridership",
+        PARTITION_COLS["mta_bus_ridership"],
+        columns=["route"],
+    )["route"].astype(str)
+
+
+def update_ridership_data(url_or_path=RIDERSHIP_URL, data_dir=Path("data")):
+    """Ingest only the months newer than the data already written
+
+    New months are appended as new month partitions. Only the quarters that
+    contain new months are re-aggregated, and their change_vs_{i}_years_ago
+    columns are computed against the three years of quarters before them.
+    """
+    high_water_mark = read_high_water_mark(data_dir)
+    if high_water_mark is None:
+        rides, rides_quarterly = clean_ridership_data(url_or_path)
+        write_partitions(
+            _with_partition_keys(rides, "month"),
+            data_dir / "mta_bus_ridership",
+            PARTITION_COLS["mta_bus_ridership"],
+        )
+        write_partitions(
+            _with_partition_keys(rides_quarterly, "quarter"),
+            data_dir / "mta_bus_ridership_quarterly",
+            PARTITION_COLS["mta_bus_ridership_quarterly"],
+        )
+        write_route_dimension(rides, data_dir)
+        write_ridership_cubes(rides, rides_quarterly, data_dir)
+        write_ridership_arrow(rides, rides_quarterly, data_dir)
+        write_high_water_mark(rides["date"].max(), data_dir)
+        return rides
+
+    _bootstrap_partitions(data_dir)
+    new_rides = read_ridership_csv(url_or_path, since=high_water_mark)
+    if new_rides.empty:
+        print(f"No months after {high_water_mark:%Y-%m-%d}")
+        return new_rides
+    routes = route_dimension(
+        list(_known_routes(data_dir)) + list(new_rides["route"].unique())
+    )
+    new_rides = prepare_monthly(new_rides, routes)
+
+    # Append the new months
+    write_partitions(
+        _with_partition_keys(new_rides, "month"),
+        data_dir / "mta_bus_ridership",
+        PARTITION_COLS["mta_bus_ridership"],
+    )
+
+    # Re-aggregate the quarters that received new months
+    affected = new_rides["date"].dt.to_period("Q").unique()
+    context_filter = ds.field("year") >= affected.min().year - 3
+    monthly = _read_partitioned(
+        data_dir, "mta_bus_ridership", routes, context_filter
+    )
+    in_affected = monthly["date"].dt.to_period("Q").isin(affected)
+    new_quarters = aggregate_quarterly(monthly[in_affected])
+
+    # Recompute the year-over-year changes against the earlier quarters
+    quarterly = _read_partitioned(
+        data_dir, "mta_bus_ridership_quarterly", routes, context_filter
+    )
+    quarterly = quarterly[~quarterly["date"].dt.to_period("Q").isin(affected)]
+    context = pd.concat([quarterly, new_quarters], ignore_index=True)
+    context = apply_ridership_schema(add_change_vs_years_ago(context), routes)
+    new_quarters = context[context["date"].dt.to_period("Q").isin(affected)]
+    write_partitions(
+        new_quarters,
+        data_dir / "mta_bus_ridership_quarterly",
+        PARTITION_COLS["mta_bus_ridership_quarterly"],
+    )
+
+    # The cubes and Arrow files hold every month, so they are rebuilt from
+    # the partitions
+    rides = _read_partitioned(data_dir, "mta_bus_ridership", routes)
+    rides_quarterly = _read_partitioned(
+        data_dir, "mta_bus_ridership_quarterly", routes
+    )
+    write_route_dimension(rides, data_dir)
+    write_ridership_cubes(rides, rides_quarterly, data_dir)
+    write_ridership_arrow(rides, rides_quarterly, data_dir)
+    write_high_water_mark(new_rides["date"].max(), data_dir)
+    print(
+        f"Appended {len(new_rides)} route months, re-aggregated quarters {', '.join(map(str, affected))}"
+    )
+    return new_rides
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Clean MTA bus ridership data"
+    )
+    parser.add_argument(
+        "--url-or-path",
+        default=RIDERSHIP_URL,
+        help="Scraper CSV to read",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only ingest months newer than the data already written, into partitioned output",
+    )
+    parser.add_argument(
+        "--routes",
+        action="store_true",
+        help="Also convert data/mta_bus_route_linestring.geojson to GeoParquet",
+    )
+    parser.add_argument(
+        "--daily",
+        help="Also merge a CSV of daily route ridership (route, date, ridership) into data/mta_bus_ridership_daily/",
+    )
+    parser.add_argument(
+        "--stop-snapshots",
+        nargs="+",
+        default=[],
+        help="Also add the per-stop counts in these stops parquet files to data/mta_bus_stop_ridership/, one snapshot per ridership_period",
     )
+    args = parser.parse_args()
+    if args.routes:
+        write_route_geoparquet()
+    if args.daily:
+        write_daily_ridership(pd.read_csv(args.daily, dtype={"route": str}))
+    for path in args.stop_snapshots:
+        write_stop_snapshots(pd.read_parquet(path, columns=STOP_SNAPSHOT_COLS))
+    if args.incremental:
+        update_ridership_data(args.url_or_path)
+    else:
+        rides, rides_quarterly = clean_ridership_data(args.url_or_path)
+        write_ridership_data_to_parquet(rides, rides_quarterly)
+        remove_partitioned_ridership()
+        write_route_dimension(rides)
+        write_ridership_cubes(rides, rides_quarterly)
+        write_ridership_arrow(rides, rides_quarterly)
+    write_stops_arrow()
 
 
 if __name__ == "__main__":
-    rides, rides_quarterly = clean_ridership_data()
-    write_ridership_data_to_parquet(rides, rides_quarterly)
+    main()
@@ -0,0 +1,104 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from app.synthetic import generate, stop_snapshots
+from clean_data import (transform_ridership, write_daily_ridership,
+                        write_ridership_arrow, write_ridership_cubes,
+                        write_ridership_data_to_parquet, write_route_dimension,
+                        write_route_geoparquet, write_stop_snapshots,
+                        write_stops_arrow)
+
+
+def write_synthetic_data(output_dir, csv=False, snapshots=1, **kwargs):
+    # Write every file the app reads, through the same ETL as the real data
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    raw, lines, stops = generate(**kwargs)
+    if kwargs.get("daily"):
+        write_daily_ridership(raw[["route", "date", "ridership"]], output_dir)
+    if csv:
+        # The scraper CSV, for profiling clean_data.py itself
+        raw.to_csv(output_dir / "mta_bus_ridership.csv", index=False)
+    rides, rides_quarterly = transform_ridership(raw)
+    write_ridership_data_to_parquet(rides, rides_quarterly, output_dir)
+    write_route_dimension(rides, output_dir)
+    write_ridership_cubes(rides, rides_quarterly, output_dir)
+    write_ridership_arrow(rides, rides_quarterly, output_dir)
+    stops.to_parquet(output_dir / "mta_bus_stops.parquet")
+    write_stops_arrow(output_dir)
+    for snapshot in stop_snapshots(
+        stops, snapshots, np.random.default_rng(kwargs.get("seed", 0))
+    ):
+        write_stop_snapshots(snapshot, output_dir)
+    geojson = output_dir / "mta_bus_route_linestring.geojson"
+    geojson.write_text(lines.to_json())
+    write_route_geoparquet(
+        geojson, output_dir / "mta_bus_route_linestring.parquet"
+    )
+    print(
+        f"Wrote {len(rides)} ridership rows, {len(lines)} routes and "
+        f"{len(stops)} stops to {output_dir}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate deterministic synthetic ridership, stops and routes"
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="data/synthetic",
+        help="Directory to write the data files to",
+    )
+    parser.add_argument(
+        "--route-scale",
+        type=int,
+        default=1,
+        help="Multiple of the real number of numbered routes",
+    )
+    parser.add_argument(
+        "--stops", type=int, default=4536, help="Number of bus stops"
+    )
+    parser.add_argument(
+        "--daily",
+        action="store_true",
+        help="One ridership row per route and day instead of per month, also written to the daily dataset",
+    )
+    parser.add_argument(
+        "--statewide",
+        action="store_true",
+        help="Spread routes and stops across Maryland",
+    )
+    parser.add_argument(
+        "--snapshots",
+        type=int,
+        default=1,
+        help="Number of seasonal stop ridership snapshots",
+    )
+    parser.add_argument("--start-date", default="2018-01-01")
+    parser.add_argument("--end-date", default="2023-09-30")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--csv",
+        action="store_true",
+        help="Also write the raw ridership in the scraper's CSV format",
+    )
+    args = parser.parse_args()
+    write_synthetic_data(
+        args.output_dir,
+        csv=args.csv,
+        snapshots=args.snapshots,
+        route_scale=args.route_scale,
+        n_stops=args.stops,
+        daily=args.daily,
+        statewide=args.statewide,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,49 @@
-from datetime import datetime
 from pprint import pprint as print
-from typing import Dict, List, Optional, Tuple, Union
-
-import folium
-import geopandas as gpd
-import leafmap.foliumap as leafmap
-import numpy as np
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import shapely.geometry
+from typing import TYPE_CHECKING, List, Optional
+
 import streamlit as st
 from annotated_text import annotated_text
-from folium.plugins import HeatMap
-from streamlit_folium import st_folium
-from streamlit_plotly_mapbox_events import plotly_mapbox_events
 
-from app.constants import CITYLINK_COLORS
-from app.load_data import (get_bus_stops, get_rides, get_rides_quarterly,
-                           get_route_linestrings)
-from app.viz import (plot_bar_top_n_for_daterange,
-                     plot_recovery_over_this_quarter, plot_ridership_average)
+from app.constants import (CITYLINK_COLORS, FULL_STOP_HOVER,
+                           HEATMAP_CELL_SIZES_M, NEARBY_STOP_RADII_M,
+                           STOP_CLICK_PIXELS)
+from app.load_data import (get_bus_stops, get_route_linestrings,
+                           get_stop_heatmap, get_stop_ridership,
+                           get_stop_route_index, get_stop_snapshots,
+                           get_stop_spatial_index, route_level_of_detail)
+from app.partitions import snapshot_label
+from app.sql import boardings_by_shelter, shelters_by_route
+from app.tiles import ground_resolution, tile_layer_url
+from app.tracing import finish_run, span, start_run
+from app.viz import add_tile_overlay, show_map
+
+# folium, geopandas, plotly and the map components take seconds to import,
+# so each is imported where it is first used. Streamlit runs every tab, so a
+# rerun still loads them all, but the page starts drawing before they load
+# and the heatmap's folium loads after the first two tabs are drawn
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import leafmap.foliumap as leafmap
 
 st.set_page_config(
     layout="wide",
     page_icon="🚌",
     page_title="Explore MTA Bus Stops",
 )
-
-# Get the linestrings of the routes served
-routes_linestrings = get_route_linestrings()
+start_run("Bus stops")
 
 # M
 
 
 def map_bus_routes(
-    gdf: gpd.GeoDataFrame,
+    gdf: "gpd.GeoDataFrame",
     route_numbers: List[str],
     highlight_routes: bool = False,
     width: int = 400,
     height: int = 400,
     bus_stop_x: float = None,
     bus_stop_y: float = None,
+    stop_tiles: Optional[str] = None,
 ):
     """
     > This function takes a GeoDataFrame of bus routes, a list of route numbers, and a boolean
@@ -60,6 +62,41 @@ def map_bus_routes(
     :type height: int (optional)
     """
 
+    key = (
+        "stop",
+        tuple(sorted(route_numbers)),
+        highlight_routes,
+        (bus_stop_x, bus_stop_y),
+        (width, height),
+        stop_tiles,
+    )
+    return show_map(
+        key,
+        lambda: build_stop_routes_map(
+            gdf,
+            route_numbers,
+            highlight_routes,
+            bus_stop_x,
+            bus_stop_y,
+            stop_tiles,
+        ),
+        width=width,
+        height=height,
+    )
+
+
+def build_stop_routes_map(
+    gdf: "gpd.GeoDataFrame",
+    route_numbers: List[str],
+    highlight_routes: bool = False,
+    bus_stop_x: float = None,
+    bus_stop_y: float = None,
+    stop_tiles: Optional[str] = None,
+) -> "leafmap.Map":
+    """Build the leafmap.Map drawn by `map_bus_routes`"""
+    # Only imported when a map is not in the render cache
+    import leafmap.foliumap as leafmap
+
     # Get the data for the route
     route = gdf[gdf["route"].isin(route_numbers)]
 
@@ -99,6 +136,9 @@ def map_bus_routes(
                 "opacity": 0.8,
             },
         )
+    # Show the other stops from the tile server
+    if stop_tiles:
+        add_tile_overlay(m, stop_tiles, "All Bus Stops")
     # Add a marker for the bus stop
     if bus_stop_x and bus_stop_y:
         m.add_marker(
@@ -108,11 +148,12 @@ def map_bus_routes(
         )
     # Zoom to the bus routes
     m.zoom_to_gdf(route)
-    # Display the map
-    return m.to_streamlit(height=height, width=width)
+    return m
+
 
+def plot_scatter_mapbox(gdf: "gpd.GeoDataFrame", **kwargs):
+    import plotly.express as px
 
-def plot_scatter_mapbox(gdf: gpd.GeoDataFrame, **kwargs):
     fig = px.scatter_mapbox(
         gdf,
         lat=gdf.geometry.y,
@@ -122,26 +163,160 @@ def plot_scatter_mapbox(gdf: gpd.GeoDataFrame, **kwargs):
     # fig.update_traces(marker=dict(color='#FF5F1F'))
     # Change mapbox style
     fig.update_layout(mapbox_style="carto-positron")
+    # Draw the bus routes under the points when the route tiles are built
+    route_tiles = tile_layer_url("mta_bus_routes")
+    if route_tiles:
+        fig.update_layout(
+            mapbox_layers=[
+                {
+                    "below": "traces",
+                    "sourcetype": "raster",
+                    "source": [route_tiles],
+                    "opacity": 0.5,
+                }
+            ]
+        )
     fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
     return fig
 
 
+def describe_stop(stop) -> str:
+    """Markdown details of a clicked stop, in place of its hover text"""
+    return (
+        f"**{stop['stop_name']}** (stop {stop['stop_id']}): "
+        f"{stop['rider_on']:,.0f} boardings and {stop['rider_off']:,.0f} "
+        f"alightings on an average day, "
+        f"{'sheltered' if stop['shelter'] else 'no shelter'}"
+    )
+
+
+def pick_stop_from_points(stops):
+    """Draw every stop as a map point and return the (stop, lat, lon) clicked
+
+    Used when the stop tiles are not built. Returns None until a stop is
+    clicked.
+    """
+    with span("stops figure", rows=len(stops)):
+        if FULL_STOP_HOVER:
+            hover = dict(
+                hover_data=[
+                    # "index",
+                    "objectid",
+                    "stop_id",
+                    "stop_name",
+                    "rider_on",
+                    "rider_off",
+                    "rider_total",
+                    "routes_served",
+                    "shelter",
+                    "df_index",
+                    "latitude",
+                    "longitude",
+                ]
+            )
+        else:
+            # Only the stop key goes to the browser. The rest of a stop's
+            # details are looked up on the server when it is clicked
+            hover = dict(custom_data=["stop_id"])
+        fig = plot_scatter_mapbox(
+            gdf=stops,
+            height=600,
+            # size_max=30,
+            **hover,
+            # size="rider_total",
+            zoom=10,
+            opacity=0.5,
+            # For some reason, using color only returns an array of length 527 in the customdata, so we can't use it to select routes
+            # color="shelter",
+            # color_discrete_map={True: "green", False: "orange"},
+        )
+        fig.update_traces(marker=dict(color="blue"))
+        if not FULL_STOP_HOVER:
+            fig.update_traces(
+                hovertemplate="Stop %{customdata[0]}: click for details"
+                "<extra></extra>"
+            )
+
+    # Get mapbox events (clicks) from the user
+    with span("stops map"):
+        from streamlit_plotly_mapbox_events import plotly_mapbox_events
+
+        mapbox_events = plotly_mapbox_events(
+            fig,
+            click_event=True,
+            key="mapbox_events",
+        )
+    if not mapbox_events[0]:
+        return None
+    # The click carries the point's position and location only. The point
+    # is a row of this page's stops, whose key finds the stop in the
+    # stop-route index, whatever the columns or row order
+    click = mapbox_events[0][0]
+    return stops.iloc[click["pointIndex"]], click["lat"], click["lon"]
+
+
+def pick_stop_from_tiles(stops, stop_tiles: str):
+    """Draw the stops from their tileset and return the (stop, lat, lon) clicked
+
+    No stop is sent to the browser. A click anywhere on the map is resolved
+    to the nearest stop with the spatial index, if it is within
+    `STOP_CLICK_PIXELS` of the click at the map's zoom. Returns None until
+    a stop is clicked.
+    """
+    import folium
+    from streamlit_folium import st_folium
+
+    with span("stops map"):
+        m = folium.Map(
+            [stops["latitude"].mean(), stops["longitude"].mean()],
+            zoom_start=10,
+            tiles="CartoDB positron",
+        )
+        route_tiles = tile_layer_url("mta_bus_routes")
+        if route_tiles:
+            add_tile_overlay(m, route_tiles, "Bus Routes", opacity=0.5)
+        add_tile_overlay(m, stop_tiles, "Bus Stops")
+        st_data = st_folium(
+            m,
+            height=600,
+            use_container_width=True,
+            returned_objects=["last_clicked", "zoom"],
+            key="stop_tiles_map",
+        )
+    clicked = (st_data or {}).get("last_clicked")
+    if not clicked:
+        return None
+    with span("nearest stop"):
+        positions, distances = get_stop_spatial_index().nearest(
+            clicked["lat"], clicked["lng"]
+        )
+    tolerance_m = STOP_CLICK_PIXELS * ground_resolution(
+        clicked["lat"], st_data.get("zoom") or 10
+    )
+    if positions[0, 0] < 0 or distances[0, 0] > tolerance_m:
+        return None
+    # Positions are rows of the stops table, as this page's stops are
+    stop = stops.iloc[positions[0, 0]]
+    return stop, stop["latitude"], stop["longitude"]
+
+
 tab1, tab2, tab3 = st.tabs(["Bus Stops", "Shelters", "Ridership Heatmap"])
 
 stops = get_bus_stops()
+stop_route_index = get_stop_route_index()
 print(f"number of stops: {len(stops)}")
 # stops=stops.dropna().reset_index(drop=True)
-# Map "yes" and "no" to True and False for the shelter column
-stops["shelter"] = (
-    stops["shelter"].map({"Yes": True, "No": False}).astype(bool)
-)
-# Fill in missing values for the shelter column
-stops["shelter"] = stops["shelter"].fillna(False)
-print(f"number of stops after dropping na: {len(stops)}")
-# Set the index to the stop_id
-stops["df_index"] = stops.index
-stops = stops.set_index("stop_id")
-stops["stop_id"] = stops.index
+with span("prepare stops", rows=len(stops)):
+    # The loaded stops are shared by every session and read-only, so derive
+    # this page's frame from them. Unchanged columns still share their data
+    stops = stops.assign(
+        # Map "yes" and "no" to True and False for the shelter column
+        shelter=stops["shelter"].map({"Yes": True, "No": False}).astype(bool),
+        df_index=stops.index,
+    )
+    print(f"number of stops after dropping na: {len(stops)}")
+    # Set the index to the stop_id, keeping the column
+    stops = stops.set_index("stop_id", drop=False)
 # So
 
 with tab1:
@@ -151,64 +326,24 @@ with tab1:
         "Click on a stop to see the routes served by that stop.  Ridership data is from Summer 2023. The routes may not be concurrent with service changes. Fixing those is on the to-do list."
     )
 
-    fig = plot_scatter_mapbox(
-        gdf=stops,
-        height=600,
-        # size_max=30,
-        hover_data=[
-            # "index",
-            "objectid",
-            "stop_id",
-            "stop_name",
-            "rider_on",
-            "rider_off",
-            "rider_total",
-            "routes_served",
-            "shelter",
-            "df_index",
-            "latitude",
-            "longitude",
-        ],
-        # size="rider_total",
-        zoom=10,
-        opacity=0.5,
-        # For some reason, using color only returns an array of length 527 in the customdata, so we can't use it to select routes
-        # color="shelter",
-        # color_discrete_map={True: "green", False: "orange"},
-    )
-    fig.update_traces(marker=dict(color="blue"))
-
-    # Get mapbox events (clicks) from the user
-    mapbox_events = plotly_mapbox_events(
-        fig,
-        click_event=True,
-        key="mapbox_events",
-    )
-    # If the user clicks, get the index of the stop
-    # print(st.session_state.keys())
+    # Draw the stops from the tiles when they are built, so the browser only
+    # fetches the tiles on screen instead of every stop
+    stop_tiles = tile_layer_url("mta_bus_stops")
+    if stop_tiles:
+        picked = pick_stop_from_tiles(stops, stop_tiles)
+    else:
+        picked = pick_stop_from_points(stops)
     plot_name_holder_clicked = st.empty()
-    # plot_name_holder_clicked.write(f"Clicked Point: {mapbox_events[0]}")
-    if mapbox_events[0]:
-        index_selection = mapbox_events[0][0]["pointIndex"]
-
-        # print(f"len(fig.data[0].customdata): {len(fig.data[0].customdata)}")
-        # print(f"routes_served: {fig.data[0].customdata[index_selection][6]}")
-        # Show a badge with each route served
-
-        # print(f"Type of fig.data[0].customdata[index_selection]: {type(fig.data[0].customdata[index_selection])}")
-        # Get the latitude and longitude of the stop
-        lat, lon = (
-            fig.data[0].customdata[index_selection][9],
-            fig.data[0].customdata[index_selection][10],
-        )
+    if picked is not None:
+        stop, lat, lon = picked
+        plot_name_holder_clicked.markdown(describe_stop(stop))
         # Get the routes served by the stop
-        routes_served = fig.data[0].customdata[index_selection][6]
-        routes_served = routes_served.split(",")
-        routes_served = [x.strip() for x in routes_served]
-        # There are some strings that are separated by semi-colons instead of commas
-        routes_served = [x.split(";") for x in routes_served]
-        routes_served = [item for sublist in routes_served for item in sublist]
-        routes_served = [x.strip() for x in routes_served]
+        position = stop_route_index.stop_position(stop["stop_id"])
+        routes_served = (
+            []
+            if position is None
+            else stop_route_index.routes_for_stop(position)
+        )
 
         # st.subheader("Routes Served")
         annotated_text(
@@ -226,17 +361,26 @@ with tab1:
         )
 
         # Plot the map of the routes served
-        map = map_bus_routes(
-            routes_linestrings,
-            route_numbers=routes_served,
-            highlight_routes=False,
-            height=500,
-            width=800,
-            bus_stop_x=lon,
-            bus_stop_y=lat,
+        # Get the linestrings of the routes served
+        routes_linestrings = get_route_linestrings(
+            tuple(sorted(routes_served)),
+            lod=route_level_of_detail(routes_served, width=800, height=500),
         )
+        with span("route map"):
+            map = map_bus_routes(
+                routes_linestrings,
+                route_numbers=routes_served,
+                highlight_routes=False,
+                height=500,
+                width=800,
+                bus_stop_x=lon,
+                bus_stop_y=lat,
+                stop_tiles=stop_tiles,
+            )
 
 with tab2:
+    import plotly.express as px
+
     st.header("Explore Shelters")
     col1, col2, col3 = st.columns([1, 1, 1])
     col1.metric("Sheltered", stops["shelter"].sum())
@@ -248,32 +392,33 @@ with tab2:
         stops_selection = stops[stops["rider_on"] > 0]
     else:
         stops_selection = stops
-    fig2 = plot_scatter_mapbox(
-        gdf=stops_selection,
-        height=600,
-        width=800,
-        # size_max=40,
-        hover_data=[
-            "stop_id",
-            "stop_name",
-            "rider_on",
-            "rider_off",
-            "rider_total",
-            "routes_served",
-            "shelter",
-        ],
-        size=stops_selection["rider_on"].values if size_by_ridership else None,
-        zoom=10,
-        opacity=0.5,
-        # For some reason, using color only returns an array of length 527 in the customdata, so we can't use it to select routes
-        color="shelter",
-        color_discrete_map={True: "blue", False: "orange"},
-    )
-    fig2
+    with span("shelter map", rows=len(stops_selection)):
+        fig2 = plot_scatter_mapbox(
+            gdf=stops_selection,
+            height=600,
+            width=800,
+            # size_max=40,
+            hover_data=[
+                "stop_id",
+                "stop_name",
+                "rider_on",
+                "rider_off",
+                "rider_total",
+                "routes_served",
+                "shelter",
+            ],
+            size=stops_selection["rider_on"].values
+            if size_by_ridership
+            else None,
+            zoom=10,
+            opacity=0.5,
+            # For some reason, using color only returns an array of length 527 in the customdata, so we can't use it to select routes
+            color="shelter",
+            color_discrete_map={True: "blue", False: "orange"},
+        )
+        fig2
     # Create a bar graph comparing the number of boardings at sheltered and unsheltered stops
-    grouped_by_shelter = (
-        stops[["shelter", "rider_on"]].groupby("shelter").sum().reset_index()
-    )
+    grouped_by_shelter = boardings_by_shelter()
     grouped_by_shelter["shelter_text"] = grouped_by_shelter["shelter"].map(
         {True: "Sheltered", False: "Unsheltered"}
     )
@@ -301,76 +446,11 @@ with tab2:
     # st.header("Boardings at Sheltered vs. Unsheltered Stops")
     fig3
     # <------------------------>
-    # Creat a new dataframe where each row is identified by a route, a stop, and a shelter. Since each stop can have multiple routes, we need to create a new row for each route
-    route_stop = stops.copy()
-    # Drop geometry column
-    route_stop = route_stop.drop(columns=["geometry"])
-    # Convert from geodataframe to dataframe
-
-    # We need to split on commas and semicolons
-    route_stop["routes_served"] = route_stop["routes_served"].str.split(",")
-    # st.dataframe(route_stop)
-    route_stop = route_stop.explode("routes_served")
-    # Split on semicolons
-    route_stop["routes_served"] = route_stop["routes_served"].str.split(";")
-    route_stop = route_stop.explode("routes_served")
-    # st.dataframe(route_stop)
-    route_stop["routes_served"] = route_stop["routes_served"].str.strip()
-
-    # Dictionary mapping short color codes to their corresponding CityLink route names
-    color_to_citylink = {
-        "BL": "CityLink Blue",
-        "BR": "CityLink Brown",
-        "CityLink BLUE": "CityLink Blue",
-        "CityLink NAVY": "CityLink Navy",
-        "CityLink ORANGE": "CityLink Orange",
-        "CityLink RED": "CityLink Red",
-        "CityLink SILVER": "CityLink Silver",
-        "GD": "CityLink Gold",
-        "GR": "CityLink Green",
-        "LM": "CityLink Lime",
-        "NV": "CityLink Navy",
-        "OR": "CityLink Orange",
-        "PK": "CityLink Pink",
-        "PR": "CityLink Purple",
-        "RD": "CityLink Red",
-        "SV": "CityLink Silver",
-        "YW": "CityLink Yellow",
-    }
-
-    # Function to map colors to their full names, keeping unmatched values
-    def map_color_to_citylink(color):
-        return color_to_citylink.get(color, color)
-
-    # Apply the function to the 'routes_served' column
-    route_stop["routes_served"] = route_stop["routes_served"].apply(
-        map_color_to_citylink
-    )
-    # st.dataframe(route_stop)
-
-    # Group by route and shelter
-    grouped_by_route_shelter = (
-        route_stop[
-            [
-                "routes_served",
-                "stop_id",
-                "shelter",
-            ]
-        ]
-        .groupby(["routes_served"])
-        .sum("shelter")
-        .reset_index()
-        .sort_values(by="shelter", ascending=False)
-    )
-    # Rename the columns
-    grouped_by_route_shelter = grouped_by_route_shelter.rename(
-        columns={
-            "routes_served": "route",
-            "shelter": "number_of_sheltered_stops",
-        }
-    )
-    # Replace NaN values with 0
-    grouped_by_route_shelter = grouped_by_route_shelter.fillna(0)
+    # Count the sheltered and total stops on each route in SQL, which splits
+    # routes_served and normalizes CityLink names as the stop-route index does
+    with span("shelter aggregation", rows=len(stops)):
+        route_shelters = shelters_by_route()
+        grouped_by_route_shelter = route_shelters
     # Create a vertical bar chart showing the number of sheltered stops for each route
     fig4 = px.bar(
         grouped_by_route_shelter,
@@ -401,24 +481,7 @@ with tab2:
         textposition="outside",
     )
 
-    # Counting sheltered and total stops for each route
-    total_counts = (
-        route_stop[["routes_served", "shelter"]]
-        .groupby(["routes_served"])
-        .count()
-        .reset_index()
-        .sort_values(by="shelter", ascending=False)
-    )
-    total_counts = total_counts.rename(
-        columns={"routes_served": "route", "shelter": "total_stops"}
-    )
-    # Replace NaN values with 0
-    total_counts = total_counts.fillna(0)
-
-    # Merging the counts
-    merged_data = pd.merge(
-        grouped_by_route_shelter, total_counts, on="route"
-    ).reset_index(drop=True)
+    merged_data = route_shelters.copy()
 
     # Calculating the percentage of sheltered stops
     merged_data["sheltered_percentage"] = (
@@ -472,8 +535,17 @@ with tab2:
 
 with tab3:
     st.header("Explore Ridership")
+    # Only the selected period's partition of the stop ridership snapshots is
+    # read. Without snapshots, the counts in the stops data are used
+    snapshots = {snapshot_label(key): key for key in get_stop_snapshots()}
+    snapshot = None
+    if len(snapshots) > 1:
+        snapshot = snapshots[
+            st.selectbox("Ridership period", list(snapshots)[::-1])
+        ]
     st.write(
-        "This is a heatmap of MTA bus ridership by stop.  The data is from Summer 2023."
+        "This is a heatmap of MTA bus ridership by stop.  The data is from "
+        f"{snapshot_label(snapshot) if snapshot else 'Summer 2023'}."
     )
     select_column = st.selectbox(
         "Select a column",
@@ -486,25 +558,78 @@ with tab3:
     # if no column is selected, default to "rider_total"
     if not select_column:
         select_column = "rider_total"
-    heat_df = stops[["latitude", "longitude", select_column]]
-    # Drop NaN values from the data
-    heat_df = heat_df.dropna(
-        axis=0, subset=["latitude", "longitude", select_column]
+    cell_size_m = st.select_slider(
+        "Grid cell size (meters)", HEATMAP_CELL_SIZES_M, value=250
     )
-    m = folium.Map(
-        [stops["latitude"].mean(), stops["longitude"].mean()], zoom_start=10
+    with span("heatmap figure") as stage:
+        import folium
+        from folium.plugins import HeatMap
+
+        m = folium.Map(
+            [stops["latitude"].mean(), stops["longitude"].mean()],
+            zoom_start=10,
+        )
+        # Stops are pre-binned per metric and cell size, so only the non-empty
+        # cells are sent to the map
+        heat_data = get_stop_heatmap(
+            select_column, cell_size_m, snapshot=snapshot
+        ).tolist()
+        # Plot it on the map
+        HeatMap(
+            heat_data,
+            radius=25,
+            blur=15,
+            # gradient={0.2: "blue", 0.4: "lime", 0.6: "yellow", 1: "red"},
+            min_opacity=0.3,
+        ).add_to(m)
+        stage.rows = len(heat_data)
+
+    with span("st_folium"):
+        from streamlit_folium import st_folium
+
+        st_data = st_folium(m, width=900, height=800)
+
+    # List the stops near the last point clicked on the map, found with the
+    # spatial index instead of measuring the distance to every stop
+    radius_m = st.select_slider(
+        "Nearby stops within (meters)", NEARBY_STOP_RADII_M, value=400
     )
-    heat_data = [
-        [row["latitude"], row["longitude"], row[select_column]]
-        for index, row in heat_df.iterrows()
-    ]
-    # Plot it on the map
-    HeatMap(
-        heat_data,
-        radius=25,
-        blur=15,
-        # gradient={0.2: "blue", 0.4: "lime", 0.6: "yellow", 1: "red"},
-        min_opacity=0.3,
-    ).add_to(m)
-
-    st_data = st_folium(m, width=900, height=800)
+    clicked = (st_data or {}).get("last_clicked")
+    if clicked:
+        with span("nearby stops") as stage:
+            _, positions, distances = get_stop_spatial_index().within(
+                clicked["lat"], clicked["lng"], radius_m
+            )
+            nearby = stops.iloc[positions][
+                ["stop_id", "stop_name", "rider_on", "rider_total"]
+            ].assign(distance_m=distances.round())
+            if snapshot and len(nearby):
+                # Show the ridership of the period on the heatmap
+                snapshot_rides = get_stop_ridership(
+                    tuple(nearby["stop_id"]), snapshot
+                ).set_index("stop_id")
+                nearby = nearby.assign(
+                    rider_on=nearby["stop_id"].map(snapshot_rides["rider_on"]),
+                    rider_total=nearby["stop_id"].map(
+                        snapshot_rides["rider_total"]
+                    ),
+                )
+            stage.rows = len(nearby)
+        st.subheader(f"{len(nearby)} stops within {radius_m} m")
+        st.dataframe(
+            nearby.rename(
+                columns={
+                    "stop_id": "Stop",
+                    "stop_name": "Name",
+                    "rider_on": "Daily boardings",
+                    "rider_total": "Daily boardings and alightings",
+                    "distance_m": "Distance (m)",
+                }
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+    else:
+        st.caption("Click anywhere on the map to list the stops near it.")
+
+finish_run()
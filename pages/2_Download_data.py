@@ -1,48 +1,96 @@
-import pandas as pd
 import streamlit as st
-from streamlit_extras.dataframe_explorer import dataframe_explorer
 
-from app.load_data import get_rides, get_rides_quarterly, get_route_linestrings
+from app.export import download_export
+from app.load_data import read_route_dimension
+from app.query import column_ranges, scan_ridership
+from app.tracing import cache_data, finish_run, span, start_run
 
 st.set_page_config(
     layout="wide", page_icon="⬇️", page_title="Download MTA Bus Ridership Data"
 )
+start_run("Download data")
 
+columns = [
+    "route",
+    "date",
+    "ridership",
+    "ridership_per_day",
+    # "ridership_weekday",
+    # "ridership_weekday_2019",
+]
+numeric_columns = ["ridership", "ridership_per_day"]
+
+
+@cache_data
+def get_filter_options():
+    # Route names and column ranges come from the route table and the
+    # parquet statistics, so no ridership rows are read
+    return (
+        read_route_dimension()["route"].tolist(),
+        column_ranges(columns=["date"] + numeric_columns),
+    )
+
+
+@cache_data
+def get_filtered_rides(routes, start_date, end_date, bounds):
+    # Only the row groups that can match the filters are read
+    return (
+        scan_ridership(
+            columns=columns,
+            routes=routes,
+            start_date=start_date,
+            end_date=end_date,
+            bounds=dict(bounds),
+        )
+        .read_all()
+        .to_pandas()
+    )
 
-@st.cache_data
-def convert_df(df):
-    # IMPORTANT: Cache the conversion to prevent computation on every rerun
-    return df.to_csv().encode("utf-8")
-
-
-rides = get_rides()[
-    [
-        "route",
-        "date",
-        "ridership",
-        "ridership_per_day",
-        # "ridership_weekday",
-        # "ridership_weekday_2019",
-    ]
-].rename(
-    columns={
-        # "ridership_weekday_2019": "ridership_weekday_2019_baseline",
-        "business_days": "n_weekdays",
-        # "ridership": "ridership_monthly",
-    }
-)
 
 st.markdown("## Ridership data by route")
 
 with st.expander("Notes"):
     st.write("The 'date' column refers to the first day of the month.")
-dataframe = rides
-filtered_dataframe = dataframe_explorer(dataframe)
-st.dataframe(filtered_dataframe, use_container_width=True, hide_index=True)
-csv = convert_df(filtered_dataframe)
-st.download_button(
-    label="Download filtered dataset as CSV",
-    data=csv,
-    file_name="mta_bus_ridership_by_route.csv",
-    mime="text/csv",
+
+route_options, ranges = get_filter_options()
+col1, col2 = st.columns([2, 1])
+routes = col1.multiselect("Routes", route_options, placeholder="All routes")
+min_date, max_date = (d.date() for d in ranges["date"])
+date_range = col2.date_input(
+    "Date range",
+    value=(min_date, max_date),
+    min_value=min_date,
+    max_value=max_date,
 )
+# The second date is missing while the user is picking the range
+start_date, end_date = (tuple(date_range) + (max_date,))[:2]
+
+bounds = []
+for col, container in zip(numeric_columns, st.columns(len(numeric_columns))):
+    low, high = (float(v) for v in ranges[col])
+    selected = container.slider(col, low, high, (low, high))
+    # Only filter on a column when its range has been narrowed
+    if selected != (low, high):
+        bounds.append((col, selected))
+
+filters = dict(
+    routes=tuple(routes),
+    start_date=start_date,
+    end_date=end_date,
+    bounds=tuple(bounds),
+)
+filtered_dataframe = get_filtered_rides(**filters)
+with span("table", rows=len(filtered_dataframe)):
+    st.dataframe(filtered_dataframe, use_container_width=True, hide_index=True)
+# The export scans the same filtered rows again as a stream, and only when a
+# download is requested
+with span("export"):
+    download_export(
+        lambda: scan_ridership(
+            columns=columns,
+            **{**filters, "bounds": dict(filters["bounds"])},
+        ),
+        file_stem="mta_bus_ridership_by_route",
+    )
+
+finish_run()
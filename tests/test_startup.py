@@ -0,0 +1,17 @@
+import subprocess
+import sys
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def test_pages_start_within_budget():
+    # The same check as `python benchmark.py --startup`: each page's imports
+    # run in a fresh interpreter and must finish within STARTUP_BUDGET_S
+    result = subprocess.run(
+        [sys.executable, "benchmark.py", "--startup"],
+        capture_output=True,
+        text=True,
+        cwd=REPO,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr